@@ -19,27 +19,212 @@ Version: 3.0.0 (Windows2Go Edition)
 Autor: LMLK-seal
 """
 
-import customtkinter as ctk
-from tkinter import filedialog, messagebox
-import psutil
 import subprocess
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
 import os
 import sys
 import time
 import json
 import re
-from pathlib import Path
-from typing import List, Dict, Optional, Callable
+import codecs
+import collections
+import hashlib
+import mmap
+import stat
+import fnmatch
+import struct
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Callable, Iterator, Tuple
 import tempfile
 import shutil
-import ctypes
+
+# The GUI toolkit and the heavier system modules are imported where they are first needed, so the
+# install core (and headless mode) can be imported without them and the window appears quickly.
+ctk = filedialog = messagebox = None  # Set by load_gui()
 
 # --- Application Configuration ---
 APP_NAME = "Windows2Go"
 APP_VERSION = "3.0.0"
 CONFIG_FILE = "windows_togo_config.json"
 SEVEN_ZIP_EXECUTABLE = "7z.exe"
+# Executables used for each step. Any of them can be overridden with "tool_paths" in the config file
+# (or --tool NAME=PATH in headless mode), e.g. to run the whole pipeline against stub tools.
+DEFAULT_TOOLS = {"7z": SEVEN_ZIP_EXECUTABLE, "diskpart": "diskpart", "dism": "dism", "bcdboot": "bcdboot", "powershell": "powershell",
+                 "reg": "reg", "robocopy": "robocopy", "compact": "compact"}
+CREATE_NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)  # Windows-only flag; 0 elsewhere
+DISKPART_LOCK = threading.Lock()  # diskpart allows only one running instance at a time
+
+# --- ISO Extraction Planning ---
+# Files each later phase reads from the extracted ISO tree, as groups of alternatives in order of
+# preference (archive paths, compared case-insensitively). Only these are pulled out of the ISO.
+PHASE_REQUIRED_FILES: Dict[str, List[tuple]] = {
+    "apply": [("sources/install.wim", "sources/install.esd")],
+    "bootable": [],
+}
+# "selective": extract only planned files, "full": extract the whole ISO,
+# "mount": mount the ISO and read the image from it directly (no temp copy).
+EXTRACTION_MODES = ("selective", "full", "mount")
+
+# --- Scratch Space Placement ---
+SCRATCH_DIR_NAME = "Windows2Go-scratch"   # Created at the root of a volume chosen for extraction
+SCRATCH_MARGIN_BYTES = 512 * 1024 ** 2     # Free space left over on the scratch volume after extracting
+SCRATCH_PROBE_SECONDS = 0.25               # Time limit of the quick write test that ranks scratch volumes
+SCRATCH_PROBE_BYTES = 64 * 1024 ** 2
+
+ISO_SECTOR_SIZE = 2048
+WIM_HEADER_SIZE = 208
+WIM_ARCHITECTURES = {0: "x86", 5: "ARM", 6: "IA64", 9: "x64", 12: "ARM64"}
+WTG_SPACE_MARGIN_GB = 4  # Room for the pagefile, first-boot setup and updates on top of the expanded image
+
+APP_DATA_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache"), APP_NAME)
+
+# --- UI Event Pipeline ---
+UI_DRAIN_INTERVAL_MS = 50     # How often the Tk main loop drains worker events
+UI_DRAIN_MAX_EVENTS = 5000    # Events handled per drain, so a flood of output never stalls the UI
+LOG_WIDGET_MAX_LINES = 2000   # The log widget keeps only the most recent lines; the log file has everything
+LOG_DIR = os.path.join(APP_DATA_DIR, "logs")
+LOG_FILES_KEPT = 20
+
+# --- Install Phases ---
+# Seconds each phase is expected to take, used to weight overall progress until real durations
+# have been measured (see "phase_durations" in the config file).
+DEFAULT_PHASE_DURATIONS = {"extract": 180.0, "prepare": 60.0, "benchmark": 8.0, "apply": 1800.0, "tune": 10.0, "bootable": 60.0,
+                           "stage": 60.0, "refresh": 600.0, "verify": 120.0, "convert": 600.0}
+PHASE_DURATION_SMOOTHING = 0.5  # Weight of the latest run in the moving average of phase durations
+JOURNAL_DIR = os.path.join(APP_DATA_DIR, "journals")  # One install journal per disk, for resuming failed runs
+
+# --- Apply Options ---
+# "standard": plain DISM apply. "compact": DISM /Compact stores system files compressed, which writes
+# far fewer bytes to the (slow) USB drive at the cost of some CPU when they are read.
+APPLY_MODES = ("standard", "compact")
+APPLY_MODE_LABELS = {"standard": "Standard", "compact": "Compact (fewer bytes written to the USB)"}
+# Offline edits that cut write-heavy features of a portable OS, by name. Each edit is
+# (hive file in Windows\System32\config, key, value, type, data) and is applied with `reg` after the apply.
+PORTABLE_TWEAKS: Dict[str, List[tuple]] = {
+    "pagefile": [("SYSTEM", r"ControlSet001\Control\Session Manager\Memory Management", "PagingFiles", "REG_MULTI_SZ", "")],
+    "hibernation": [("SYSTEM", r"ControlSet001\Control\Power", "HibernateEnabled", "REG_DWORD", "0"),
+                    ("SYSTEM", r"ControlSet001\Control\Power", "HibernateEnabledDefault", "REG_DWORD", "0")],
+    "system_restore": [("SOFTWARE", r"Policies\Microsoft\Windows NT\SystemRestore", "DisableSR", "REG_DWORD", "1"),
+                       ("SOFTWARE", r"Policies\Microsoft\Windows NT\SystemRestore", "DisableConfig", "REG_DWORD", "1")],
+    "indexing": [("SYSTEM", r"ControlSet001\Services\WSearch", "Start", "REG_DWORD", "4")],
+}
+
+# --- Subprocess Output Processing ---
+OUTPUT_READ_SIZE = 64 * 1024          # Bytes read from a tool's stdout at a time
+OUTPUT_TAIL_LINES = 200               # Lines of output kept in memory for error reports
+PROGRESS_MIN_INTERVAL = 0.1           # Seconds between progress callbacks
+# Progress formats: DISM "[=====      20.0%       ]", 7-Zip -bsp1 " 20% 3 - sources\install.wim"
+PROGRESS_PATTERNS = {
+    "dism": re.compile(r'\[[=\s]*(\d{1,3}(?:\.\d+)?)%[=\s]*\]'),
+    "7z": re.compile(r'^\s*(\d{1,3})%'),
+}
+
+# --- Tool Supervision ---
+# Limits for each tool run, by the phase running it: "timeout" is the longest a run may take and
+# "stall" how long it may go without printing anything or doing disk I/O (0 disables either).
+# Overridden per phase with "phase_limits" in the config file.
+DEFAULT_PHASE_LIMITS = {
+    "extract": {"timeout": 2 * 3600, "stall": 600},
+    "prepare": {"timeout": 1800, "stall": 900},
+    "apply": {"timeout": 8 * 3600, "stall": 1800},
+    "tune": {"timeout": 600, "stall": 300},
+    "bootable": {"timeout": 900, "stall": 600},
+    "stage": {"timeout": 3600, "stall": 900},
+    "convert": {"timeout": 2 * 3600, "stall": 900},
+}
+SUPERVISOR_INTERVAL = 0.5   # Seconds between checks of a running tool (cancellation is noticed at once)
+KILL_GRACE_SECONDS = 2.0    # Time a stopped tool gets to exit before it is killed
+
+# --- Extraction Cache ---
+DEFAULT_CACHE_DIR = os.path.join(APP_DATA_DIR, "extract-cache")
+CACHE_MANIFEST = "manifest.json"
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024  # Bytes hashed from the start, middle and end of a file
+
+# --- ESD Conversion ---
+# An install.esd is LZMS-compressed, so applying it is bound by decompression on the CPU. The chosen
+# index can be exported once to a WIM with faster compression, which later applies read instead.
+# "auto": convert when the image is read more than once in a run (several drives, or a refresh or
+# verification, which would otherwise expand the ESD to scratch); "always": convert every ESD so
+# later runs profit; "off": neither convert nor use converted images.
+ESD_CONVERSION_MODES = ("auto", "always", "off")
+# DISM /Compress values for the export: XPRESS ("fast") or LZX ("max"); both decompress far faster than LZMS.
+ESD_COMPRESSIONS = ("fast", "max")
+DEFAULT_WIM_CACHE_DIR = os.path.join(APP_DATA_DIR, "wim-cache")
+CONVERTED_IMAGE_NAME = "install.wim"
+CONVERT_SPACE_FACTOR = 2.0  # Free space needed for an export, as a multiple of the ESD size (XPRESS compresses less)
+
+# --- Performance Tracing ---
+TRACE_DIR = os.path.join(APP_DATA_DIR, "traces")
+TRACE_FILES_KEPT = 20              # Runs whose traces are kept (a .jsonl and a Chrome .json file each)
+TRACE_IO_SAMPLE_INTERVAL = 0.5     # Seconds between samples of a running tool's I/O counters
+
+# --- Drive Benchmark ---
+BENCHMARK_FILE = "windows2go-benchmark.tmp"
+BENCHMARK_SECONDS = 1.5                    # Time limit for each of the four tests
+BENCHMARK_MAX_FILE_BYTES = 256 * 1024 ** 2  # The sequential write stops here even if time is left
+BENCHMARK_BLOCK = 1024 * 1024              # Sequential I/O size
+BENCHMARK_RANDOM_BLOCK = 4096              # Random I/O size
+BENCHMARK_RESULTS_FILE = os.path.join(APP_DATA_DIR, "drive-benchmarks.json")
+# Performance classes, best first: (name, minimum sequential write MB/s, minimum 4K random write IOPS).
+DRIVE_CLASSES = [("fast", 150, 1500), ("good", 60, 400), ("usable", 20, 100), ("slow", 0, 0)]
+# Estimated small writes per file of the image during the DISM apply (data, metadata and directory updates).
+APPLY_WRITES_PER_FILE = 2
+
+# --- Differential Refresh ---
+# "clean" formats the drive and applies the image; "refresh" updates an existing Windows2Go drive
+# in place, writing only the files that differ from the new image; "verify" only checks a drive.
+INSTALL_MODES = ("clean", "refresh", "verify")
+MANIFEST_DIR = os.path.join(APP_DATA_DIR, "manifests")  # File manifests of images and refreshed volumes
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 2)
+# Top-level entries of a Windows2Go volume that are not part of the image; a refresh leaves them
+# alone (bcdboot rewrites the boot files afterwards).
+REFRESH_KEEP = ("system volume information", "$recycle.bin", "boot", "efi", "bootmgr", "bootnxt", "bootmgr.efi")
+LINK_REPARSE_TAGS = (0xA0000003, 0xA000000C)  # Junctions (mount points) and symlinks
+WOF_REPARSE_TAG = 0x80000017  # Files stored compressed by compact mode
+# On Windows a refresh copies changed files with one robocopy run over the tree, limited by a job file to
+# the names of those files: /COPYALL keeps security descriptors, owner, auditing and alternate data streams,
+# /B uses backup privileges, /XJ leaves links to the refresh and /FP lists each file with its full path as it
+# lands. Files with a matching name that are already up to date have the same size and time, so robocopy skips them.
+REFRESH_ROBOCOPY_THREADS = 8
+REFRESH_ROBOCOPY_ARGS = ['/S', '/XJ', '/COPYALL', '/B', f'/MT:{REFRESH_ROBOCOPY_THREADS}', '/R:1', '/W:1',
+                         '/NP', '/NJH', '/NJS', '/NDL', '/NC', '/NS', '/FP']
+REFRESH_COMPACT_ARGS = ['/c', '/exe:xpress4k', '/i', '/q']  # What DISM /Compact uses
+# Patterns of files DISM /Compact leaves uncompressed (boot-critical ones), read from the image.
+COMPACT_EXCLUSIONS_FILE = os.path.join("Windows", "System32", "WimBootCompress.ini")
+COMMAND_LINE_BUDGET = 24000  # Characters of file names per tool run (Windows allows 32,767 per command line)
+
+# --- Post-install Verification ---
+# "sampled" reads back a random share of the files (plus the files Windows needs to start); "full" reads them all.
+VERIFY_MODES = ("off", "sampled", "full")
+VERIFY_MODE_LABELS = {"off": "Off", "sampled": "Sampled (fast)", "full": "Full (every file)"}
+VERIFY_SAMPLE_PERCENT = 5  # Default share of files and of bytes checked in sampled mode
+VERIFY_ALWAYS = (r"Windows\System32\ntoskrnl.exe", r"Windows\System32\hal.dll", r"Windows\System32\ci.dll",
+                 r"Windows\System32\winload.exe", r"Windows\System32\winload.efi", r"Windows\System32\drivers\disk.sys",
+                 r"Windows\System32\drivers\ntfs.sys", r"Windows\System32\drivers\usbstor.sys")
+# Parallel readers per drive class (see DRIVE_CLASSES); slow sticks get worse with concurrent reads.
+VERIFY_WORKERS = {"fast": 8, "good": 4, "usable": 2, "slow": 1}
+VERIFY_DEFAULT_WORKERS = 2  # Drives that were never benchmarked
+VERIFY_REPORT_LIMIT = 10    # Mismatches listed in the log
+
+# --- USB Drive Discovery ---
+DRIVE_POLL_INTERVAL = 2.0          # Seconds between cheap checks for added or removed volumes
+DRIVE_FULL_RESCAN_INTERVAL = 30.0  # Seconds between full enumerations when nothing seems to change
+
+# --- Tool Sessions ---
+# diskpart and PowerShell run as long-lived sessions fed over stdin instead of one process per query.
+TOOL_SESSION_TIMEOUT = 600.0      # Seconds one command may take before its session is killed
+TOOL_SESSION_IDLE_SECONDS = 60.0  # Idle sessions are closed; diskpart allows one instance system-wide
+DISKPART_PROMPT = "DISKPART> "    # Printed by diskpart whenever it is ready for the next command
+POWERSHELL_ERROR_MARKER = "__W2G_ERROR__"
+# Interactive diskpart carries on after a failed command, so failures are recognised in its replies.
+DISKPART_ERROR_PATTERN = re.compile(r"DiskPart has encountered an error|Virtual Disk Service error|DiskPart failed|"
+                                    r"is not valid|There is no \w+ selected|not free to be assigned|"
+                                    r"arguments specified for this command are not valid", re.IGNORECASE)
+DRIVE_LETTER_CANDIDATES = "WVUTSRQPONMLKJIHG"  # Letters given to target volumes, away from the commonly used ones
 
 # --- Custom Exception for Detailed Errors ---
 class SubprocessError(Exception):
@@ -51,16 +236,2883 @@ class SubprocessError(Exception):
         details = f"\n\n--- Command Output ---\n{self.command_output}" if self.command_output else ""
         return f"{super().__str__()}{details}"
 
-# Set appearance mode and color theme
-ctk.set_appearance_mode("dark")
-ctk.set_default_color_theme("blue")
+class InstallationCancelled(SubprocessError):
+    """Raised inside a phase when the installation is stopped, by the user or because another phase failed."""
+
+class ToolTimeoutError(SubprocessError):
+    """Raised when a tool was stopped for taking too long or for making no progress."""
+
+class ToolSessionLost(SubprocessError):
+    """Raised when a command can't be sent because the session's process is gone."""
+
+def _normalize_archive_path(path: str) -> str:
+    return path.replace("\\", "/").strip("/").lower()
+
+def list_iso_contents(iso_path: str, seven_zip: str = SEVEN_ZIP_EXECUTABLE) -> Dict[str, int]:
+    """Lists the files in an ISO with 7-Zip. Returns {archive path: size in bytes}."""
+    command = [seven_zip, 'l', '-slt', '-ba', iso_path]
+    proc = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='replace',
+                          creationflags=CREATE_NO_WINDOW)
+    if proc.returncode != 0:
+        raise SubprocessError(f"Could not list the contents of {os.path.basename(iso_path)}.", proc.stdout + proc.stderr)
+    entries: Dict[str, int] = {}
+    path, size, is_dir = None, 0, False
+    for line in proc.stdout.splitlines() + [""]:
+        if not line.strip():
+            if path is not None and not is_dir: entries[path] = size
+            path, size, is_dir = None, 0, False
+            continue
+        key, _, value = line.partition(" = ")
+        if key == "Path": path = value
+        elif key == "Size": size = int(value) if value.isdigit() else 0
+        elif key in ("Folder", "Attributes") and (value == "+" or value.startswith("D")): is_dir = True
+    return entries
+
+def plan_extraction(entries: Dict[str, int], phases: Optional[List[str]] = None) -> List[str]:
+    """Picks the first present alternative of each PHASE_REQUIRED_FILES group from an ISO listing. Raises RuntimeError if one is missing."""
+    by_name = {_normalize_archive_path(p): p for p in entries}
+    selected = []
+    for phase in (phases or list(PHASE_REQUIRED_FILES)):
+        for alternatives in PHASE_REQUIRED_FILES.get(phase, []):
+            match = next((by_name[a] for a in alternatives if a in by_name), None)
+            if match is None:
+                raise RuntimeError(f"The ISO does not contain any of: {', '.join(alternatives)}.")
+            if match not in selected: selected.append(match)
+    return selected
+
+def find_image_file(root: str) -> str:
+    """Returns the path of install.wim (preferred) or install.esd below an extracted or mounted ISO root."""
+    for name in PHASE_REQUIRED_FILES["apply"][0]:
+        candidate = os.path.join(root, *name.split("/"))
+        if os.path.exists(candidate): return candidate
+    raise RuntimeError("Could not find install.wim or install.esd in the ISO's sources directory.")
+
+# --- ISO File System Reader ---
+class IsoFormatError(Exception):
+    """Raised when an ISO image is truncated or its file system structures are not understood."""
+
+class IsoEntry:
+    """A file or directory inside an ISO. `extents` are (byte offset in the ISO, length) pairs."""
+    __slots__ = ("path", "is_dir", "size", "extents")
+
+    def __init__(self, path: str, is_dir: bool, size: int, extents: List[Tuple[int, int]]):
+        self.path, self.is_dir, self.size, self.extents = path, is_dir, size, extents
+
+    @property
+    def offset(self) -> int:
+        return self.extents[0][0] if self.extents else 0
+
+    @property
+    def is_contiguous(self) -> bool:
+        return all(a[0] + a[1] == b[0] for a, b in zip(self.extents, self.extents[1:]))
+
+    def __repr__(self):
+        return f"IsoEntry({self.path!r}, size={self.size}, offset={self.offset}, extents={len(self.extents)})"
+
+class IsoImage:
+    """Reads the directory tree of an ISO (UDF, then Joliet, then ISO9660) in place through a read-only memory map."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise IsoFormatError(f"{os.path.basename(path)} is empty.")
+        self.file_system = ""
+        self._block_size = ISO_SECTOR_SIZE
+        self._partitions: List[int] = []
+        self._root = None
+        try:
+            self._detect()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._map.closed: self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if offset < 0 or offset + length > len(self._map):
+            raise IsoFormatError(f"The image is truncated (needed bytes {offset}-{offset + length} of {len(self._map)}).")
+        return self._map[offset:offset + length]
+
+    # Volume recognition
+    def _detect(self):
+        primary = joliet = None
+        has_udf = False
+        for sector in range(16, 16 + 64):
+            if (sector + 1) * ISO_SECTOR_SIZE > len(self._map): break
+            descriptor = self._read(sector * ISO_SECTOR_SIZE, ISO_SECTOR_SIZE)
+            identifier = descriptor[1:6]
+            if identifier == b"CD001":
+                if descriptor[0] == 1 and primary is None: primary = descriptor
+                elif descriptor[0] == 2 and descriptor[88:91] in (b"%/@", b"%/C", b"%/E"): joliet = descriptor
+            elif identifier in (b"NSR02", b"NSR03"): has_udf = True
+            elif identifier not in (b"BEA01", b"TEA01", b"BOOT2", b"CDW02"): break
+        if has_udf:
+            try:
+                self._root = ("udf",) + self._udf_root()
+                self.file_system = "UDF"
+                return
+            except IsoFormatError:
+                if not (joliet or primary): raise
+        if joliet or primary:
+            self.file_system = "Joliet" if joliet else "ISO9660"
+            root = self._iso_record((joliet or primary)[156:190], bool(joliet))[2]
+            root.path = ""
+            self._root = ("iso", root)
+            return
+        raise IsoFormatError(f"{os.path.basename(self.path)} is not an ISO9660 or UDF image.")
+
+    # ISO9660 / Joliet
+    def _iso_record(self, record: bytes, joliet: bool) -> Tuple[str, int, IsoEntry]:
+        """Returns (name, flags, entry) for a directory record."""
+        lba, length = struct.unpack_from("<I4xI", record, 2)
+        flags, name_len = record[25], record[32]
+        raw_name = record[33:33 + name_len]
+        if raw_name in (b"\x00", b"\x01"): name = "\x00"
+        elif joliet: name = raw_name.decode("utf-16-be", errors="replace")
+        else: name = raw_name.decode("ascii", errors="replace")
+        name = name.split(";")[0]
+        if not (flags & 0x02) and name.endswith("."): name = name[:-1]
+        return name, flags, IsoEntry(name, bool(flags & 0x02), length, [(lba * ISO_SECTOR_SIZE, length)] if length else [])
+
+    def _iso_children(self, directory: IsoEntry) -> List[IsoEntry]:
+        data = b"".join(self._read(offset, length) for offset, length in directory.extents)
+        joliet = self.file_system == "Joliet"
+        children: List[IsoEntry] = []
+        pending: Optional[IsoEntry] = None
+        pos = 0
+        while pos < len(data):
+            record_len = data[pos]
+            if record_len == 0:  # Records never cross a sector boundary; the rest of the sector is padding.
+                pos = (pos // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+                continue
+            name, flags, entry = self._iso_record(data[pos:pos + record_len], joliet)
+            pos += record_len
+            if name == "\x00": continue
+            if pending is not None and pending.path == name:  # Continuation of a multi-extent file (> 4 GB)
+                pending.extents += entry.extents; pending.size += entry.size
+            else:
+                pending = entry; children.append(entry)
+            if not (flags & 0x80): pending = None
+        return children
+
+    # UDF
+    def _udf_descriptor(self, offset: int, expected_tags: Tuple[int, ...]) -> bytes:
+        block = self._read(offset, self._block_size)
+        tag_id = struct.unpack_from("<H", block, 0)[0]
+        if tag_id not in expected_tags:
+            raise IsoFormatError(f"Unexpected UDF descriptor {tag_id} at offset {offset} (expected {expected_tags}).")
+        return block
+
+    def _udf_offset(self, block: int, partition_ref: int) -> int:
+        if partition_ref >= len(self._partitions):
+            raise IsoFormatError(f"UDF partition reference {partition_ref} is out of range.")
+        return (self._partitions[partition_ref] + block) * self._block_size
+
+    def _udf_root(self) -> Tuple[int, int]:
+        anchor = self._udf_descriptor(256 * ISO_SECTOR_SIZE, (2,))
+        vds_length, vds_location = struct.unpack_from("<II", anchor, 16)
+        partition_starts: Dict[int, int] = {}
+        logical_volume = None
+        for index in range(max(1, vds_length // ISO_SECTOR_SIZE)):
+            descriptor = self._read((vds_location + index) * ISO_SECTOR_SIZE, ISO_SECTOR_SIZE)
+            tag_id = struct.unpack_from("<H", descriptor, 0)[0]
+            if tag_id == 5:
+                number = struct.unpack_from("<H", descriptor, 22)[0]
+                partition_starts[number] = struct.unpack_from("<I", descriptor, 188)[0]
+            elif tag_id == 6 and logical_volume is None:
+                logical_volume = descriptor
+            elif tag_id == 8:
+                break
+        if logical_volume is None or not partition_starts:
+            raise IsoFormatError("The UDF volume descriptor sequence has no logical volume or partition.")
+        self._block_size = struct.unpack_from("<I", logical_volume, 212)[0]
+        fsd_block, fsd_partition = struct.unpack_from("<IH", logical_volume, 252)
+        map_count = struct.unpack_from("<I", logical_volume, 268)[0]
+        pos = 440
+        for _ in range(map_count):
+            map_type, map_len = logical_volume[pos], logical_volume[pos + 1]
+            if map_type != 1:
+                raise IsoFormatError("UDF virtual, sparable and metadata partitions are not supported.")
+            number = struct.unpack_from("<H", logical_volume, pos + 4)[0]
+            if number not in partition_starts:
+                raise IsoFormatError(f"UDF partition {number} is referenced but not described.")
+            self._partitions.append(partition_starts[number])
+            pos += map_len
+        file_set = self._udf_descriptor(self._udf_offset(fsd_block, fsd_partition), (256,))
+        return struct.unpack_from("<IH", file_set, 404)
+
+    def _udf_entry(self, name: str, block: int, partition_ref: int) -> IsoEntry:
+        """Reads a (extended) file entry and resolves its allocation descriptors into byte extents."""
+        entry_offset = self._udf_offset(block, partition_ref)
+        entry = self._udf_descriptor(entry_offset, (261, 266))
+        extended = struct.unpack_from("<H", entry, 0)[0] == 266
+        ea_length, ad_length = struct.unpack_from("<II", entry, 208 if extended else 168)
+        ad_start = (216 if extended else 176) + ea_length
+        is_dir = entry[27] == 4
+        ad_type = struct.unpack_from("<H", entry, 34)[0] & 0x07
+        size = struct.unpack_from("<Q", entry, 56)[0]
+        extents: List[Tuple[int, int]] = []
+        if ad_type == 3:  # Data embedded in the file entry itself
+            extents.append((entry_offset + ad_start, ad_length))
+        elif ad_type in (0, 1):
+            ad_size = 8 if ad_type == 0 else 16
+            for pos in range(ad_start, ad_start + ad_length - ad_size + 1, ad_size):
+                raw_length, location = struct.unpack_from("<II", entry, pos)
+                ref = partition_ref if ad_type == 0 else struct.unpack_from("<H", entry, pos + 8)[0]
+                length, extent_type = raw_length & 0x3FFFFFFF, raw_length >> 30
+                if length == 0: break
+                if extent_type == 3:
+                    raise IsoFormatError(f"Chained UDF allocation descriptors ({name}) are not supported.")
+                extents.append((self._udf_offset(location, ref), length))
+        else:
+            raise IsoFormatError(f"Unsupported UDF allocation descriptor type {ad_type} ({name}).")
+        remaining, trimmed = size, []
+        for offset, length in extents:
+            if remaining <= 0: break
+            trimmed.append((offset, min(length, remaining))); remaining -= length
+        return IsoEntry(name, is_dir, size, trimmed)
+
+    def _udf_children(self, directory: IsoEntry) -> List[Tuple[str, bool, int, int]]:
+        """Returns (name, is_dir, icb block, icb partition) for each file identifier in a directory."""
+        data = b"".join(self._read(offset, length) for offset, length in directory.extents)
+        children = []
+        pos = 0
+        while pos + 38 <= len(data):
+            if struct.unpack_from("<H", data, pos)[0] != 257:
+                raise IsoFormatError(f"Corrupt UDF directory {directory.path!r}.")
+            characteristics, id_length = data[pos + 18], data[pos + 19]
+            block, partition_ref = struct.unpack_from("<IH", data, pos + 24)
+            iu_length = struct.unpack_from("<H", data, pos + 36)[0]
+            raw_name = data[pos + 38 + iu_length:pos + 38 + iu_length + id_length]
+            pos += (38 + iu_length + id_length + 3) & ~3
+            if characteristics & 0x0C or not raw_name: continue  # Deleted or parent entry
+            name = raw_name[1:].decode("utf-16-be" if raw_name[0] == 16 else "latin-1", errors="replace")
+            children.append((name, bool(characteristics & 0x02), block, partition_ref))
+        return children
+
+    # Public API
+    def _root_entry(self) -> IsoEntry:
+        if self._root[0] == "udf": return self._udf_entry("", self._root[1], self._root[2])
+        return self._root[1]
+
+    def _list(self, directory: IsoEntry) -> List[Tuple[str, bool, Callable[[], IsoEntry]]]:
+        base = f"{directory.path}/" if directory.path else ""
+        if self._root[0] == "udf":
+            return [(name, is_dir, lambda n=name, b=block, p=ref: self._udf_entry(base + n, b, p))
+                    for name, is_dir, block, ref in self._udf_children(directory)]
+        result = []
+        for child in self._iso_children(directory):
+            child.path = base + child.path
+            result.append((child.path.rsplit("/", 1)[-1], child.is_dir, lambda c=child: c))
+        return result
+
+    def find(self, path: str) -> Optional[IsoEntry]:
+        """Returns the entry at `path` (any separator, case-insensitive) or None if it does not exist."""
+        entry = self._root_entry()
+        for part in [p for p in path.replace("\\", "/").split("/") if p]:
+            if not entry.is_dir: return None
+            match = next((load for name, _, load in self._list(entry) if name.lower() == part.lower()), None)
+            if match is None: return None
+            entry = match()
+        return entry
+
+    def walk(self, path: str = "") -> Iterator[IsoEntry]:
+        """Yields every file below `path` (recursively, files only)."""
+        start = self.find(path)
+        stack = [start] if start is not None and start.is_dir else []
+        while stack:
+            for _, is_dir, load in self._list(stack.pop()):
+                entry = load()
+                if is_dir or entry.is_dir: stack.append(entry)
+                else: yield entry
+
+    def list_files(self) -> Dict[str, int]:
+        """Returns {path: size in bytes} for every file in the image, like list_iso_contents."""
+        return {entry.path: entry.size for entry in self.walk()}
+
+    def read_entry(self, entry: IsoEntry, offset: int, length: int) -> bytes:
+        """Reads `length` bytes at `offset` within a file, following its extents."""
+        parts, position = [], 0
+        for extent_offset, extent_length in entry.extents:
+            if length <= 0: break
+            if offset < position + extent_length:
+                start = max(offset - position, 0)
+                count = min(extent_length - start, length)
+                parts.append(self._read(extent_offset + start, count))
+                offset += count; length -= count
+            position += extent_length
+        return b"".join(parts)
+
+    def iter_chunks(self, entry: IsoEntry, chunk_size: int = 4 * 1024 * 1024) -> Iterator[bytes]:
+        """Yields the content of a file in chunks straight from the memory map."""
+        for offset, length in entry.extents:
+            for pos in range(offset, offset + length, chunk_size):
+                yield self._read(pos, min(chunk_size, offset + length - pos))
+
+def find_image_in_iso(iso: IsoImage) -> Optional[IsoEntry]:
+    """Returns the install.wim (preferred) or install.esd entry of an opened ISO, or None."""
+    for name in PHASE_REQUIRED_FILES["apply"][0]:
+        entry = iso.find(name)
+        if entry is not None and not entry.is_dir: return entry
+    return None
+
+
+def fingerprint_reader(read: Callable[[int, int], bytes], size: int) -> str:
+    """Fingerprints a file from its size and three 1 MiB samples; `read(offset, length)` returns bytes of the file."""
+    digest = hashlib.sha256(str(size).encode())
+    if size <= 3 * FINGERPRINT_SAMPLE_SIZE:
+        digest.update(read(0, size))
+    else:
+        for offset in (0, size // 2, size - FINGERPRINT_SAMPLE_SIZE):
+            digest.update(read(offset, FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+def fingerprint_file(path: str) -> str:
+    with open(path, 'rb') as f:
+        def read(offset: int, length: int) -> bytes:
+            f.seek(offset); return f.read(length)
+        return fingerprint_reader(read, os.path.getsize(path))
+
+class ExtractionCache:
+    """Files extracted from ISOs (and WIM exports of ESDs), kept between runs by fingerprint and evicted least-recently-used."""
+
+    def __init__(self, cache_dir: str, max_bytes: int, log: Optional[Callable[..., None]] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log = log or (lambda message, level="info": None)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._remove_stale_staging()
+
+    def _entry_dir(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def _remove_stale_staging(self):
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(".staging-"):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    def _read_manifest(self, entry_dir: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(entry_dir, CACHE_MANIFEST), 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def _write_manifest(self, entry_dir: str, manifest: Dict):
+        tmp_path = os.path.join(entry_dir, CACHE_MANIFEST + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, os.path.join(entry_dir, CACHE_MANIFEST))
+
+    def lookup(self, fingerprint: str, members: List[str]) -> Optional[str]:
+        """Returns the entry directory if it holds intact copies of all members, else None (dropping a damaged entry)."""
+        entry_dir = self._entry_dir(fingerprint)
+        manifest = self._read_manifest(entry_dir)
+        if manifest is None: return None
+        files = manifest.get("files", {})
+        for member in members:
+            key = _normalize_archive_path(member)
+            info = files.get(key)
+            path = os.path.join(entry_dir, *key.split("/"))
+            if info is None: return None
+            if not os.path.isfile(path) or os.path.getsize(path) != info["size"] or fingerprint_file(path) != info["fingerprint"]:
+                self.log(f"Cached copy of {member} failed the integrity check, discarding cache entry.", "warning")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+        manifest["last_used"] = time.time()
+        self._write_manifest(entry_dir, manifest)
+        return entry_dir
+
+    def create_staging(self, fingerprint: str) -> str:
+        return tempfile.mkdtemp(prefix=f".staging-{fingerprint[:16]}-", dir=self.cache_dir)
+
+    def publish(self, fingerprint: str, staging_dir: str, members: List[str], iso_name: str = "") -> str:
+        """Records the manifest of a completed staging directory and atomically renames it into place."""
+        files = {}
+        for member in members:
+            key = _normalize_archive_path(member)
+            path = os.path.join(staging_dir, *key.split("/"))
+            files[key] = {"size": os.path.getsize(path), "fingerprint": fingerprint_file(path)}
+        now = time.time()
+        self._write_manifest(staging_dir, {"iso_name": iso_name, "created": now, "last_used": now, "files": files})
+        entry_dir = self._entry_dir(fingerprint)
+        if os.path.exists(entry_dir): shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+        self.evict(keep=fingerprint)
+        return entry_dir
+
+    def discard(self, staging_dir: str):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def entries(self) -> List[Dict]:
+        """Lists cache entries as dicts with 'fingerprint', 'path', 'size' and 'last_used'."""
+        result = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(name)
+            if name.startswith(".") or not os.path.isdir(entry_dir): continue
+            manifest = self._read_manifest(entry_dir) or {}
+            size = sum(info.get("size", 0) for info in manifest.get("files", {}).values())
+            result.append({"fingerprint": name, "path": entry_dir, "size": size, "last_used": manifest.get("last_used", 0)})
+        return result
+
+    def evict(self, keep: Optional[str] = None):
+        """Removes least-recently-used entries until the cache fits into max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e["last_used"])
+        total = sum(e["size"] for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes: break
+            if entry["fingerprint"] == keep: continue
+            self.log(f"Evicting cache entry {entry['fingerprint'][:12]} ({entry['size'] / (1024 ** 3):.2f} GB)", "info")
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            total -= entry["size"]
+
+# --- WIM/ESD Metadata ---
+class WimFormatError(Exception):
+    """Raised when a file is not a WIM/ESD image or its XML metadata cannot be read."""
+
+_wim_images_cache: Dict[str, List[Dict]] = {}
+_wim_images_lock = threading.Lock()
+
+def parse_wim_images(read: Callable[[int, int], bytes], size: Optional[int] = None) -> List[Dict]:
+    """Reads the editions in a WIM/ESD from its header and XML metadata, one dict per image."""
+    header = read(0, WIM_HEADER_SIZE)
+    if len(header) < WIM_HEADER_SIZE or header[:8] != b"MSWIM\0\0\0":
+        raise WimFormatError("Not a WIM or ESD image.")
+    xml_size = int.from_bytes(header[72:79], "little")
+    xml_offset = struct.unpack_from("<Q", header, 80)[0]
+    if xml_size == 0 or (size is not None and xml_offset + xml_size > size):
+        raise WimFormatError("The image has no readable XML metadata.")
+    raw = read(xml_offset, xml_size)
+    import xml.etree.ElementTree as ET
+    try:
+        root = ET.fromstring(raw.decode("utf-16" if raw[:2] in (b"\xff\xfe", b"\xfe\xff") else "utf-16-le"))
+    except (UnicodeDecodeError, ET.ParseError) as e:
+        raise WimFormatError(f"The image's XML metadata is corrupt: {e}")
+    images = []
+    for image in root.findall("IMAGE"):
+        def text(path: str, default: str = "") -> str:
+            element = image.find(path)
+            return element.text.strip() if element is not None and element.text else default
+        def number(path: str) -> int:
+            value = text(path, "0")
+            return int(value) if value.isdigit() else 0
+        index = int(image.get("INDEX", len(images) + 1))
+        arch = text("WINDOWS/ARCH")
+        version = ".".join(text(f"WINDOWS/VERSION/{part}") for part in ("MAJOR", "MINOR", "BUILD", "SPBUILD")).strip(".")
+        images.append({
+            'index': index, 'name': text("DISPLAYNAME") or text("NAME") or f"Image {index}",
+            'edition': text("WINDOWS/EDITIONID") or text("FLAGS"),
+            'architecture': WIM_ARCHITECTURES.get(int(arch), arch) if arch.isdigit() else (arch or "unknown"),
+            'version': version, 'expanded_bytes': number("TOTALBYTES"),
+            'file_count': number("FILECOUNT"), 'dir_count': number("DIRCOUNT"),
+        })
+    if not images:
+        raise WimFormatError("The image's XML metadata lists no images.")
+    return sorted(images, key=lambda i: i['index'])
+
+def _cached_wim_images(read: Callable[[int, int], bytes], size: int) -> List[Dict]:
+    # The header holds the image GUID and the location of the XML resource, so it identifies the image content.
+    key = hashlib.sha256(read(0, WIM_HEADER_SIZE)).hexdigest() + f":{size}"
+    with _wim_images_lock:
+        if key in _wim_images_cache: return _wim_images_cache[key]
+    images = parse_wim_images(read, size)
+    with _wim_images_lock: _wim_images_cache[key] = images
+    return images
+
+def read_wim_images(path: str) -> List[Dict]:
+    """Returns the editions of a WIM/ESD file on disk (see parse_wim_images)."""
+    with open(path, 'rb') as f:
+        def read(offset: int, length: int) -> bytes:
+            f.seek(offset); return f.read(length)
+        return _cached_wim_images(read, os.path.getsize(path))
+
+def read_wim_images_from_iso(iso: IsoImage, entry: IsoEntry) -> List[Dict]:
+    """Returns the editions of a WIM/ESD inside an ISO without extracting it."""
+    return _cached_wim_images(lambda offset, length: iso.read_entry(entry, offset, length), entry.size)
+
+def describe_wim_image(image: Dict) -> str:
+    return f"{image['index']}: {image['name']} ({image['architecture']}, {image['expanded_bytes'] / (1024 ** 3):.1f} GB)"
+
+# --- UI Event Pipeline ---
+class EventBus:
+    """Thread-safe queue of ('log' | 'progress' | 'label' | 'call', ...) events from worker threads to the UI."""
 
-class WindowsToGoCreator:
     def __init__(self):
-        # --- Pre-flight Checks ---
-        self.check_admin_rights()
-        self.check_dependencies()
+        self._queue = queue.SimpleQueue()
+
+    def post(self, kind: str, *payload):
+        self._queue.put((kind,) + payload)
+
+    def drain(self, limit: int = UI_DRAIN_MAX_EVENTS) -> List[tuple]:
+        events = []
+        try:
+            while len(events) < limit: events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+def open_log_file() -> Optional[object]:
+    """Opens a new timestamped log file in LOG_DIR and prunes the oldest ones. Returns None if not writable."""
+    try:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        old_logs = sorted(f for f in os.listdir(LOG_DIR) if f.startswith("windows2go-") and f.endswith(".log"))
+        for name in old_logs[:max(0, len(old_logs) - LOG_FILES_KEPT + 1)]:
+            os.remove(os.path.join(LOG_DIR, name))
+        return open(os.path.join(LOG_DIR, time.strftime("windows2go-%Y%m%d-%H%M%S.log")), 'a', encoding='utf-8')
+    except OSError as e:
+        print(f"Failed to open log file: {e}")
+        return None
+
+# --- Subprocess Output Processing ---
+def progress_pattern_for(command: List[str]) -> Optional["re.Pattern"]:
+    """Returns the precompiled progress pattern for a tool, picked by its executable name."""
+    tool = os.path.splitext(os.path.basename(command[0]))[0].lower() if command else ""
+    if tool in ("7z", "7za", "7zr"): return PROGRESS_PATTERNS["7z"]
+    return PROGRESS_PATTERNS.get(tool)
+
+class OutputProcessor:
+    """Splits a tool's streamed output into log lines and throttled progress updates, keeping only the tail in memory."""
+
+    def __init__(self, pattern: Optional["re.Pattern"] = None,
+                 progress_callback: Optional[Callable[[float], None]] = None,
+                 lines_callback: Optional[Callable[[str], None]] = None,
+                 tail_lines: int = OUTPUT_TAIL_LINES, min_interval: float = PROGRESS_MIN_INTERVAL, spill: bool = True):
+        self.pattern = pattern
+        self.progress_callback = progress_callback
+        self.lines_callback = lines_callback
+        self.min_interval = min_interval
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.line_count = 0
+        self.progress_updates = 0
+        self._pending = ""
+        self._last_report = 0.0
+        self._unreported: Optional[float] = None
+        self.spill_path: Optional[str] = None
+        self._spill = None
+        self._spill_wanted = spill  # The transcript file is created with the first output, so a run that never starts leaves none
+
+    def feed(self, text: str):
+        if self._spill_wanted and text:
+            self._spill_wanted = False
+            self._spill = tempfile.NamedTemporaryFile('w', encoding='utf-8', prefix='win-togo-output-', suffix='.log', delete=False)
+            self.spill_path = self._spill.name
+        if self._spill: self._spill.write(text)
+        self._process(text)
+
+    def _process(self, text: str):
+        # Chunks are searched with str.find/split; only the lines they end and their latest progress value are looked at.
+        text = self._pending + text
+        end = max(text.rfind("\n"), text.rfind("\r"), text.rfind("\b")) + 1
+        text, self._pending = text[:end].replace("\r\n", "\n"), text[end:]
+        if not text: return
+        pieces = text.split("\n")  # The last piece holds only redraws of a line still being written
+        if self.pattern is not None and "%" in text:
+            for piece in reversed(pieces):
+                value = self._latest_progress(piece) if "%" in piece else None
+                if value is not None:
+                    self._progress(value)
+                    break
+        lines = []
+        for line in pieces[:-1]:
+            if "\r" in line or "\b" in line:  # Keep what the line ended up showing
+                line = line.rstrip("\r\b")
+                line = line[max(line.rfind("\r"), line.rfind("\b")) + 1:]
+            if not line or line.isspace() or ("%" in line and self.pattern is not None and self.pattern.search(line)): continue
+            lines.append(line + "\n")
+        if lines:
+            self.line_count += len(lines)
+            self.tail.extend(lines)
+            if self.lines_callback: self.lines_callback("".join(lines))
+
+    def _latest_progress(self, line: str) -> Optional[float]:
+        """The progress value of the last redraw of a line that shows one, or None."""
+        redraws = [c for c in "\r\b" if c in line]
+        percent = line.rfind("%")
+        while percent >= 0:
+            start = max([line.rfind(c, 0, percent) for c in redraws], default=-1) + 1
+            stop = min([i for i in (line.find(c, percent) for c in redraws) if i >= 0], default=len(line))
+            match = self.pattern.search(line[start:stop])
+            if match: return float(match.group(1))
+            percent = line.rfind("%", 0, start)
+        return None
+
+    def _progress(self, value: float):
+        now = time.monotonic()
+        if now - self._last_report >= self.min_interval or value >= 100:
+            self._report(value); self._last_report = now
+        else:
+            self._unreported = value
+
+    def _report(self, value: float):
+        self._unreported = None
+        self.progress_updates += 1
+        if self.progress_callback: self.progress_callback(int(value) if value.is_integer() else value)
+
+    def finish(self):
+        """Processes any unterminated output and reports the last progress value that was held back."""
+        if self._pending: self._process("\n")
+        if self._unreported is not None: self._report(self._unreported)
+        if self._spill: self._spill.close()
+
+    def summary(self) -> str:
+        """The tail of the output, with a pointer to the full transcript if lines were dropped."""
+        text = "".join(self.tail)
+        if self.line_count > len(self.tail) and self.spill_path:
+            text = f"(Last {len(self.tail)} of {self.line_count} lines; full output in {self.spill_path})\n" + text
+        return text
+
+    def discard_spill(self):
+        if self.spill_path and os.path.exists(self.spill_path):
+            try: os.remove(self.spill_path)
+            except OSError: pass
+
+# --- Performance Tracing ---
+def _disk_io() -> Optional[Tuple[int, int]]:
+    try:
+        import psutil
+        counters = psutil.disk_io_counters()
+        return (counters.read_bytes, counters.write_bytes) if counters else None
+    except Exception:
+        return None
+
+class Span:
+    """One timed operation (a phase or a tool run) with its disk I/O; attributes describing it go in `args`."""
+
+    def __init__(self, name: str, category: str, args: Dict):
+        self.name, self.category, self.args = name, category, dict(args)
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+        self._io_start = _disk_io()
+        self._last_sample = 0.0
+
+    def mark(self, key: str):
+        """Records the milliseconds elapsed since the span started under `key` (only the first time)."""
+        self.args.setdefault(key, round((time.perf_counter() - self.start) * 1000, 1))
+
+    def sample_process(self, process: subprocess.Popen, force: bool = False):
+        """Reads a running tool's own I/O counters, at most every TRACE_IO_SAMPLE_INTERVAL seconds."""
+        now = time.perf_counter()
+        if not force and now - self._last_sample < TRACE_IO_SAMPLE_INTERVAL: return
+        self._last_sample = now
+        try:
+            import psutil
+            counters = psutil.Process(process.pid).io_counters()
+        except Exception: return
+        self.args["process_read_bytes"], self.args["process_write_bytes"] = counters.read_bytes, counters.write_bytes
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.end = time.perf_counter()
+        if error is not None: self.error = f"{type(error).__name__}: {str(error).splitlines()[0] if str(error) else ''}"
+        io_end = _disk_io()
+        if self._io_start and io_end:
+            self.args["read_bytes"] = io_end[0] - self._io_start[0]
+            self.args["write_bytes"] = io_end[1] - self._io_start[1]
+            self.args["mb_per_s"] = round((self.args["read_bytes"] + self.args["write_bytes"]) / (1024 ** 2) / max(self.seconds, 1e-6), 1)
+
+    @property
+    def seconds(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+class Tracer:
+    """Collects spans for one run and exports them as JSON lines and as a Chrome trace (chrome://tracing)."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.spans: List[Span] = []
+        self.origin = time.perf_counter()
+        self.metadata: Dict = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str, **args) -> Iterator[Optional[Span]]:
+        if not self.enabled:
+            yield None
+            return
+        span = Span(name, category, args)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(e)
+            raise
+        else:
+            span.finish()
+        finally:
+            with self._lock: self.spans.append(span)
+
+    def records(self) -> List[Dict]:
+        with self._lock: spans = sorted(self.spans, key=lambda s: s.start)
+        return [{"name": s.name, "category": s.category, "thread": s.thread,
+                 "start_s": round(s.start - self.origin, 4), "seconds": round(s.seconds, 4),
+                 **({"error": s.error} if s.error else {}), **s.args} for s in spans]
+
+    def chrome_trace(self) -> Dict:
+        threads: Dict[str, int] = {}
+        events = []
+        for record in self.records():
+            tid = threads.setdefault(record["thread"], len(threads) + 1)
+            args = {k: v for k, v in record.items() if k not in ("name", "category", "thread", "start_s", "seconds")}
+            events.append({"name": record["name"], "cat": record["category"], "ph": "X", "pid": 1, "tid": tid,
+                           "ts": int(record["start_s"] * 1e6), "dur": int(record["seconds"] * 1e6), "args": args})
+        events += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}} for name, tid in threads.items()]
+        return {"traceEvents": events, "otherData": self.metadata}
+
+    def export(self, directory: str = TRACE_DIR) -> Optional[str]:
+        """Writes <run>.jsonl and <run>.trace.json to directory and prunes old runs. Returns the .jsonl path."""
+        if not self.enabled or not self.spans: return None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            old = sorted(f for f in os.listdir(directory) if f.startswith("run-") and f.endswith(".jsonl"))
+            for name in old[:max(0, len(old) - TRACE_FILES_KEPT + 1)]:
+                for path in (name, name[:-len(".jsonl")] + ".trace.json"):
+                    try: os.remove(os.path.join(directory, path))
+                    except OSError: pass
+            base = os.path.join(directory, time.strftime("run-%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+            with open(base + ".jsonl", 'w', encoding='utf-8') as f:
+                if self.metadata: f.write(json.dumps({"name": "run", "category": "metadata", **self.metadata}) + "\n")
+                for record in self.records(): f.write(json.dumps(record) + "\n")
+            with open(base + ".trace.json", 'w', encoding='utf-8') as f: json.dump(self.chrome_trace(), f)
+            return base + ".jsonl"
+        except OSError as e:
+            print(f"Failed to write trace: {e}")
+            return None
+
+    def summary(self, category: str = "phase") -> str:
+        parts = []
+        for r in self.records():
+            if r["category"] != category: continue
+            rate = f" ({r['mb_per_s']} MB/s)" if "mb_per_s" in r else ""
+            parts.append(f"{r['name']} {r['seconds']:.1f}s{rate}")
+        return ", ".join(parts)
+
+# --- Drive Benchmark ---
+def _open_unbuffered(path: str, write: bool = True) -> Tuple[object, bool]:
+    """Opens path for unbuffered I/O (read/write, or read-only for an existing file). Returns (raw file, True if the OS cache is bypassed)."""
+    mode = 'r+b' if write else 'rb'
+    if os.name == "nt":
+        try:
+            import ctypes, msvcrt
+            GENERIC_READ, GENERIC_WRITE, FILE_SHARE_READ, OPEN_EXISTING, OPEN_ALWAYS = 0x80000000, 0x40000000, 1, 3, 4
+            FILE_FLAG_NO_BUFFERING, FILE_FLAG_WRITE_THROUGH, FILE_FLAG_SEQUENTIAL_SCAN = 0x20000000, 0x80000000, 0x08000000
+            create_file = ctypes.windll.kernel32.CreateFileW
+            create_file.restype = ctypes.c_void_p
+            if write: handle = create_file(path, GENERIC_READ | GENERIC_WRITE, 0, None, OPEN_ALWAYS, FILE_FLAG_NO_BUFFERING | FILE_FLAG_WRITE_THROUGH, None)
+            else: handle = create_file(path, GENERIC_READ, FILE_SHARE_READ, None, OPEN_EXISTING, FILE_FLAG_NO_BUFFERING | FILE_FLAG_SEQUENTIAL_SCAN, None)
+            if handle not in (None, ctypes.c_void_p(-1).value):
+                return open(msvcrt.open_osfhandle(handle, (os.O_RDWR if write else os.O_RDONLY) | os.O_BINARY), mode, buffering=0), True
+        except (AttributeError, OSError, ImportError):
+            pass
+    flags = os.O_RDWR | os.O_CREAT if write else os.O_RDONLY
+    if hasattr(os, "O_DIRECT"):
+        try: return open(os.open(path, flags | os.O_DIRECT), mode, buffering=0), True
+        except OSError: pass  # e.g. tmpfs, which has no direct I/O
+    return open(os.open(path, flags | getattr(os, "O_BINARY", 0)), mode, buffering=0), False
+
+def benchmark_path(directory: str, seconds: float = BENCHMARK_SECONDS, max_bytes: int = BENCHMARK_MAX_FILE_BYTES,
+                   cancel_event: Optional[threading.Event] = None) -> Dict:
+    """Measures sequential and 4K random read/write speed of the volume holding directory with a temporary test file."""
+    import random
+    path = os.path.join(directory, BENCHMARK_FILE)
+    max_bytes = min(max_bytes, max(BENCHMARK_BLOCK, shutil.disk_usage(directory).free // 4))
+    buffer = mmap.mmap(-1, BENCHMARK_BLOCK)  # Page-aligned, as unbuffered I/O requires
+    buffer.write(os.urandom(BENCHMARK_BLOCK))
+    small = memoryview(buffer)[:BENCHMARK_RANDOM_BLOCK]
+    def timed(step: Callable[[], int]) -> Tuple[int, float]:
+        count, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            if cancel_event and cancel_event.is_set(): raise InstallationCancelled("Drive benchmark stopped.")
+            if not step(): break
+            count += 1
+        return count, max(time.perf_counter() - start, 1e-6)
+    f, direct = _open_unbuffered(path)
+    try:
+        sync = (lambda: None) if direct else (lambda: os.fsync(f.fileno()))
+        def seq_write() -> int:
+            if f.tell() + BENCHMARK_BLOCK > max_bytes: return 0
+            written = f.write(buffer); sync(); return written
+        writes, write_time = timed(seq_write)
+        size = writes * BENCHMARK_BLOCK
+        if size < BENCHMARK_BLOCK: raise OSError("The drive is too slow to complete a single write.")
+        f.seek(0)
+        reads, read_time = timed(lambda: f.tell() + BENCHMARK_BLOCK <= size and f.readinto(buffer))
+        blocks = size // BENCHMARK_RANDOM_BLOCK
+        def random_io(write: bool) -> int:
+            f.seek(random.randrange(blocks) * BENCHMARK_RANDOM_BLOCK)
+            if write:
+                done = f.write(small); sync(); return done
+            return f.readinto(small)
+        random_writes, random_write_time = timed(lambda: random_io(True))
+        random_reads, random_read_time = timed(lambda: random_io(False))
+    finally:
+        f.close()
+        small.release(); buffer.close()
+        try: os.remove(path)
+        except OSError: pass
+    mb = BENCHMARK_BLOCK / (1024 ** 2)
+    return {"seq_write_mbps": round(writes * mb / write_time, 1), "seq_read_mbps": round(reads * mb / read_time, 1),
+            "rand_write_iops": round(random_writes / random_write_time), "rand_read_iops": round(random_reads / random_read_time),
+            "direct": direct, "test_bytes": size, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def classify_drive(result: Dict) -> str:
+    for name, seq_write, rand_write in DRIVE_CLASSES:
+        if result["seq_write_mbps"] >= seq_write and result["rand_write_iops"] >= rand_write: return name
+    return DRIVE_CLASSES[-1][0]
+
+def estimate_apply_seconds(result: Dict, expanded_bytes: int, file_count: int) -> Optional[float]:
+    """Rough DISM apply time on a benchmarked drive: bulk data at sequential speed plus small writes per file."""
+    if not expanded_bytes or result["seq_write_mbps"] <= 0: return None
+    seconds = expanded_bytes / (result["seq_write_mbps"] * 1024 ** 2)
+    if file_count and result["rand_write_iops"] > 0: seconds += file_count * APPLY_WRITES_PER_FILE / result["rand_write_iops"]
+    return seconds
+
+def benchmark_verdict(result: Dict, config: Dict) -> Tuple[str, str]:
+    """Compares a result with the configured thresholds. Returns (level, message) with level 'ok', 'warn' or 'block'."""
+    summary = (f"{classify_drive(result)}: sequential {result['seq_write_mbps']:.0f}/{result['seq_read_mbps']:.0f} MB/s write/read, "
+               f"4K random {result['rand_write_iops']}/{result['rand_read_iops']} IOPS write/read")
+    for level in ("block", "warn"):
+        limits = config.get(f"benchmark_{level}", {})
+        if result["seq_write_mbps"] < limits.get("seq_write_mbps", 0) or result["rand_write_iops"] < limits.get("rand_write_iops", 0):
+            return level, summary
+    return "ok", summary
+
+def drive_benchmark_key(drive: Dict) -> str:
+    return f"{drive.get('model', '')}|{drive.get('serial', '')}|{round(drive.get('total_gb', 0))}"
+
+def load_benchmark_results() -> Dict[str, Dict]:
+    try:
+        with open(BENCHMARK_RESULTS_FILE, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_benchmark_result(key: str, result: Dict):
+    results = load_benchmark_results()
+    results[key] = result
+    try:
+        os.makedirs(os.path.dirname(BENCHMARK_RESULTS_FILE), exist_ok=True)
+        with open(BENCHMARK_RESULTS_FILE + ".tmp", 'w', encoding='utf-8') as f: json.dump(results, f, indent=4)
+        os.replace(BENCHMARK_RESULTS_FILE + ".tmp", BENCHMARK_RESULTS_FILE)
+    except OSError as e:
+        print(f"Failed to save drive benchmark: {e}")
+
+# --- Scratch Space Placement ---
+def volume_root(path: str) -> str:
+    """The root of the volume holding path ('C:\\' on Windows, the mount point elsewhere)."""
+    path = os.path.abspath(path)
+    drive = os.path.splitdrive(path)[0]
+    if drive: return drive.upper() + os.sep
+    while not os.path.ismount(path) and os.path.dirname(path) != path: path = os.path.dirname(path)
+    return path
+
+def target_volume_roots(drive: Dict, tools: Optional[Dict[str, str]] = None, broker: Optional["ToolBroker"] = None) -> List[str]:
+    """Volume roots currently on a target disk, which must never hold scratch data."""
+    roots = []
+    if re.match(r'^[A-Za-z]:', drive.get('device', "")): roots.append(volume_root(drive['device']))
+    tools = tools or DEFAULT_TOOLS
+    ps_script = f"Get-Partition -DiskNumber {int(drive['index'])} | Where-Object {{ $_.DriveLetter }} | ForEach-Object {{ $_.DriveLetter }}"
+    try:
+        if broker:
+            output = broker.powershell(ps_script, timeout=30)
+        else:
+            output = subprocess.run([tools["powershell"], '-NoProfile', '-NonInteractive', '-Command', ps_script],
+                                    capture_output=True, text=True, creationflags=CREATE_NO_WINDOW, timeout=30).stdout
+        roots += [f"{letter.strip().upper()}:\\" for letter in output.split() if re.match(r'^[A-Za-z]$', letter.strip())]
+    except (OSError, subprocess.SubprocessError, SubprocessError):
+        pass
+    return roots
+
+def scratch_candidates(preferred: Optional[str] = None) -> List[str]:
+    """Directories extraction could use: the preferred one (e.g. a RAM disk), the temp directory, then every fixed volume."""
+    candidates = [preferred] if preferred else []
+    candidates.append(tempfile.gettempdir())
+    try:
+        import psutil
+        for part in psutil.disk_partitions(all=False):
+            if {"removable", "cdrom", "ro"} & set(part.opts.split(",")): continue
+            candidates.append(os.path.join(part.mountpoint, SCRATCH_DIR_NAME))
+    except Exception:
+        pass
+    return candidates
+
+def choose_scratch_dir(required_bytes: int, exclude_roots: List[str], preferred: Optional[str] = None,
+                       log: Callable[..., None] = lambda message, level="info": None) -> Tuple[str, Dict]:
+    """Picks the fastest volume (or the preferred one) with room for required_bytes that is not a target. Returns (directory, placement info)."""
+    excluded = {root.upper() for root in exclude_roots}
+    measured = load_benchmark_results()
+    qualifying, seen, rejected = [], set(), []
+    for candidate in scratch_candidates(preferred):
+        root = volume_root(candidate)
+        if root.upper() in excluded or root in seen: continue
+        seen.add(root)
+        try:
+            existing = candidate if os.path.isdir(candidate) else os.path.dirname(candidate)
+            free = shutil.disk_usage(existing).free
+            if not os.access(existing, os.W_OK): continue
+        except OSError:
+            continue
+        if free < required_bytes + SCRATCH_MARGIN_BYTES:
+            rejected.append(f"{root} ({free / (1024 ** 3):.1f} GB free)"); continue
+        qualifying.append({"path": candidate, "probe_dir": existing, "root": root, "free_bytes": free, "preferred": candidate == preferred})
+    if not qualifying:
+        raise RuntimeError(f"No volume has room for the {required_bytes / (1024 ** 3):.1f} GB extraction"
+                           + (f" (checked {', '.join(rejected)})" if rejected else "") + ". Free up space or set scratch_dir in the config file.")
+    if not qualifying[0]["preferred"] and len(qualifying) > 1:
+        for candidate in qualifying:
+            key = f"scratch|{candidate['root']}"
+            if key not in measured:
+                try:
+                    measured[key] = benchmark_path(candidate.pop("probe_dir"), SCRATCH_PROBE_SECONDS, SCRATCH_PROBE_BYTES)
+                    save_benchmark_result(key, measured[key])
+                except OSError as e:
+                    log(f"Could not measure {candidate['root']}: {e}", "warning")
+                    measured[key] = {"seq_write_mbps": 0}
+            candidate["seq_write_mbps"] = measured[key].get("seq_write_mbps", 0)
+        qualifying.sort(key=lambda c: -c["seq_write_mbps"])
+    if preferred and not qualifying[0]["preferred"]: log(f"The scratch directory {preferred} is not usable or too small.", "warning")
+    chosen = qualifying[0]
+    chosen.pop("probe_dir", None)
+    os.makedirs(chosen["path"], exist_ok=True)
+    chosen["required_bytes"] = required_bytes
+    return chosen["path"], chosen
+
+# --- Differential Refresh ---
+def hash_file(path: str) -> str:
+    """The SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""): digest.update(block)
+    return digest.hexdigest()
+
+def _is_link(entry: "os.DirEntry") -> bool:
+    """True for symlinks and junctions, which manifests record as links instead of following."""
+    if entry.is_symlink(): return True
+    try: return getattr(entry.stat(follow_symlinks=False), "st_reparse_tag", 0) in LINK_REPARSE_TAGS
+    except OSError: return False
+
+def read_link(root: str, entry: "os.DirEntry") -> List:
+    """[target, target is relative to root, reparse tag, is a directory] of a link below root."""
+    target = os.readlink(entry.path)
+    plain, base = target[4:] if target.startswith("\\\\?\\") else target, os.path.join(os.path.abspath(root), "")
+    inside = os.path.isabs(plain) and os.path.normcase(plain).startswith(os.path.normcase(base))
+    info = entry.stat(follow_symlinks=False)
+    attributes = getattr(info, "st_file_attributes", None)
+    is_dir = bool(attributes & stat.FILE_ATTRIBUTE_DIRECTORY) if attributes is not None else entry.is_dir()
+    return [plain[len(base):] if inside else target, inside, getattr(info, "st_reparse_tag", 0), is_dir]
+
+def create_link(root: str, entry: List):
+    """Recreates a link recorded by FileManifest.scan below root, pointing into root if the original pointed into its own."""
+    path = os.path.join(root, entry[0])
+    target = os.path.join(root, entry[1]) if entry[2] else entry[1]
+    if entry[3] == LINK_REPARSE_TAGS[0]:
+        import _winapi
+        _winapi.CreateJunction(target[4:] if target.startswith("\\\\?\\") else target, path)
+    else:
+        os.symlink(target, path, target_is_directory=entry[4])
+
+def read_compact_exclusions(image_root: str) -> List[str]:
+    """The [CompressionExclusionList] patterns of the image's WimBootCompress.ini, lower-case."""
+    try:
+        with open(os.path.join(image_root, COMPACT_EXCLUSIONS_FILE), 'rb') as f: data = f.read()
+    except OSError:
+        return []
+    text = data.decode('utf-16') if data[:2] in (b'\xff\xfe', b'\xfe\xff') else data.decode('utf-8-sig', errors='replace')
+    patterns, section = [], None
+    for line in text.splitlines():
+        line = line.split(';')[0].strip().lower()
+        if line.startswith('['): section = line
+        elif line and section == '[compressionexclusionlist]': patterns.append(line)
+    return patterns
+
+def compact_excluded(rel: str, patterns: List[str]) -> bool:
+    """True if a pattern from read_compact_exclusions matches the file at rel: by path if it starts with a backslash, else by name."""
+    path = "\\" + rel.replace("/", "\\").lower()
+    return any(fnmatch.fnmatchcase(path if pattern.startswith("\\") else path.rsplit("\\", 1)[-1], pattern) for pattern in patterns)
+
+def _remove_link(path: str, is_dir: bool):
+    if is_dir and os.name == "nt": os.rmdir(path)  # Removes a junction or directory symlink, not what it points to
+    else: os.remove(path)
+
+class FileManifest:
+    """Size, modification time and (on request) SHA-256 of every file below a directory, cached in a JSON file."""
+
+    def __init__(self, cache_path: Optional[str] = None):
+        self.cache_path = cache_path
+        self.files: Dict[str, List] = {}  # lower-case relative path -> [relative path, size, mtime in ns, SHA-256 or None]
+        self.dirs: Dict[str, str] = {}  # lower-case relative path -> relative path
+        self.links: Dict[str, List] = {}  # lower-case relative path -> [relative path] + read_link()
+        self.compressed: set = set()  # lower-case relative paths of files stored compressed by compact mode
+        self._lock = threading.Lock()
+        self._hash_lock = threading.Lock()
+
+    def scan(self, root: str, skip_top: Tuple[str, ...] = ()) -> "FileManifest":
+        """Walks root (leaving out top-level entries named in skip_top) and keeps cached hashes that still apply."""
+        previous: Dict[str, List] = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r', encoding='utf-8') as f: data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION: previous = data.get("files", {})
+            except (OSError, ValueError): pass
+        files, dirs, links, compressed, pending = {}, {}, {}, set(), [""]
+        while pending:
+            rel_dir = pending.pop()
+            try: entries = list(os.scandir(os.path.join(root, rel_dir)))
+            except OSError: continue
+            for entry in entries:
+                if not rel_dir and entry.name.lower() in skip_top: continue
+                rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                try:
+                    if _is_link(entry):
+                        links[rel.lower()] = [rel] + read_link(root, entry); continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs[rel.lower()] = rel; pending.append(rel); continue
+                    info = entry.stat(follow_symlinks=False)
+                except OSError: continue
+                if getattr(info, "st_reparse_tag", 0) == WOF_REPARSE_TAG: compressed.add(rel.lower())
+                old = previous.get(rel.lower())
+                digest = old[3] if old and old[1] == info.st_size and old[2] == info.st_mtime_ns else None
+                files[rel.lower()] = [rel, info.st_size, info.st_mtime_ns, digest]
+        self.files, self.dirs, self.links, self.compressed = files, dirs, links, compressed
+        return self
+
+    def hash_files(self, root: str, keys: List[str], cancel_event: Optional[threading.Event] = None,
+                   progress: Callable[[int, int], None] = lambda done, total: None, workers: int = HASH_WORKERS) -> int:
+        """Hashes the listed files that have no hash yet, several at a time. Returns the bytes hashed."""
+        with self._hash_lock:  # Drives refreshed together share the image manifest; hash each file once
+            todo = [key for key in keys if self.files[key][3] is None]
+            total, done = sum(self.files[key][1] for key in todo), [0]
+            def work(key: str):
+                if cancel_event is not None and cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+                entry = self.files[key]
+                digest = hash_file(os.path.join(root, entry[0]))
+                with self._lock:
+                    entry[3] = digest
+                    done[0] += entry[1]
+                    progress(done[0], total)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash") as pool:
+                for future in [pool.submit(work, key) for key in todo]: future.result()
+            return total
+
+    def save(self):
+        if not self.cache_path: return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with self._lock:
+                with open(self.cache_path + ".tmp", 'w', encoding='utf-8') as f:
+                    json.dump({"version": MANIFEST_VERSION, "files": self.files}, f)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError as e:
+            print(f"Failed to save file manifest: {e}")
+
+def plan_refresh(image: FileManifest, volume: FileManifest) -> Dict:
+    """Lists what to copy, retime, delete and create to turn a volume into an image, from their manifests."""
+    copy, touch = [], []
+    for key, entry in image.files.items():
+        current = volume.files.get(key)
+        if current is None or current[1] != entry[1]: copy.append(key)
+        elif current[2] != entry[2]:
+            if current[3] is None or entry[3] is None or current[3] != entry[3]: copy.append(key)
+            else: touch.append(key)
+    return {"copy": copy, "touch": touch,
+            "delete": [key for key in volume.files if key not in image.files],
+            "delete_dirs": sorted((key for key in volume.dirs if key not in image.dirs), key=len, reverse=True),
+            "create_dirs": sorted((key for key in image.dirs if key not in volume.dirs), key=len),
+            "delete_links": [key for key, entry in volume.links.items() if image.links.get(key, [None])[1:] != entry[1:]],
+            "create_links": [key for key, entry in image.links.items() if volume.links.get(key, [None])[1:] != entry[1:]]}
+
+def _command_batches(items: List, length: Callable[..., int], budget: int = COMMAND_LINE_BUDGET):
+    """Splits items into lists whose command-line length stays within budget."""
+    batch, size = [], 0
+    for item in items:
+        if batch and size + length(item) > budget:
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += length(item) + 3  # Separator and quotes
+    if batch: yield batch
+
+def _replace_files(source_root: str, target_root: str, entries: List[List], on_file: Callable[[int], None],
+                   progress: Callable[[int, int], None], cancel_event: threading.Event) -> Dict:
+    """Copies manifest entries with shutil.copy2, where there are no security descriptors to keep (e.g. stub runs)."""
+    total, done, start = sum(entry[1] for entry in entries), 0, time.perf_counter()
+    for index, entry in enumerate(entries):
+        if cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+        source, target = os.path.join(source_root, entry[0]), os.path.join(target_root, entry[0])
+        try: shutil.copy2(source, target)
+        except PermissionError:
+            os.chmod(target, stat.S_IWRITE)  # Read-only files in the old installation
+            shutil.copy2(source, target)
+        done += entry[1]
+        on_file(index)
+        progress(done, total)
+    return {"bytes_copied": done, "mbps": round(done / (1024 ** 2) / max(time.perf_counter() - start, 1e-6), 1)}
+
+def _remove_file(path: str):
+    try: os.remove(path)
+    except PermissionError:
+        os.chmod(path, stat.S_IWRITE)
+        os.remove(path)
+
+# --- Install Phase Scheduling ---
+def _no_progress(fraction: float, detail: Optional[str] = None):
+    pass
+
+class Phase:
+    """A node in the install graph. `run(report)` does the work and calls report(fraction, detail)."""
+
+    def __init__(self, name: str, label: str, run: Callable[[Callable[..., None]], None],
+                 depends_on: Tuple[str, ...] = (), weight: float = 1.0,
+                 resource: Optional[str] = None, cancel_on_failure: bool = True):
+        self.name, self.label, self.run = name, label, run
+        self.depends_on = tuple(depends_on)
+        self.weight = max(weight, 0.001)
+        self.resource = resource  # Counted against the PhaseScheduler limits
+        self.cancel_on_failure = cancel_on_failure  # False: a failure only takes this phase's dependents down
+        self.status = "pending"  # pending -> running -> done | failed, or cancelled if never started
+        self.fraction = 0.0
+        self.detail: Optional[str] = None
+        self.duration: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+class PhaseScheduler:
+    """Runs phases as a dependency graph in parallel, within per-resource limits, and stops them all on a failure."""
+
+    def __init__(self, phases: List[Phase], on_progress: Callable[[float, str], None] = lambda f, l: None,
+                 cancel_event: Optional[threading.Event] = None, on_cancel: Optional[Callable[[], None]] = None,
+                 max_workers: int = 4, limits: Optional[Dict[str, int]] = None, tracer: Optional[Tracer] = None):
+        self.phases = {phase.name: phase for phase in phases}
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event or threading.Event()
+        self.on_cancel = on_cancel
+        self.max_workers = max_workers
+        self.limits = limits or {}
+        self.tracer = tracer or Tracer(enabled=False)
+        self._lock = threading.Lock()
+        self._check_graph()
+
+    def _check_graph(self):
+        for phase in self.phases.values():
+            for dependency in phase.depends_on:
+                if dependency not in self.phases: raise ValueError(f"Phase '{phase.name}' depends on unknown phase '{dependency}'.")
+        remaining = dict(self.phases)
+        while remaining:
+            ready = [n for n, p in remaining.items() if not any(d in remaining for d in p.depends_on)]
+            if not ready: raise ValueError(f"Install phases have a dependency cycle: {', '.join(remaining)}.")
+            for name in ready: del remaining[name]
+
+    def _ready(self) -> List[Phase]:
+        in_use = collections.Counter(p.resource for p in self.phases.values() if p.status == "running")
+        ready = []
+        for phase in self.phases.values():
+            if phase.status != "pending" or not all(self.phases[d].status == "done" for d in phase.depends_on): continue
+            if phase.resource in self.limits and in_use[phase.resource] >= self.limits[phase.resource]: continue
+            in_use[phase.resource] += 1
+            ready.append(phase)
+        return ready
+
+    def report(self, phase: Phase, fraction: float, detail: Optional[str] = None):
+        with self._lock:
+            phase.fraction = min(max(fraction, 0.0), 1.0)
+            if detail is not None: phase.detail = detail
+            total = sum(p.weight for p in self.phases.values())
+            overall = sum(p.weight * (1.0 if p.status == "done" else p.fraction) for p in self.phases.values()) / total
+            label = " | ".join(f"{p.label}... ({p.detail})" if p.detail else f"{p.label}..."
+                               for p in self.phases.values() if p.status == "running")
+        self.on_progress(overall, label)
+
+    def _run_phase(self, phase: Phase):
+        start = time.monotonic()
+        try:
+            with self.tracer.span(phase.name, "phase", label=phase.label):
+                phase.run(lambda fraction, detail=None: self.report(phase, fraction, detail))
+        finally:
+            phase.duration = time.monotonic() - start
+
+    def cancel(self):
+        if not self.cancel_event.is_set():
+            self.cancel_event.set()
+            if self.on_cancel: self.on_cancel()
+
+    def run(self) -> Dict[str, float]:
+        """Runs the graph to completion. Returns {phase name: seconds} for every phase that ran."""
+        first_error: Optional[BaseException] = None
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="phase") as pool:
+            running = {}
+            while True:
+                if not self.cancel_event.is_set():
+                    for phase in self._ready():
+                        phase.status = "running"
+                        running[pool.submit(self._run_phase, phase)] = phase
+                        self.report(phase, 0.0)
+                if not running: break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    phase = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        phase.status = "done"
+                        self.report(phase, 1.0)
+                        continue
+                    phase.status, phase.error = "failed", error
+                    if not phase.cancel_on_failure and not isinstance(error, InstallationCancelled): continue
+                    # A phase stopped by cancellation is a consequence, not the cause.
+                    if first_error is None or (isinstance(first_error, InstallationCancelled) and not isinstance(error, InstallationCancelled)):
+                        first_error = error
+                    self.cancel()
+        for phase in self.phases.values():
+            if phase.status == "pending": phase.status = "cancelled"
+        if first_error is not None: raise first_error
+        if self.cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+        return {name: phase.duration for name, phase in self.phases.items() if phase.duration is not None}
+
+# --- Post-install Verification ---
+_read_buffers = threading.local()
+
+def stream_hash(path: str, on_chunk: Callable[[int], None] = lambda size: None) -> Tuple[str, bool]:
+    """Hashes a file as the drive returns it, bypassing the OS cache where possible. Returns (SHA-256, cache bypassed)."""
+    if not hasattr(_read_buffers, "buffer"): _read_buffers.buffer = mmap.mmap(-1, HASH_BLOCK_SIZE)
+    buffer, done = _read_buffers.buffer, [0]
+    def read_all(f) -> str:
+        digest = hashlib.sha256()
+        with f:
+            for size in iter(lambda: f.readinto(buffer), 0):
+                digest.update(memoryview(buffer)[:size])
+                done[0] += size; on_chunk(size)
+        return digest.hexdigest()
+    f, bypassed = _open_unbuffered(path, write=False)
+    try:
+        return read_all(f), bypassed
+    except OSError:
+        if not bypassed: raise
+    on_chunk(-done[0])  # Some file systems refuse direct reads only when reading; start over buffered
+    done[0] = 0
+    return read_all(open(path, 'rb', buffering=0)), False
+
+def select_verify_sample(keys: List[str], files: Dict[str, List], percent: float) -> List[str]:
+    """A random set of keys holding at least `percent` of the files and of their bytes, plus VERIFY_ALWAYS."""
+    import random
+    always = {os.path.join(*path.split("\\")).lower() for path in VERIFY_ALWAYS}
+    chosen = [key for key in keys if key in always]
+    rest = [key for key in keys if key not in always]
+    random.shuffle(rest)
+    total_bytes = sum(files[key][1] for key in keys)
+    count, size = len(chosen), sum(files[key][1] for key in chosen)
+    for key in rest:
+        if count >= len(keys) * percent / 100 and size >= total_bytes * percent / 100: break
+        chosen.append(key); count += 1; size += files[key][1]
+    return chosen
+
+def verify_tree(image: FileManifest, image_root: str, root: str, mode: str = "sampled", percent: float = VERIFY_SAMPLE_PERCENT,
+                cancel_event: Optional[threading.Event] = None, report: Callable[..., None] = _no_progress,
+                workers: int = VERIFY_DEFAULT_WORKERS) -> Dict:
+    """Reads the image's files back from root and compares them with the image. Returns counts, throughput and mismatches."""
+    volume = FileManifest().scan(root, REFRESH_KEEP)
+    mismatches, missing, modified, candidates = [], [], 0, []
+    for key, entry in image.files.items():
+        current = volume.files.get(key)
+        if current is None: missing.append(entry[0])
+        elif current[2] != entry[2]: modified += 1
+        elif current[1] != entry[1]: mismatches.append((entry[0], f"size {current[1]:,} bytes, expected {entry[1]:,}"))
+        else: candidates.append(key)
+    keys = candidates if mode == "full" else select_verify_sample(candidates, image.files, percent)
+    total = sum(image.files[key][1] for key in keys)
+    report(0.0, "hashing the image")
+    image.hash_files(image_root, keys, cancel_event, lambda done, todo: report(0.2 * done / max(todo, 1), "hashing the image"))
+
+    lock, read, direct, start = threading.Lock(), [0], [True], time.perf_counter()
+    def on_chunk(size: int):
+        with lock:
+            read[0] += size
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            report(0.2 + 0.8 * read[0] / max(total, 1), f"{read[0] / (1024 ** 2) / elapsed:.0f} MB/s")
+    def check(key: str):
+        if cancel_event is not None and cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+        rel = image.files[key][0]
+        try:
+            digest, bypassed = stream_hash(os.path.join(root, volume.files[key][0]), on_chunk)
+        except OSError as e:
+            with lock: mismatches.append((rel, f"read error: {e.strerror or e}"))
+            return
+        with lock:
+            direct[0] = direct[0] and bypassed
+            if digest != image.files[key][3]: mismatches.append((rel, "content differs"))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") as pool:
+        for future in [pool.submit(check, key) for key in keys]: future.result()
+    seconds = time.perf_counter() - start
+    return {"mode": mode, "files": len(image.files), "files_checked": len(keys), "bytes_checked": total,
+            "seconds": round(seconds, 2), "mbps": round(total / (1024 ** 2) / max(seconds, 1e-6), 1), "workers": workers,
+            "direct": direct[0], "modified": modified, "missing": missing, "mismatches": mismatches}
+
+# --- Tool Supervision ---
+def _format_seconds(seconds: float) -> str:
+    return f"{seconds / 3600:.1f} hours" if seconds >= 7200 else f"{seconds / 60:.0f} minutes" if seconds >= 120 else f"{seconds:g} s"
+
+def _wait_stopped(members: List, timeout: float) -> List:
+    """Waits until every psutil process in members has exited (a zombie counts). Returns those still running."""
+    import psutil
+    deadline = time.monotonic() + timeout
+    while True:
+        alive = []
+        for member in members:
+            try:
+                if member.status() != psutil.STATUS_ZOMBIE: alive.append(member)
+            except psutil.Error: pass
+        if not alive or time.monotonic() >= deadline: return alive
+        time.sleep(0.02)
+
+def kill_process_tree(process: subprocess.Popen, grace: float = KILL_GRACE_SECONDS) -> int:
+    """Stops a process and every process it started. Returns the number of child processes stopped."""
+    try:
+        import psutil
+        parent = psutil.Process(process.pid)
+        tree = parent.children(recursive=True) + [parent]  # Listed before anything dies and gets reparented
+    except Exception:
+        try: process.kill()
+        except OSError: pass
+        return 0
+    for member in tree:
+        try: member.terminate()
+        except psutil.Error: pass
+    for member in _wait_stopped(tree, grace):
+        try: member.kill()
+        except psutil.Error: pass
+    _wait_stopped(tree, grace)
+    return len(tree) - 1
+
+class ProcessSupervisor:
+    """Stops a running tool's process tree on cancellation, timeout or stall; `cause` says which."""
+
+    def __init__(self, process: subprocess.Popen, name: str, cancel_event: threading.Event,
+                 timeout: Optional[float] = None, stall: Optional[float] = None, interval: float = SUPERVISOR_INTERVAL):
+        self.process = process
+        self.name = name
+        self.cancel_event = cancel_event
+        self.timeout = timeout
+        self.stall = stall
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.cause: Optional[str] = None
+        self.children_stopped = 0
+        self.stopped_at: Optional[float] = None  # time.monotonic() once the whole tree is gone
+        self._io: Optional[int] = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True, name=f"{name}-supervisor")
+
+    def start(self) -> "ProcessSupervisor":
+        self._thread.start()
+        return self
+
+    def activity(self):
+        """Records that the tool printed something."""
+        self.last_activity = time.monotonic()
+
+    def finish(self):
+        """Called once the tool's output has ended. Waits for a stop in progress to complete."""
+        self._done.set()
+        if self.cause or self.cancel_event.is_set(): self._thread.join()
+
+    def _tree_io(self) -> Optional[int]:
+        try:
+            import psutil
+            parent = psutil.Process(self.process.pid)
+            total = 0
+            for member in [parent] + parent.children(recursive=True):
+                try:
+                    total += sum(member.io_counters()[:4])  # Read/write operation and byte counts
+                except (psutil.Error, AttributeError): pass
+            return total
+        except Exception: return None
+
+    def _watch(self):
+        while True:
+            cancelled = self.cancel_event.wait(self.interval)
+            if self._done.is_set(): return
+            if cancelled: self._stop("cancelled"); return
+            now = time.monotonic()
+            if self.stall:
+                io = self._tree_io()
+                if io is not None and io != self._io: self._io, self.last_activity = io, now
+            if self.timeout and now - self.started > self.timeout: self._stop("timeout"); return
+            if self.stall and now - self.last_activity > self.stall: self._stop("stalled"); return
+
+    def _stop(self, cause: str):
+        self.cause = cause
+        if self.process.poll() is None: self.children_stopped = kill_process_tree(self.process)
+        self.stopped_at = time.monotonic()
+
+    def stopped(self) -> str:
+        """What was stopped, e.g. 'dism and 2 child processes'."""
+        n = self.children_stopped
+        return self.name + (f" and {n} child process{'es' if n != 1 else ''}" if n else "")
+
+    def describe(self) -> str:
+        """Why the tool was stopped, for the error shown to the user."""
+        if self.cause == "timeout":
+            return f"{self.name} did not finish within {_format_seconds(self.timeout)}; stopped {self.stopped()}."
+        if self.cause == "stalled":
+            return f"{self.name} made no progress for {_format_seconds(self.stall)} (no output, no I/O); stopped {self.stopped()}."
+        return f"Stopped {self.stopped()}."
+
+# --- Tool Sessions ---
+class ToolSession:
+    """One long-lived interactive tool process, fed commands over stdin and restarted when it dies."""
+
+    def __init__(self, command: List[str], sentinel: Callable[[str], Tuple[Optional[str], str]],
+                 ready_marker: Optional[str] = None, startup: Optional[List[str]] = None,
+                 lock: Optional[threading.Lock] = None, idle_seconds: float = TOOL_SESSION_IDLE_SECONDS):
+        self.command = command
+        self.sentinel = sentinel
+        self.ready_marker = ready_marker
+        self.startup = startup or []
+        self.lock = lock or threading.Lock()  # Held for a whole batch of commands
+        self.idle_seconds = idle_seconds
+        self.process: Optional[subprocess.Popen] = None
+        self.starts = 0  # Processes started so far
+        self._buffer = ""
+        self._eof = False
+        self._changed = threading.Condition()
+        self._sequence = 0
+        self._idle_timer: Optional[threading.Timer] = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.command[0])
+
+    def execute(self, lines: List[str], timeout: float = TOOL_SESSION_TIMEOUT,
+                check: Optional[Callable[[str, str], None]] = None) -> List[str]:
+        """Sends lines one at a time and returns the reply to each; check(line, reply) may raise to stop the batch."""
+        with self.lock:
+            if self._idle_timer: self._idle_timer.cancel(); self._idle_timer = None
+            try:
+                if self.process is None or self.process.poll() is not None: self._start(timeout)
+                replies = []
+                for line in lines:
+                    try:
+                        reply = self._send(line, timeout)
+                    except ToolSessionLost:
+                        if replies: raise
+                        self._start(timeout)  # Died before the batch; nothing of it has run, so it is safe to send again
+                        reply = self._send(line, timeout)
+                    replies.append(reply)
+                    if check: check(line, reply)
+                return replies
+            except (OSError, SubprocessError):
+                self.close(kill=True)
+                raise
+            finally:
+                if self.idle_seconds and self.process is not None:
+                    self._idle_timer = threading.Timer(self.idle_seconds, self._close_if_idle)
+                    self._idle_timer.daemon = True
+                    self._idle_timer.start()
+
+    def _start(self, timeout: float):
+        self.close(kill=True)
+        try:
+            process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, creationflags=CREATE_NO_WINDOW)
+        except FileNotFoundError:
+            raise SubprocessError(f"Command not found: {self.command[0]}", "Ensure the executable is in the correct directory or system PATH.")
+        except OSError as e:
+            raise SubprocessError(f"Could not start {self.name}: {e}")
+        with self._changed:
+            self.process, self._buffer, self._eof = process, "", False
+        self.starts += 1
+        threading.Thread(target=self._read, args=(process,), daemon=True, name=f"{self.name}-session").start()
+        if self.ready_marker: self._wait_for(self.ready_marker, timeout)
+        for line in self.startup: self._send(line, timeout)
+
+    def _read(self, process: subprocess.Popen):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            try: chunk = process.stdout.read1(OUTPUT_READ_SIZE)
+            except (OSError, ValueError): chunk = b""
+            with self._changed:
+                if process is not self.process: return
+                if chunk: self._buffer += decoder.decode(chunk).replace("\r", "")
+                else: self._eof = True
+                self._changed.notify_all()
+            if not chunk: return
+
+    def _send(self, line: str, timeout: float) -> str:
+        self._sequence += 1
+        extra, marker = self.sentinel(f"__W2G_{os.getpid()}_{self._sequence}__")
+        process = self.process
+        if process is None: raise SubprocessError(f"The {self.name} session was closed.")
+        try:
+            process.stdin.write((line + "\n" + (extra + "\n" if extra else "")).encode('utf-8'))
+            process.stdin.flush()
+        except (OSError, ValueError) as e:  # ValueError: the pipe was closed by close() from another thread
+            if self.process is not process: raise SubprocessError(f"The {self.name} session was closed.")
+            raise ToolSessionLost(f"The {self.name} session is no longer running ({e}).")
+        return self._wait_for(marker, timeout).strip("\n")
+
+    def _wait_for(self, marker: str, timeout: float) -> str:
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                position = self._buffer.find(marker)
+                if position >= 0:
+                    reply, self._buffer = self._buffer[:position], self._buffer[position + len(marker):]
+                    return reply
+                if self._eof:
+                    raise SubprocessError(f"The {self.name} session ended unexpectedly.", self._buffer[-OUTPUT_READ_SIZE:])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ToolTimeoutError(f"The {self.name} session did not answer within {_format_seconds(timeout)}; stopped it.", self._buffer[-OUTPUT_READ_SIZE:])
+                self._changed.wait(min(remaining, 1.0))
+
+    def _close_if_idle(self):
+        if self.lock.acquire(blocking=False):
+            try: self.close()
+            finally: self.lock.release()
+
+    def close(self, kill: bool = False):
+        """Ends the process by closing its input or, with kill, at once. Safe to call from any thread."""
+        with self._changed:
+            process, self.process, self._eof = self.process, None, True
+            self._changed.notify_all()
+        if process is None: return
+        try:
+            if kill: kill_process_tree(process)
+            else: process.stdin.close()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            kill_process_tree(process)
+        finally:
+            for stream in (process.stdin, process.stdout):
+                try: stream.close()
+                except OSError: pass
+
+class ToolBroker:
+    """Shared diskpart and PowerShell sessions for everything that queries or partitions disks."""
+
+    def __init__(self, tools: Optional[Dict[str, str]] = None, idle_seconds: float = TOOL_SESSION_IDLE_SECONDS):
+        self.tools = tools or DEFAULT_TOOLS
+        self.idle_seconds = idle_seconds
+        self._sessions: Dict[str, ToolSession] = {}
+        self._lock = threading.Lock()
+
+    def session(self, tool: str) -> ToolSession:
+        with self._lock:
+            if tool not in self._sessions:
+                if tool == "diskpart":
+                    self._sessions[tool] = ToolSession([self.tools["diskpart"]], lambda token: (None, DISKPART_PROMPT),
+                                                       ready_marker=DISKPART_PROMPT, lock=DISKPART_LOCK, idle_seconds=self.idle_seconds)
+                elif tool == "powershell":
+                    self._sessions[tool] = ToolSession(
+                        [self.tools["powershell"], '-NoLogo', '-NoProfile', '-NonInteractive', '-Command', '-'],
+                        lambda token: (f"Write-Output '{token}'", token + "\n"),
+                        startup=["[Console]::OutputEncoding = [System.Text.Encoding]::UTF8; "
+                                 "$ErrorActionPreference = 'Stop'; $ProgressPreference = 'SilentlyContinue'"],
+                        idle_seconds=self.idle_seconds)
+                else:
+                    raise ValueError(f"No interactive session for '{tool}'.")
+            return self._sessions[tool]
+
+    def diskpart(self, script: str, timeout: float = TOOL_SESSION_TIMEOUT) -> str:
+        """Runs the commands of a diskpart script in the diskpart session. Returns the combined replies."""
+        lines = [line.strip() for line in script.splitlines() if line.strip() and line.strip().lower() != "exit"]
+        def check(line: str, reply: str):
+            if DISKPART_ERROR_PATTERN.search(reply): raise SubprocessError(f"diskpart failed at `{line}`.", reply)
+        return "\n".join(self.session("diskpart").execute(lines, timeout, check))
+
+    def powershell(self, command: str, timeout: float = TOOL_SESSION_TIMEOUT) -> str:
+        """Runs a one-line PowerShell command in the PowerShell session and returns its output."""
+        def check(line: str, reply: str):
+            if POWERSHELL_ERROR_MARKER in reply:
+                raise SubprocessError("PowerShell command failed.", reply.split(POWERSHELL_ERROR_MARKER, 1)[1].strip())
+        wrapped = f"try {{ {command} }} catch {{ Write-Output \"{POWERSHELL_ERROR_MARKER} $_\" }}"
+        return self.session("powershell").execute([wrapped], timeout, check)[0]
+
+    def close(self, tool: Optional[str] = None, kill: bool = False):
+        """Closes one session, or all of them. A later command starts a new one."""
+        with self._lock: sessions = [s for name, s in self._sessions.items() if tool in (None, name)]
+        for session in sessions: session.close(kill)
+
+def parse_diskpart_table(text: str) -> List[Dict[str, str]]:
+    """Parses the first table in diskpart output into one dict per row, keyed by lower-case column name."""
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if i == 0 or not re.match(r'^\s*-+(\s+-+)+\s*$', line): continue
+        starts = [m.start() for m in re.finditer(r'-+', line)]
+        bounds = list(zip(starts, starts[1:] + [None]))
+        names = [lines[i - 1][a:b].replace("###", "").strip().lower() for a, b in bounds]
+        rows = []
+        for row in lines[i + 1:]:
+            if not row.strip(): break
+            rows.append({name: row[a:b].strip() for name, (a, b) in zip(names, bounds)})
+        return rows
+    return []
+
+def diskpart_volumes(text: str) -> List[Dict]:
+    """The volumes in 'list volume' or 'detail disk' output as dicts with 'number', 'letter' (or None), 'label', 'fs' and 'status'."""
+    volumes = []
+    for row in parse_diskpart_table(text):
+        match = re.search(r'(\d+)', row.get("volume", ""))
+        if not match: continue
+        letter = row.get("ltr", "")
+        volumes.append({"number": int(match.group(1)), "letter": letter.upper() if re.match(r'^[A-Za-z]$', letter) else None,
+                        "label": row.get("label", ""), "fs": row.get("fs", ""), "status": row.get("status", "")})
+    return volumes
+
+# --- Installation Core ---
+def is_admin() -> bool:
+    """True if running elevated. Where Windows has no say (e.g. stub runs on Linux) this is True."""
+    import ctypes
+    if not hasattr(ctypes, "windll"): return True
+    return bool(ctypes.windll.shell32.IsUserAnAdmin())
+
+def resolve_tools(config: Dict) -> Dict[str, str]:
+    return {**DEFAULT_TOOLS, **config.get("tool_paths", {})}
+
+def default_config() -> Dict:
+    return {"last_iso_path": "", "partition_scheme": "MBR", "file_system": "NTFS", "extraction_mode": "selective",
+            "cache_enabled": True, "cache_dir": DEFAULT_CACHE_DIR, "cache_max_gb": 40,
+            "image_index": 1,
+            "phase_durations": dict(DEFAULT_PHASE_DURATIONS),
+            "max_parallel_drives": 2, "tool_paths": {}, "trace_enabled": True,
+            "resume_enabled": True, "apply_mode": "standard", "portable_tuning": [],
+            "benchmark_enabled": True, "benchmark_warn": {"seq_write_mbps": 20, "rand_write_iops": 100},
+            "benchmark_block": {"seq_write_mbps": 5, "rand_write_iops": 10}, "scratch_dir": "",
+            "tool_sessions": True, "phase_limits": {}, "install_mode": "clean",
+            "verify_mode": "off", "verify_sample_percent": VERIFY_SAMPLE_PERCENT,
+            "esd_conversion": "auto", "esd_compression": "fast", "wim_cache_dir": DEFAULT_WIM_CACHE_DIR, "wim_cache_max_gb": 20}
+
+def load_config() -> Dict:
+    config = default_config()
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r') as f: config.update(json.load(f))
+        except Exception as e: print(f"Failed to load config: {e}")
+    return config
+
+def save_config(config: Dict):
+    try:
+        with open(CONFIG_FILE, 'w') as f: json.dump(config, f, indent=4)
+    except Exception as e: print(f"Failed to save config: {e}")
+
+def record_phase_durations(config: Dict, durations: Dict[str, float]):
+    """Folds measured phase durations into config["phase_durations"]; per-drive phases like 'apply@1' count as 'apply'."""
+    by_phase = collections.defaultdict(list)
+    for name, seconds in durations.items(): by_phase[name.split("@")[0]].append(seconds)
+    measured = config.setdefault("phase_durations", dict(DEFAULT_PHASE_DURATIONS))
+    for name, values in by_phase.items():
+        seconds = sum(values) / len(values)
+        previous = measured.get(name, DEFAULT_PHASE_DURATIONS.get(name, seconds))
+        measured[name] = round(PHASE_DURATION_SMOOTHING * seconds + (1 - PHASE_DURATION_SMOOTHING) * previous, 1)
+
+def list_usb_disks(tools: Optional[Dict[str, str]] = None, broker: Optional[ToolBroker] = None) -> List[Dict]:
+    """Asks PowerShell (the broker's session if given) for the USB disks. Returns dicts with 'index', 'model' and 'size_bytes'."""
+    tools = tools or DEFAULT_TOOLS
+    # Use PowerShell instead of wmic (wmic is deprecated/removed in Windows 11 24H2+)
+    ps_script = (
+        "Get-PhysicalDisk | Where-Object { $_.BusType -eq 'USB' } | "
+        "Select-Object DeviceId, FriendlyName, SerialNumber, Size | "
+        "ConvertTo-Json -Compress"
+    )
+    if broker:
+        output = broker.powershell(ps_script).strip()
+    else:
+        command = [tools["powershell"], '-NoProfile', '-NonInteractive', '-Command', ps_script]
+        proc = subprocess.run(command, capture_output=True, text=True, check=True,
+                              creationflags=CREATE_NO_WINDOW)
+        output = proc.stdout.strip()
+    if not output:
+        return []
+
+    raw = json.loads(output)
+    # PowerShell returns a single object (dict) if only one disk, or a list
+    if isinstance(raw, dict):
+        raw = [raw]
+    disks = []
+    for disk in raw:
+        try:
+            disks.append({'index': int(disk["DeviceId"]), 'model': disk.get("FriendlyName") or "Unknown USB Drive",
+                          'serial': (disk.get("SerialNumber") or "").strip(), 'size_bytes': int(disk["Size"])})
+        except (ValueError, KeyError, TypeError):
+            continue
+    return disks
+
+def partition_index() -> Dict[int, str]:
+    """Maps disk index -> first mountpoint found on it, built with a single pass over the partitions."""
+    import psutil
+    mountpoints: Dict[int, str] = {}
+    for part in psutil.disk_partitions(all=True):
+        match = re.search(r'PhysicalDrive(\d+)', part.device)
+        if match: mountpoints.setdefault(int(match.group(1)), part.mountpoint)
+    return mountpoints
+
+def build_drive_list(disks: List[Dict], mountpoints: Dict[int, str]) -> List[Dict]:
+    """Turns raw disks into the drive dicts the UI shows, skipping anything under 1 GB."""
+    usb_drives = []
+    for disk in disks:
+        size_gb = disk['size_bytes'] / (1024 ** 3)
+        if size_gb < 1:
+            continue
+        index, model = disk['index'], disk['model']
+        mountpoint = mountpoints.get(index, f"Disk {index}")
+        usb_drives.append({
+            'device': mountpoint, 'index': index, 'model': model, 'serial': disk.get('serial', ""),
+            'total_gb': size_gb,
+            'display_name': f"{mountpoint} (Disk {index}) - {model} ({size_gb:.1f} GB)"
+        })
+    return usb_drives
+
+def enumerate_usb_drives(tools: Optional[Dict[str, str]] = None, broker: Optional[ToolBroker] = None) -> List[Dict]:
+    """Lists USB disks of at least 1 GB as dicts with 'device', 'index', 'model', 'total_gb' and 'display_name'."""
+    return build_drive_list(list_usb_disks(tools, broker), partition_index())
+
+def logical_drives_token() -> Optional[int]:
+    """A cheap value that changes when volumes come and go (the logical drive bitmask), or None if unavailable."""
+    try:
+        import ctypes
+        return ctypes.windll.kernel32.GetLogicalDrives()
+    except (AttributeError, OSError): return None
+
+_letter_lock = threading.Lock()
+_reserved_letters: Dict[int, str] = {}  # Disk index -> drive letter its new volume gets in this process
+
+def reserve_drive_letter(disk_index: int) -> Optional[str]:
+    """Picks the drive letter the volume formatted on a disk will get, or None if none is free."""
+    in_use = logical_drives_token() or 0
+    with _letter_lock:
+        if disk_index in _reserved_letters: return _reserved_letters[disk_index]
+        taken = set(_reserved_letters.values())
+        for letter in DRIVE_LETTER_CANDIDATES:
+            if letter not in taken and not in_use >> (ord(letter) - ord("A")) & 1:
+                _reserved_letters[disk_index] = letter
+                return letter
+    return None
+
+class DriveInventory:
+    """Keeps the list of USB drives up to date in a background thread, rescanning when volumes change."""
+
+    def __init__(self, list_disks: Callable[[], List[Dict]],
+                 on_change: Callable[[List[Dict], List[Dict], List[Dict], List[Dict]], None],
+                 on_error: Callable[[Exception], None] = lambda e: None,
+                 change_token: Callable[[], Optional[int]] = logical_drives_token,
+                 mountpoints: Callable[[], Dict[int, str]] = partition_index,
+                 poll_interval: float = DRIVE_POLL_INTERVAL, full_rescan_interval: float = DRIVE_FULL_RESCAN_INTERVAL):
+        self.list_disks, self.on_change, self.on_error = list_disks, on_change, on_error
+        self.change_token, self.mountpoints = change_token, mountpoints
+        self.poll_interval, self.full_rescan_interval = poll_interval, full_rescan_interval
+        self.drives: Dict[int, Dict] = {}
+        self.scanned = False
+        self._refresh_requested = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Starts polling; the first scan happens immediately."""
+        self._refresh_requested.set()
+        self._thread = threading.Thread(target=self._poll, name="drive-inventory", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._refresh_requested.set()
+
+    def refresh(self):
+        """Requests a full scan without waiting for it. Safe to call from any thread."""
+        self._refresh_requested.set()
+
+    def _poll(self):
+        last_token, last_scan = None, 0.0
+        while not self._stop.is_set():
+            forced = self._refresh_requested.wait(self.poll_interval)
+            if self._stop.is_set(): break
+            self._refresh_requested.clear()
+            token = self.change_token()
+            if forced or token != last_token or time.monotonic() - last_scan >= self.full_rescan_interval:
+                last_token, last_scan = token, time.monotonic()
+                self.scan()
+
+    def scan(self) -> bool:
+        """Enumerates the drives now and publishes the differences. Returns True if anything changed."""
+        try:
+            drives = {d['index']: d for d in build_drive_list(self.list_disks(), self.mountpoints())}
+        except Exception as e:
+            self.on_error(e)
+            return False
+        added = [d for i, d in drives.items() if i not in self.drives]
+        removed = [d for i, d in self.drives.items() if i not in drives]
+        changed = [d for i, d in drives.items() if i in self.drives and self.drives[i] != d]
+        first_scan, self.drives, self.scanned = not self.scanned, drives, True
+        if first_scan or added or removed or changed:
+            self.on_change(sorted(drives.values(), key=lambda d: d['index']), added, removed, changed)
+            return True
+        return False
+
+def iso_on_drive(iso_path: str, drive: Optional[Dict]) -> bool:
+    """True if the ISO is stored on a volume of the given drive (which is about to be wiped)."""
+    iso_drive = os.path.splitdrive(os.path.abspath(iso_path))[0].upper()
+    target = (drive or {}).get('device', "")
+    return bool(iso_drive) and os.path.splitdrive(target)[0].upper() == iso_drive
+
+def iso_placement_error(config: Dict, iso_path: str, drive: Optional[Dict]) -> Optional[str]:
+    """Why an ISO stored on the drive rules out writing to it with this configuration, or None."""
+    if not iso_on_drive(iso_path, drive): return None
+    if config.get("install_mode", "clean") == "refresh":
+        return "The ISO is stored on the drive being updated, and the update removes files that are not part of the image. Copy the ISO to another drive first."
+    if config.get("extraction_mode") == "mount":
+        return "The ISO is stored on the target USB drive, which will be wiped. Copy it to another drive or use the 'selective' extraction mode."
+    return None  # Extracted before prepare wipes the drive
+
+class InstallSession:
+    """Provides the Windows image from one ISO and runs the external tools of an installation."""
+
+    def __init__(self, config: Dict, iso_path: str, log: Optional[Callable[..., None]] = None,
+                 output: Optional[Callable[[str], None]] = None, cancel_event: Optional[threading.Event] = None,
+                 broker: Optional[ToolBroker] = None):
+        self.config = config
+        self.iso_path = iso_path
+        self.tools = resolve_tools(config)
+        self._log = log or (lambda message, level="info": print(message))
+        self._output = output or (lambda text: None)
+        self.cancel_event = cancel_event or threading.Event()
+        self.cancel_requested_at: Optional[float] = None  # time.monotonic() of the stop request, for the cancel latency
+        self.temp_iso_extract_path: Optional[str] = None
+        self.mounted_iso_path: Optional[str] = None
+        self.image_file_path: Optional[str] = None
+        self.converted_image: Optional[str] = None  # WIM export of the chosen ESD index (see convert_image)
+        self.extraction_plan: Optional[Dict] = None
+        self.exclude_roots: List[str] = []          # Volumes on the target drives (never used for scratch data)
+        self.staged_image_dir: Optional[str] = None  # Files of the new image for a refresh (see stage_image)
+        self.staged_mounted = False
+        self.image_manifest: Optional[FileManifest] = None
+        self.tracer = Tracer(enabled=config.get("trace_enabled", True))
+        self._owns_broker = broker is None and config.get("tool_sessions", True)
+        self.broker = ToolBroker(self.tools) if self._owns_broker else broker
+
+    def log_message(self, message: str, level: str = "info"):
+        self._log(message, level)
+
+    def cancel(self):
+        """Signals every phase to stop. Safe to call from any thread."""
+        if not self.cancel_event.is_set(): self.cancel_requested_at = time.monotonic()
+        self.cancel_event.set()
+        if self.broker:  # Not on the calling thread, which may be the UI
+            threading.Thread(target=self.broker.close, args=("diskpart", True), daemon=True, name="diskpart-stop").start()
+
+    def phase_limits(self, phase: Optional[str]) -> Dict:
+        """The timeout and stall limits for tool runs of a phase: DEFAULT_PHASE_LIMITS with "phase_limits" from the config on top."""
+        return {**DEFAULT_PHASE_LIMITS.get(phase, {}), **self.config.get("phase_limits", {}).get(phase, {})}
+
+    def run_tool(self, tool: str, args: List[str], progress_callback: Optional[Callable[[float], None]] = None,
+                 phase: Optional[str] = None, lines_callback: Optional[Callable[[str], None]] = None):
+        command = [self.tools[tool]] + args
+        self.run_subprocess(command, progress_callback, PROGRESS_PATTERNS.get(tool) or progress_pattern_for(command),
+                            self.phase_limits(phase), lines_callback)
 
+    def run_subprocess(self, command: List[str], progress_callback: Optional[Callable[[float], None]] = None,
+                       pattern: Optional["re.Pattern"] = None, limits: Optional[Dict] = None,
+                       lines_callback: Optional[Callable[[str], None]] = None):
+        """Runs a tool to completion. Its output goes to the log, and to lines_callback in blocks of whole lines."""
+        def on_lines(text: str):
+            self._output(text)
+            lines_callback(text)
+        output = OutputProcessor((pattern or progress_pattern_for(command)) if progress_callback else None,
+                                 progress_callback, on_lines if lines_callback else self._output)
+        with self.tracer.span(os.path.basename(command[0]), "tool", command=" ".join(command)[:300]) as span:
+            self._run_subprocess(command, output, span, limits or {})
+
+    def _run_subprocess(self, command: List[str], output: OutputProcessor, span: Optional[Span], limits: Dict):
+        failed = True
+        process: Optional[subprocess.Popen] = None
+        supervisor: Optional[ProcessSupervisor] = None
+        try:
+            if self.cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                creationflags=CREATE_NO_WINDOW
+            )
+            if span: span.mark("spawn_ms")
+            supervisor = ProcessSupervisor(process, os.path.basename(command[0]), self.cancel_event,
+                                           limits.get("timeout"), limits.get("stall")).start()
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            while True:
+                chunk = process.stdout.read1(OUTPUT_READ_SIZE)
+                if not chunk: break
+                supervisor.activity()
+                if span: span.mark("first_output_ms"); span.sample_process(process)
+                output.feed(decoder.decode(chunk))
+            if span: span.sample_process(process, force=True)
+            output.feed(decoder.decode(b"", final=True))
+            output.finish()
+            process.wait()
+            supervisor.finish()
+            if supervisor.cause == "cancelled" or (supervisor.cause is None and self.cancel_event.is_set()):
+                if supervisor.stopped_at and self.cancel_requested_at:
+                    latency = supervisor.stopped_at - self.cancel_requested_at
+                    if span: span.args["cancel_latency_ms"] = round(latency * 1000, 1)
+                    self.log_message(f"Stopped {supervisor.stopped()} {latency:.2f} s after the stop request.", "info")
+                raise InstallationCancelled("Installation stopped by user.", output.summary())
+            if supervisor.cause:
+                if span: span.args["stopped"] = supervisor.cause
+                raise ToolTimeoutError(supervisor.describe(), output.summary())
+            if span: span.args["exit_code"] = process.returncode
+            is_robocopy = os.path.splitext(os.path.basename(command[0]))[0].lower() == 'robocopy'
+            failed = (is_robocopy and process.returncode >= 8) or (not is_robocopy and process.returncode != 0)
+            if failed:
+                raise SubprocessError(f"Command `{' '.join(command)}` failed with exit code {process.returncode}.", output.summary())
+        except FileNotFoundError:
+            output.discard_spill()
+            raise SubprocessError(f"Command not found: {command[0]}", "Ensure the executable is in the correct directory or system PATH.")
+        except Exception as e:
+            if not isinstance(e, SubprocessError): raise SubprocessError(f"An unexpected error occurred: {e}", output.summary())
+            else: raise e
+        finally:
+            output.finish()
+            if not failed: output.discard_spill()
+            if process and process.poll() is None: kill_process_tree(process)  # Never leave a tool running after an error
+            if supervisor: supervisor.finish()
+            if process and process.stdout: process.stdout.close()
+
+    def run_diskpart(self, script: str, capture: bool = False) -> str:
+        """Runs a diskpart script. Scripts are serialized because diskpart allows one instance at a time."""
+        if self.broker:
+            if self.cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.")
+            session = self.broker.session("diskpart")
+            starts = session.starts
+            with self.tracer.span("diskpart", "tool", command="diskpart session: " + "; ".join(script.splitlines())[:300]) as span:
+                try:
+                    output = self.broker.diskpart(script, self.phase_limits("prepare").get("timeout") or TOOL_SESSION_TIMEOUT)
+                except SubprocessError as e:
+                    if self.cancel_event.is_set(): raise InstallationCancelled("Installation stopped by user.", e.command_output)
+                    raise
+                finally:
+                    if span: span.args["session_started"] = session.starts != starts
+            if not capture: self._output(output + "\n")
+            return output
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt', encoding='utf-8') as sf:
+            sf.write(script); script_path = sf.name
+        try:
+            with DISKPART_LOCK:
+                if not capture:
+                    self.run_tool("diskpart", ['/s', script_path], phase="prepare")
+                    return ""
+                with self.tracer.span("diskpart", "tool", command="diskpart /s (query)"):
+                    proc = subprocess.run(
+                        [self.tools["diskpart"], '/s', script_path], capture_output=True, text=True, check=True,
+                        creationflags=CREATE_NO_WINDOW, timeout=self.phase_limits("prepare").get("timeout") or None
+                    )
+                return proc.stdout
+        finally:
+            os.remove(script_path)
+
+    def plan_workspace(self, exclude_roots: Optional[List[str]] = None) -> Dict:
+        """Decides what to extract from the ISO and where, before any phase runs."""
+        mode = self.config.get("extraction_mode", "selective")
+        if mode not in EXTRACTION_MODES:
+            self.log_message(f"Unknown extraction mode '{mode}', using 'selective'.", "warning"); mode = "selective"
+        plan = {"mode": mode, "members": [], "use_cache": False, "scratch_dir": None, "required_bytes": 0}
+        self.extraction_plan = plan
+        if mode == "mount": return plan
+        self.log_message("Listing ISO contents to plan the extraction...")
+        try:
+            with IsoImage(self.iso_path) as iso: entries = iso.list_files()
+        except (IsoFormatError, OSError) as e:
+            self.log_message(f"Could not read the ISO directly ({e}), listing it with 7-Zip instead.", "warning")
+            entries = list_iso_contents(self.iso_path, self.tools["7z"])
+        if mode == "selective":
+            plan["members"] = plan_extraction(entries)
+            plan["required_bytes"] = sum(entries[m] for m in plan["members"])
+            self.log_message(f"Extracting {len(plan['members'])} of {len(entries)} files ({plan['required_bytes'] / (1024 ** 3):.2f} GB): {', '.join(plan['members'])}", "info")
+        else:
+            plan["required_bytes"] = sum(entries.values())
+        excluded = {root.upper() for root in exclude_roots or []}
+        self.exclude_roots = list(excluded)
+        if mode == "selective" and self.config.get("cache_enabled", True):
+            cache_dir = self.config.get("cache_dir") or DEFAULT_CACHE_DIR
+            cache_root = volume_root(cache_dir)
+            try: cache_free = shutil.disk_usage(cache_dir if os.path.isdir(cache_dir) else volume_root(cache_dir)).free
+            except OSError: cache_free = 0
+            if cache_root.upper() in excluded:
+                self.log_message(f"The extraction cache is on a target drive ({cache_root}); extracting elsewhere.", "warning")
+            elif cache_free < plan["required_bytes"] + SCRATCH_MARGIN_BYTES:
+                try: cached = ExtractionCache(cache_dir, 0).lookup(fingerprint_file(self.iso_path), plan["members"])
+                except OSError: cached = None
+                if cached:
+                    plan["use_cache"] = True
+                else:
+                    self.log_message(f"Not enough room in the extraction cache volume {cache_root} ({cache_free / (1024 ** 3):.1f} GB free); extracting elsewhere.", "warning")
+            else:
+                plan["use_cache"] = True
+            if plan["use_cache"]:
+                self.tracer.metadata["scratch"] = {"path": cache_dir, "cache": True, "required_bytes": plan["required_bytes"], "free_bytes": cache_free}
+                return plan
+        plan["scratch_dir"], placement = choose_scratch_dir(plan["required_bytes"], list(excluded), self.config.get("scratch_dir") or None, self.log_message)
+        self.tracer.metadata["scratch"] = placement
+        speed = f", {placement['seq_write_mbps']:.0f} MB/s" if placement.get("seq_write_mbps") else ""
+        self.log_message(f"Extracting on {placement['root']} ({placement['free_bytes'] / (1024 ** 3):.1f} GB free{speed}).", "info")
+        return plan
+
+    def extract_iso(self, report: Callable[..., None] = _no_progress):
+        def update_extraction_progress(percent: int):
+            report(percent / 100, f"{percent}%")
+        plan = self.extraction_plan or self.plan_workspace()
+        if plan["mode"] == "mount":
+            iso_root = self._mount_iso(self.iso_path)
+            self.image_file_path = find_image_file(iso_root)
+            self.log_message(f"Reading the image directly from the mounted ISO at {iso_root}", "info")
+            return
+        members = plan["members"]
+        if plan["use_cache"]:
+            self._extract_with_cache(members, update_extraction_progress)
+            return
+        self.log_message("Creating temporary directory for ISO extraction...")
+        self.temp_iso_extract_path = tempfile.mkdtemp(prefix="win-togo-", dir=plan["scratch_dir"])
+        self.log_message(f"Extracting to: {self.temp_iso_extract_path}", "info")
+        self.run_tool("7z", ['x', self.iso_path, f'-o{self.temp_iso_extract_path}', '-y', '-bsp1'] + members,
+                      progress_callback=update_extraction_progress, phase="extract")
+        self.image_file_path = find_image_file(self.temp_iso_extract_path)
+
+    def image_source(self, image_index: int) -> Tuple[str, int]:
+        """The file DISM reads image_index from and its index there: the converted WIM if there is one, else the ISO's image."""
+        if self.converted_image: return self.converted_image, 1
+        return self.image_file_path or find_image_file(self.temp_iso_extract_path), image_index
+
+    def convert_image(self, image_index: int, convert: bool = True, report: Callable[..., None] = _no_progress):
+        """Makes later phases read an ESD image from a cached WIM export, exporting one first if `convert`."""
+        image_file = self.image_file_path or find_image_file(self.temp_iso_extract_path)
+        mode = self.config.get("esd_conversion", "auto")
+        if not image_file.lower().endswith(".esd") or mode == "off":
+            report(1.0); return
+        compression = self.config.get("esd_compression", "fast")
+        if compression not in ESD_COMPRESSIONS:
+            self.log_message(f"Unknown ESD compression '{compression}', using 'fast'.", "warning"); compression = "fast"
+        cache_dir = self.config.get("wim_cache_dir") or DEFAULT_WIM_CACHE_DIR
+        cache = ExtractionCache(cache_dir, int(float(self.config.get("wim_cache_max_gb", 20)) * 1024 ** 3), self.log_message)
+        key = f"{fingerprint_file(image_file)[:32]}-{image_index}-{compression}"
+        entry_dir = cache.lookup(key, [CONVERTED_IMAGE_NAME])
+        source_bytes = os.path.getsize(image_file)
+        stats = {"cached": bool(entry_dir), "compression": compression, "esd_bytes": source_bytes}
+        if entry_dir:
+            self.log_message(f"Using the WIM converted from this ESD earlier ({compression} compression); DISM reads it faster.", "success")
+        elif not convert:
+            report(1.0); return
+        else:
+            free = shutil.disk_usage(cache_dir).free
+            if volume_root(cache_dir).upper() in self.exclude_roots or free < source_bytes * CONVERT_SPACE_FACTOR + SCRATCH_MARGIN_BYTES:
+                self.log_message(f"Not converting the ESD: the WIM cache volume {volume_root(cache_dir)} is a target drive or has "
+                                 f"too little room ({free / (1024 ** 3):.1f} GB free).", "warning")
+                report(1.0); return
+            staging_dir = cache.create_staging(key)
+            target = os.path.join(staging_dir, CONVERTED_IMAGE_NAME)
+            self.log_message(f"Converting image index {image_index} of the ESD to a WIM ({compression} compression), "
+                             "so this and later applies don't have to decompress LZMS...", "info")
+            start = time.monotonic()
+            try:
+                self.run_tool("dism", ['/Export-Image', f'/SourceImageFile:{image_file}', f'/SourceIndex:{image_index}',
+                                       f'/DestinationImageFile:{target}', f'/Compress:{compression}'],
+                              progress_callback=lambda percent: report(percent / 100, f"{int(percent)}%"), phase="convert")
+                entry_dir = cache.publish(key, staging_dir, [CONVERTED_IMAGE_NAME], os.path.basename(self.iso_path))
+            except InstallationCancelled:
+                cache.discard(staging_dir); raise
+            except (SubprocessError, OSError) as e:
+                cache.discard(staging_dir)
+                self.log_message(f"Could not convert the ESD ({str(e).splitlines()[0]}); reading it directly.", "warning")
+                report(1.0); return
+            stats["seconds"] = round(time.monotonic() - start, 1)
+            stats["wim_bytes"] = os.path.getsize(os.path.join(entry_dir, CONVERTED_IMAGE_NAME))
+            self.log_message(f"Converted in {stats['seconds']:.0f} s: {source_bytes / (1024 ** 3):.2f} GB ESD -> "
+                             f"{stats['wim_bytes'] / (1024 ** 3):.2f} GB WIM, kept in {cache_dir}.", "success")
+        self.converted_image = os.path.join(entry_dir, CONVERTED_IMAGE_NAME)
+        stats.setdefault("wim_bytes", os.path.getsize(self.converted_image))
+        self.tracer.metadata["convert"] = stats
+        report(1.0)
+
+    def stage_image(self, image_index: int, expanded_bytes: int = 0, report: Callable[..., None] = _no_progress):
+        """Mounts (or, for an ESD, applies) the image for a refresh and builds its manifest."""
+        image_file, image_index = self.image_source(image_index)
+        if image_file.lower().endswith(".wim"):
+            directory = tempfile.mkdtemp(prefix="win-togo-mount-", dir=(self.extraction_plan or {}).get("scratch_dir"))
+            self.log_message(f"Mounting image index {image_index} read-only...", "info")
+            self.staged_image_dir, self.staged_mounted = directory, True
+            self.run_tool("dism", ['/Mount-Image', f'/ImageFile:{image_file}', f'/Index:{image_index}', f'/MountDir:{directory}', '/ReadOnly'],
+                          progress_callback=lambda percent: report(percent / 200, f"mounting {int(percent)}%"), phase="stage")
+        else:
+            scratch, _ = choose_scratch_dir(expanded_bytes, self.exclude_roots, self.config.get("scratch_dir") or None, self.log_message)
+            directory = tempfile.mkdtemp(prefix="win-togo-stage-", dir=scratch)
+            self.log_message(f"ESD images can't be mounted; expanding image index {image_index} to {directory}...", "info")
+            self.staged_image_dir, self.staged_mounted = directory, False
+            self.run_tool("dism", ['/Apply-Image', f'/ImageFile:{image_file}', f'/Index:{image_index}', f'/ApplyDir:{directory}'],
+                          progress_callback=lambda percent: report(percent / 200, f"expanding {int(percent)}%"), phase="stage")
+        report(0.5, "listing files")
+        cache_path = os.path.join(MANIFEST_DIR, f"image-{fingerprint_file(image_file)[:16]}-{image_index}.json")
+        self.image_manifest = FileManifest(cache_path).scan(self.staged_image_dir, REFRESH_KEEP)  # As the volume is scanned
+        self.log_message(f"The image has {len(self.image_manifest.files):,} files.", "info")
+
+    def _unstage_image(self):
+        directory, self.staged_image_dir = self.staged_image_dir, None
+        if self.image_manifest: self.image_manifest.save()
+        if self.staged_mounted:
+            self.log_message("Unmounting the image...")
+            try:
+                proc = subprocess.run([self.tools["dism"], '/Unmount-Image', f'/MountDir:{directory}', '/Discard'],
+                                      capture_output=True, text=True, creationflags=CREATE_NO_WINDOW, timeout=600)
+                if proc.returncode != 0: self.log_message(f"Could not unmount the image: {proc.stdout.strip()[-300:]}", "warning")
+            except (OSError, subprocess.TimeoutExpired) as e:
+                self.log_message(f"Could not unmount the image: {e}", "warning")
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _extract_with_cache(self, members: List[str], progress_callback: Callable[[int], None]):
+        """Reuses a cached extraction of the ISO, or extracts into the cache and publishes it."""
+        cache = ExtractionCache(self.config.get("cache_dir") or DEFAULT_CACHE_DIR,
+                                int(float(self.config.get("cache_max_gb", 40)) * 1024 ** 3), self.log_message)
+        fingerprint = fingerprint_file(self.iso_path)
+        entry_dir = cache.lookup(fingerprint, members)
+        if entry_dir:
+            self.log_message(f"Using cached extraction {fingerprint[:12]}, skipping 7-Zip.", "success")
+            progress_callback(100)
+        else:
+            staging_dir = cache.create_staging(fingerprint)
+            self.log_message(f"Extracting into cache: {staging_dir}", "info")
+            try:
+                self.run_tool("7z", ['x', self.iso_path, f'-o{staging_dir}', '-y', '-bsp1'] + members,
+                              progress_callback=progress_callback, phase="extract")
+                entry_dir = cache.publish(fingerprint, staging_dir, members, os.path.basename(self.iso_path))
+            except Exception:
+                cache.discard(staging_dir)
+                raise
+        self.image_file_path = find_image_file(entry_dir)
+
+    def _mount_iso(self, iso_path: str) -> str:
+        """Mounts the ISO read-only with PowerShell and returns the root of its volume (e.g. 'E:\\')."""
+        self.log_message("Mounting ISO (no temporary copy will be made)...")
+        quoted = iso_path.replace("'", "''")
+        ps_script = (
+            f"$img = Mount-DiskImage -ImagePath '{quoted}' -Access ReadOnly -StorageType ISO -PassThru; "
+            "($img | Get-Volume).DriveLetter"
+        )
+        command = [self.tools["powershell"], '-NoProfile', '-NonInteractive', '-Command', ps_script]
+        proc = subprocess.run(command, capture_output=True, text=True, creationflags=CREATE_NO_WINDOW)
+        letter = proc.stdout.strip()
+        if proc.returncode != 0 or not re.match(r'^[A-Z]$', letter):
+            raise SubprocessError("Could not mount the ISO image.", proc.stdout + proc.stderr)
+        self.mounted_iso_path = iso_path
+        return f"{letter}:\\"
+
+    def _dismount_iso(self, iso_path: str):
+        self.log_message("Dismounting ISO...")
+        quoted = iso_path.replace("'", "''")
+        command = [self.tools["powershell"], '-NoProfile', '-NonInteractive', '-Command', f"Dismount-DiskImage -ImagePath '{quoted}'"]
+        proc = subprocess.run(command, capture_output=True, text=True, creationflags=CREATE_NO_WINDOW)
+        if proc.returncode != 0: self.log_message(f"Could not dismount the ISO: {proc.stderr.strip()}", "warning")
+
+    def cleanup(self):
+        if self._owns_broker and self.broker: self.broker.close()
+        if self.staged_image_dir: self._unstage_image()
+        if self.mounted_iso_path:
+            self._dismount_iso(self.mounted_iso_path)
+            self.mounted_iso_path = None
+        self.image_file_path = self.converted_image = None
+        if self.temp_iso_extract_path and os.path.exists(self.temp_iso_extract_path):
+            self.log_message(f"Cleaning up temporary directory...")
+            shutil.rmtree(self.temp_iso_extract_path, ignore_errors=True)
+            self.temp_iso_extract_path = None
+            self.log_message("Cleanup complete.")
+
+def volume_serial(root: str) -> Optional[int]:
+    """The serial number of the volume mounted at root (e.g. 'E:\\'), or None if it can't be read."""
+    try:
+        import ctypes
+        serial = ctypes.c_uint32()
+        if ctypes.windll.kernel32.GetVolumeInformationW(ctypes.c_wchar_p(root), None, 0, ctypes.byref(serial), None, None, None, 0):
+            return serial.value
+    except (AttributeError, OSError):
+        pass
+    return None
+
+class InstallJournal:
+    """Records which phases finished on one disk, so a failed or stopped install can resume."""
+
+    def __init__(self, disk_index: int, directory: str = JOURNAL_DIR):
+        self.path = os.path.join(directory, f"disk-{disk_index}.json")
+        self.state: Dict = {}
+
+    def load(self) -> Optional[Dict]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def begin(self, inputs: Dict, completed: Optional[Dict] = None):
+        self.state = {"inputs": inputs, "started": [], "completed": dict(completed or {})}
+        self._write()
+
+    def started(self, phase: str):
+        if phase not in self.state.get("started", []):
+            self.state.setdefault("started", []).append(phase)
+            self._write()
+
+    def completed(self, phase: str, **details):
+        self.state.setdefault("completed", {})[phase] = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), **details}
+        self._write()
+
+    def clear(self):
+        self.state = {}
+        try: os.remove(self.path)
+        except OSError: pass
+
+    def _write(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self.state, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Failed to write install journal: {e}")
+
+class DriveTarget:
+    """Formats one USB disk and writes the session's Windows image to it."""
+
+    def __init__(self, session: InstallSession, drive: Dict, image_index: int = 1, image_name: str = "", log_prefix: str = "",
+                 journal: Optional[InstallJournal] = None, expanded_bytes: int = 0, file_count: int = 0):
+        self.session = session
+        self.drive = drive
+        self.disk_index = drive['index']
+        self.image_index = image_index
+        self.image_name = image_name
+        self.expanded_bytes = expanded_bytes  # Size of the image once applied, from the WIM metadata (0 if unknown)
+        self.file_count = file_count
+        self.log_prefix = log_prefix
+        self.journal = journal
+        self.resume_phases: List[str] = []  # Phases already done on the drive, skipped by build_install_phases
+        self.target_drive_letter: Optional[str] = None
+
+    def log_message(self, message: str, level: str = "info"):
+        self.session.log_message(self.log_prefix + message, level)
+
+    def prepare_usb_drive(self, report: Callable[..., None] = _no_progress):
+        disk_index = self.disk_index
+        script_content_format = f"""
+        automount enable
+        select disk {disk_index}
+        clean
+        create partition primary
+        select partition 1
+        active
+        format fs=NTFS quick label=WindowsUSB
+        exit
+        """
+        self.log_message(f"Executing diskpart to format Disk {disk_index}...", "warning")
+        if self.journal: self.journal.started("prepare")
+        self.session.run_diskpart("\n".join(line.strip() for line in script_content_format.strip().splitlines()))
+        self.target_drive_letter = self._assign_drive_letter(disk_index)
+        if self.journal: self.journal.completed("prepare", volume_serial=volume_serial(self.target_drive_letter))
+
+    def _assign_drive_letter(self, disk_index: int) -> str:
+        """Gives the new volume a letter picked beforehand, so it never has to be looked up afterwards."""
+        select = f"select disk {disk_index}\nselect partition 1\n"
+        letter = reserve_drive_letter(disk_index)
+        if letter:
+            try:
+                self.session.run_diskpart(select + f"assign letter={letter}\nexit")
+                self.log_message(f"Assigned drive letter: {letter}:\\", "success")
+                return f"{letter}:\\"
+            except InstallationCancelled: raise
+            except SubprocessError as e:
+                self.log_message(f"Could not assign drive letter {letter}: ({str(e).splitlines()[0]}); letting Windows choose.", "warning")
+        try: self.session.run_diskpart(select + "assign\nexit")
+        except InstallationCancelled: raise
+        except SubprocessError: pass  # Windows may already have mounted the volume itself
+        return self._get_drive_letter_for_disk(disk_index)
+
+    def _get_drive_letter_for_disk(self, disk_index: int) -> str:
+        self.log_message(f"Querying diskpart for the drive letter of Disk {disk_index}...", "info")
+        # 'detail disk' lists only this disk's volumes, so several drives labelled WindowsUSB can't be confused.
+        output = self.session.run_diskpart(f"select disk {disk_index}\ndetail disk\nexit", capture=True)
+        for volume in diskpart_volumes(output):
+            if volume["letter"] and volume["label"].lower() == "windowsusb":
+                drive_letter = f"{volume['letter']}:\\"
+                self.log_message(f"Diskpart reports drive letter: {drive_letter}", "success")
+                return drive_letter
+        raise RuntimeError(f"Could not find the 'WindowsUSB' volume in 'detail disk' output for Disk {disk_index}.")
+
+    def apply_windows_image(self, report: Callable[..., None] = _no_progress):
+        """Applies the Windows image using DISM."""
+        def update_apply_progress(percent: float):
+            report(percent / 100, f"{int(percent)}%")
+
+        if not self.target_drive_letter:
+            raise RuntimeError("Cannot apply image because the target drive letter was not determined.")
+
+        image_file_path, source_index = self.session.image_source(self.image_index)
+
+        self.log_message(f"Found Windows image file: {os.path.basename(image_file_path)}"
+                         + (" (converted from the ESD)" if self.session.converted_image else ""), "info")
+        self.log_message("Applying image with DISM. This is the longest step and may take a very long time...", "info")
+
+        self.log_message(f"Applying image index {self.image_index}" + (f" ({self.image_name})" if self.image_name else ""), "info")
+        compact = self.session.config.get("apply_mode", "standard") == "compact"
+        if compact: self.log_message("Compact mode: system files are stored compressed to cut the bytes written.", "info")
+        used_before = self._used_bytes()
+        if self.journal: self.journal.started("apply")
+        self.session.run_tool("dism", [
+            '/Apply-Image', f'/ImageFile:{image_file_path}',
+            f'/Index:{source_index}', f'/ApplyDir:{self.target_drive_letter}'
+        ] + (['/Compact'] if compact else []), progress_callback=update_apply_progress, phase="apply")
+        used_after = self._used_bytes()
+        written = used_after - used_before if used_before is not None and used_after is not None else None
+        if written is None:
+            self.log_message(f"Could not measure the space used on {self.target_drive_letter}, so the bytes written are not known.", "warning")
+        else:
+            gb = 1024 ** 3
+            message = f"Wrote {written / gb:.2f} GB to the drive (used space {used_before / gb:.2f} GB -> {used_after / gb:.2f} GB)"
+            if self.expanded_bytes:
+                if compact: message += f"; a standard apply writes about {self.expanded_bytes / gb:.2f} GB ({1 - written / self.expanded_bytes:.0%} less)"
+                else: message += f"; the image expands to {self.expanded_bytes / gb:.2f} GB"
+            self.log_message(message + ".", "info")
+        if self.journal: self.journal.completed("apply", bytes_written=written, used_before=used_before, used_after=used_after,
+                                                apply_mode="compact" if compact else "standard")
+
+    def refresh_in_place(self, report: Callable[..., None] = _no_progress):
+        """Updates the Windows2Go volume already on the drive to the staged image, writing only what differs."""
+        session, cancel = self.session, self.session.cancel_event
+        image = session.image_manifest
+        letter = self.target_drive_letter or self._get_drive_letter_for_disk(self.disk_index)
+        if not os.path.isdir(os.path.join(letter, 'Windows')):
+            raise RuntimeError(f"Disk {self.disk_index} has no Windows installation to update. Create the drive normally instead.")
+        self.target_drive_letter = letter
+        serial = volume_serial(letter)
+        volume = FileManifest(os.path.join(MANIFEST_DIR, f"volume-{serial:08x}.json") if serial is not None else None)
+        report(0.01, "scanning drive")
+        volume.scan(letter, REFRESH_KEEP)
+        suspects = [key for key, entry in image.files.items()
+                    if key in volume.files and volume.files[key][1] == entry[1] and volume.files[key][2] != entry[2]]
+        hash_total, hashed = sum(image.files[key][1] * 2 for key in suspects), [0, 0]
+        def hash_progress(side: int):
+            def progress(done: int, total: int):
+                hashed[side] = done
+                report(0.02 + 0.28 * sum(hashed) / max(hash_total, 1), "comparing files")
+            return progress
+        image.hash_files(session.staged_image_dir, suspects, cancel, hash_progress(0))
+        volume.hash_files(letter, suspects, cancel, hash_progress(1))
+        plan = plan_refresh(image, volume)
+        write_bytes = sum(image.files[key][1] for key in plan["copy"])
+        freed = sum(volume.files[key][1] for key in plan["delete"]) + sum(volume.files[key][1] for key in plan["copy"] if key in volume.files)
+        unchanged = len(image.files) - len(plan["copy"])
+        self.log_message(f"Update plan: write {len(plan['copy']):,} files ({write_bytes / (1024 ** 3):.2f} GB), delete {len(plan['delete']):,}, "
+                         f"retime {len(plan['touch']):,}, relink {len(plan['create_links']):,}, keep {unchanged:,} unchanged "
+                         f"({(sum(e[1] for e in image.files.values()) - write_bytes) / (1024 ** 3):.2f} GB not rewritten).", "info")
+        free = shutil.disk_usage(letter).free
+        if write_bytes - freed > free - SCRATCH_MARGIN_BYTES:
+            raise RuntimeError(f"Not enough free space on {letter} for the update ({(write_bytes - freed) / (1024 ** 3):.1f} GB more needed, {free / (1024 ** 3):.1f} GB free).")
+
+        def copied(index: int):
+            key = plan["copy"][index]
+            volume.files[key] = list(image.files[key])
+        def copy_progress(done: int, total: int):
+            report(0.3 + 0.7 * done / max(total, 1), f"{done / (1024 ** 3):.2f} of {total / (1024 ** 3):.2f} GB")
+        try:
+            for key in plan["delete"]:
+                if cancel.is_set(): raise InstallationCancelled("Installation stopped by user.")
+                _remove_file(os.path.join(letter, volume.files[key][0]))
+                del volume.files[key]
+            for key in plan["delete_links"]:
+                entry = volume.links.pop(key)
+                _remove_link(os.path.join(letter, entry[0]), entry[4])
+            for key in plan["delete_dirs"]:
+                try: os.rmdir(os.path.join(letter, volume.dirs.pop(key)))
+                except OSError: pass  # Still holds files the refresh keeps
+            for key in plan["create_dirs"]:
+                os.makedirs(os.path.join(letter, image.dirs[key]), exist_ok=True)
+                volume.dirs[key] = image.dirs[key]
+            for key in plan["create_links"]:
+                create_link(letter, image.links[key])
+                volume.links[key] = list(image.links[key])
+            for key in plan["touch"]:
+                entry = image.files[key]
+                os.utime(os.path.join(letter, volume.files[key][0]), ns=(entry[2], entry[2]))
+                volume.files[key][2] = entry[2]
+            entries = [image.files[key] for key in plan["copy"]]
+            if os.name == "nt":
+                result = self._robocopy_files(session.staged_image_dir, letter, entries, copied, copy_progress)
+                # A drive applied with /Compact gets its written files compressed again, new ones included, except
+                # those the image's WimBootCompress.ini keeps uncompressed.
+                exclusions = read_compact_exclusions(session.staged_image_dir) if volume.compressed else []
+                compress = [os.path.join(letter, image.files[key][0]) for key in plan["copy"]
+                            if key in volume.compressed or (volume.compressed and not compact_excluded(image.files[key][0], exclusions))]
+                if compress: self.log_message(f"Compact drive: compressing {len(compress):,} written files again.", "info")
+                for batch in _command_batches(compress, len):
+                    session.run_tool("compact", REFRESH_COMPACT_ARGS + batch, phase="refresh")
+            else:
+                result = _replace_files(session.staged_image_dir, letter, entries, copied, copy_progress, cancel)
+        finally:
+            volume.save()  # What was written is recorded, so a retry compares against it
+        session.tracer.metadata.setdefault("refresh", {})[str(self.disk_index)] = {
+            "files_written": len(plan["copy"]), "bytes_written": write_bytes, "files_deleted": len(plan["delete"]), "links_created": len(plan["create_links"]),
+            "files_unchanged": unchanged, "bytes_hashed": hash_total, "copy_mbps": result["mbps"]}
+        self.log_message(f"Updated in place: wrote {result['bytes_copied'] / (1024 ** 3):.2f} GB at {result['mbps']:.0f} MB/s.", "success")
+
+    def _robocopy_files(self, source_root: str, target_root: str, entries: List[List], on_file: Callable[[int], None],
+                        progress: Callable[[int, int], None]) -> Dict:
+        """Copies manifest entries in one robocopy run, reporting each file as robocopy lists it."""
+        if not entries: return {"bytes_copied": 0, "mbps": 0.0}
+        pending = {entry[0].lower(): index for index, entry in enumerate(entries)}
+        prefix = os.path.join(source_root, "").lower()
+        total, done, start = sum(entry[1] for entry in entries), [0], time.perf_counter()
+        def on_lines(text: str):
+            for line in text.splitlines():
+                path = line.strip()
+                index = pending.pop(path[len(prefix):].lower(), None) if path.lower().startswith(prefix) else None
+                if index is None: continue
+                done[0] += entries[index][1]
+                on_file(index)
+            progress(done[0], total)
+        keep = [os.path.join(source_root, name) for name in REFRESH_KEEP]
+        job = tempfile.NamedTemporaryFile('w', encoding='utf-16', prefix='win-togo-refresh-', suffix='.rcj', delete=False)
+        try:
+            with job:  # Name lists in a job file are not bound by the command-line length
+                job.write("\n".join(["/IF"] + ["\t" + name for name in sorted({os.path.basename(entry[0]) for entry in entries})]
+                                    + ["/XD"] + ["\t" + path for path in keep] + ["/XF"] + ["\t" + path for path in keep]) + "\n")
+            self.session.run_tool("robocopy", [source_root, target_root, f"/JOB:{job.name}"] + REFRESH_ROBOCOPY_ARGS,
+                                  phase="refresh", lines_callback=on_lines)
+        finally:
+            os.remove(job.name)
+        seconds = time.perf_counter() - start
+        return {"bytes_copied": done[0], "mbps": round(done[0] / (1024 ** 2) / max(seconds, 1e-6), 1)}
+
+    def benchmark_drive(self, report: Callable[..., None] = _no_progress):
+        """Measures the volume the drive already has, before it is wiped, and stops if it is below the benchmark_block thresholds."""
+        self.log_message(f"Measuring drive performance on {self.drive['device']} before it is erased...", "info")
+        try: result = benchmark_path(self.drive['device'], cancel_event=self.session.cancel_event)
+        except OSError as e:  # e.g. a full or read-only volume
+            self.log_message(f"Could not measure {self.drive['device']} ({e}); continuing without the speed check.", "warning")
+            return
+        save_benchmark_result(drive_benchmark_key(self.drive), result)
+        self.check_benchmark(result)
+
+    def benchmark_formatted(self, report: Callable[..., None] = _no_progress):
+        """Measures the freshly formatted volume of a drive that had none to measure before. Only warns: the drive is already erased."""
+        if not self.target_drive_letter:
+            raise RuntimeError("Cannot benchmark the drive because the target drive letter was not determined.")
+        if not os.path.isdir(self.target_drive_letter):  # e.g. stub tools that never mount a volume
+            self.log_message(f"{self.target_drive_letter} is not a mounted volume; skipping the speed check.", "warning")
+            return
+        self.log_message("Measuring drive performance...", "info")
+        result = benchmark_path(self.target_drive_letter, cancel_event=self.session.cancel_event)
+        save_benchmark_result(drive_benchmark_key(self.drive), result)
+        self.check_benchmark(result, block=False)
+
+    def check_benchmark(self, result: Dict, block: bool = True) -> str:
+        """Logs a benchmark result with the apply time it implies. Raises if the drive is too slow to use, unless not block."""
+        level, summary = benchmark_verdict(result, self.session.config)
+        estimate = estimate_apply_seconds(result, self.expanded_bytes, self.file_count)
+        if estimate: summary += f"; the image apply should take about {estimate / 60:.1f} min"
+        if level == "block" and block:
+            raise RuntimeError(f"Drive too slow for Windows To Go ({summary}). See benchmark_block in the config file.")
+        if level == "block":
+            self.log_message(f"Drive too slow for Windows To Go ({summary}). It is already erased, so the install goes on; "
+                             "the next install on this drive is refused before anything is written.", "warning")
+            return level
+        self.log_message(f"Drive performance {summary}.", "warning" if level == "warn" else "success")
+        return level
+
+    def _used_bytes(self) -> Optional[int]:
+        root = self.target_drive_letter or ""
+        if len(root) == 2 and root.endswith(":"): root += "\\"  # "E:" alone means the current directory on E:
+        try: return shutil.disk_usage(root).used if root else None
+        except OSError: return None
+
+    def tune_offline(self, report: Callable[..., None] = _no_progress):
+        """Turns off write-heavy features (PORTABLE_TWEAKS) by editing the applied registry hives offline."""
+        if not self.target_drive_letter:
+            raise RuntimeError("Cannot tune the installation because the target drive letter was not determined.")
+        names = [name for name in self.session.config.get("portable_tuning", []) if name in PORTABLE_TWEAKS]
+        by_hive: Dict[str, List[tuple]] = {}
+        for name in names:
+            for hive, key, value, kind, data in PORTABLE_TWEAKS[name]: by_hive.setdefault(hive, []).append((key, value, kind, data))
+        self.log_message(f"Tuning the installation for USB: disabling {', '.join(n.replace('_', ' ') for n in names)}...", "info")
+        if self.journal: self.journal.started("tune")
+        for done, (hive, edits) in enumerate(by_hive.items(), 1):
+            mount = f"HKLM\\W2G_{hive}_{self.disk_index}"
+            self.session.run_tool("reg", ['load', mount, os.path.join(self.target_drive_letter, 'Windows', 'System32', 'config', hive)], phase="tune")
+            try:
+                for key, value, kind, data in edits:
+                    self.session.run_tool("reg", ['add', f"{mount}\\{key}", '/v', value, '/t', kind, '/d', data, '/f'], phase="tune")
+            finally:
+                # Unloaded directly so a cancelled run still releases the hive.
+                try:
+                    proc = subprocess.run([self.session.tools["reg"], 'unload', mount], capture_output=True, text=True,
+                                          creationflags=CREATE_NO_WINDOW, timeout=60)
+                    if proc.returncode != 0: self.log_message(f"Could not unload {mount}: {proc.stdout.strip() or proc.stderr.strip()}", "warning")
+                except subprocess.TimeoutExpired:
+                    self.log_message(f"Could not unload {mount}: reg did not finish within a minute.", "warning")
+            report(done / len(by_hive))
+        if self.journal: self.journal.completed("tune", tweaks=names)
+
+    def make_bootable(self, report: Callable[..., None] = _no_progress):
+        """Creates boot files using BCDBoot."""
+        if not self.target_drive_letter:
+            raise RuntimeError("Cannot make drive bootable because the target drive letter was not determined.")
+
+        windows_dir = os.path.join(self.target_drive_letter, 'Windows')
+        drive_letter = self.target_drive_letter.strip('\\')
+
+        self.log_message(f"Creating boot files on {drive_letter} using BCDBoot...", "info")
+
+        # /f ALL creates boot files for both BIOS and UEFI systems for maximum compatibility.
+        self.session.run_tool("bcdboot", [windows_dir, '/s', drive_letter, '/f', 'ALL'], phase="bootable")
+        if self.journal: self.journal.clear()
+
+    def verify_drive(self, report: Callable[..., None] = _no_progress):
+        """Reads the written files back and compares them with the staged image (see verify_tree)."""
+        session = self.session
+        audit = session.config.get("install_mode", "clean") == "verify"
+        mode = session.config.get("verify_mode", "off")
+        if mode not in ("sampled", "full"): mode = "sampled"
+        letter = self.target_drive_letter or self._get_drive_letter_for_disk(self.disk_index)
+        if not os.path.isdir(os.path.join(letter, 'Windows')):
+            raise RuntimeError(f"Disk {self.disk_index} has no Windows installation to verify.")
+        self.target_drive_letter = letter
+        known = load_benchmark_results().get(drive_benchmark_key(self.drive))
+        workers = VERIFY_WORKERS[classify_drive(known)] if known else VERIFY_DEFAULT_WORKERS
+        self.log_message(f"Verifying the drive ({mode}, {workers} reader{'s' if workers > 1 else ''})...", "info")
+        result = verify_tree(session.image_manifest, session.staged_image_dir, letter, mode,
+                             float(session.config.get("verify_sample_percent", VERIFY_SAMPLE_PERCENT)), session.cancel_event, report, workers)
+        session.tracer.metadata.setdefault("verify", {})[str(self.disk_index)] = {
+            **{k: v for k, v in result.items() if k not in ("missing", "mismatches")},
+            "missing": len(result["missing"]), "mismatches": result["mismatches"][:VERIFY_REPORT_LIMIT]}
+        message = (f"Read back {result['files_checked']:,} of {result['files']:,} files ({result['bytes_checked'] / (1024 ** 3):.2f} GB) "
+                   f"in {result['seconds']:.1f} s, {result['mbps']:.0f} MB/s")
+        if not result["direct"]: message += " (the OS cache could not be bypassed, so recently written data may have been read from memory)"
+        if result["modified"]: message += f"; {result['modified']:,} files changed since the image was written were skipped"
+        self.log_message(message + ".", "info")
+        problems = result["mismatches"] + ([] if audit else [(path, "missing") for path in result["missing"]])
+        if audit and result["missing"]:
+            self.log_message(f"{len(result['missing']):,} files of the image are not on the drive (e.g. {result['missing'][0]}).", "warning")
+        for path, reason in problems[:VERIFY_REPORT_LIMIT]: self.log_message(f"Mismatch: {path}: {reason}", "error")
+        if problems:
+            more = f" (first: {problems[0][0]}, {problems[0][1]})"
+            raise RuntimeError(f"Verification found {len(problems):,} damaged or missing file{'s' if len(problems) > 1 else ''}{more}. "
+                               "The drive may be faulty; try another USB port or drive.")
+        self.log_message("Verification passed: the checked files match the image.", "success")
+
+    def plan_resume(self, iso_fingerprint: str) -> List[str]:
+        """Compares the journal with the drive's current state and sets resume_phases."""
+        self.resume_phases = []
+        if not self.journal: return []
+        inputs = {"iso_fingerprint": iso_fingerprint, "image_index": self.image_index, "disk_index": self.disk_index,
+                  "model": self.drive.get('model'), "total_gb": round(self.drive.get('total_gb', 0), 1)}
+        state = self.journal.load()
+        completed = (state or {}).get("completed", {})
+        if not state or state.get("inputs") != inputs or "prepare" not in completed:
+            self.journal.begin(inputs); return []
+        if "apply" in state.get("started", []) and "apply" not in completed:
+            self.log_message("The previous image apply on this drive was interrupted; starting over.", "warning")
+            self.journal.begin(inputs); return []
+        try:
+            letter = self._get_drive_letter_for_disk(self.disk_index)
+        except Exception as e:
+            self.log_message(f"The volume from the previous attempt is gone ({e}); starting over.", "warning")
+            self.journal.begin(inputs); return []
+        recorded_serial = completed["prepare"].get("volume_serial")
+        if recorded_serial is not None and volume_serial(letter) != recorded_serial:
+            self.log_message("The drive was reformatted since the previous attempt; starting over.", "warning")
+            self.journal.begin(inputs); return []
+        self.target_drive_letter = letter
+        self.resume_phases = ["prepare"]
+        if "apply" in completed:
+            if os.path.isdir(os.path.join(letter, 'Windows')):
+                self.resume_phases.append("apply")
+                if "tune" in completed: self.resume_phases.append("tune")
+            else: completed = {"prepare": completed["prepare"]}
+        self.journal.begin(inputs, completed)
+        self.journal.state["started"] = list(self.resume_phases)
+        self.log_message(f"Resuming the previous installation: {', '.join(self.resume_phases)} already done.", "success")
+        return self.resume_phases
+
+def build_install_phases(session: InstallSession, targets: List[DriveTarget], durations: Optional[Dict[str, float]] = None) -> List[Phase]:
+    """The install graph for the session's install mode, with per-drive phases suffixed '@<disk index>' when there are several."""
+    durations = {**DEFAULT_PHASE_DURATIONS, **(durations or {})}
+    fan_out = len(targets) > 1
+    tune = bool(session.config.get("portable_tuning"))
+    install_mode = session.config.get("install_mode", "clean")
+    verify = install_mode == "verify" or session.config.get("verify_mode", "off") in ("sampled", "full")
+    image_index, expanded_bytes = targets[0].image_index, max(target.expanded_bytes for target in targets)
+    conversion = session.config.get("esd_conversion", "auto")
+    # Worth converting when the image is read by several drives or would be expanded to scratch by the stage phase.
+    convert_now = conversion == "always" or (conversion == "auto" and (fan_out or verify or install_mode != "clean"))
+    convert = [Phase("convert", "Converting the image" if convert_now else "Looking for a converted image",
+                     lambda report: session.convert_image(image_index, convert_now, report), ("extract",),
+                     durations["convert"] if convert_now else 1.0)] if conversion != "off" else []
+    image_deps = ("extract",) + (("convert",) if convert else ())
+    stage = Phase("stage", "Reading the image", lambda report: session.stage_image(image_index, expanded_bytes, report),
+                  image_deps, durations["stage"])
+    def verify_phase(target: DriveTarget, after: str) -> List[Phase]:
+        suffix = f"@{target.disk_index}" if fan_out else ""
+        options = {"resource": "drive", "cancel_on_failure": False} if fan_out else {}
+        return [Phase("verify" + suffix, (f"Disk {target.disk_index}: " if fan_out else "") + "Verifying files", target.verify_drive,
+                      ("stage",) + ((after + suffix,) if after else ()), durations["verify"], **options)] if verify else []
+    if install_mode == "verify":
+        return [Phase("extract", "Extracting ISO", session.extract_iso, weight=durations["extract"])] + convert + [stage] + \
+            [phase for target in targets for phase in verify_phase(target, "")]
+    if install_mode == "refresh":
+        phases = [Phase("extract", "Extracting ISO", session.extract_iso, weight=durations["extract"])] + convert + [stage]
+        for target in targets:
+            suffix = f"@{target.disk_index}" if fan_out else ""
+            label = f"Disk {target.disk_index}: " if fan_out else ""
+            options = {"resource": "drive", "cancel_on_failure": False} if fan_out else {}
+            phases += [Phase("refresh" + suffix, label + "Updating files in place", target.refresh_in_place, ("stage",), durations["refresh"], **options)]
+            if tune: phases += [Phase("tune" + suffix, label + "Tuning for USB", target.tune_offline, ("refresh" + suffix,), durations["tune"], **options)]
+            phases += [Phase("bootable" + suffix, label + "Creating boot files", target.make_bootable,
+                             (("tune" if tune else "refresh") + suffix,), durations["bootable"], **options)]
+            phases += verify_phase(target, "bootable")
+        return phases
+    phases = []
+    # Only the apply phase reads the image, so a retry that resumes after it needs no extraction (unless it verifies).
+    if verify or any("apply" not in target.resume_phases for target in targets):
+        phases += [Phase("extract", "Extracting ISO", session.extract_iso, weight=durations["extract"])] + convert
+    if verify:
+        stage.cancel_on_failure = False  # Only the verify phases read it; a failed mount must not stop the writes
+        phases.append(stage)
+    for target in targets:
+        suffix = f"@{target.disk_index}" if fan_out else ""
+        label = f"Disk {target.disk_index}: " if fan_out else ""
+        options = {"resource": "drive", "cancel_on_failure": False} if fan_out else {}
+        # If the ISO lives on the target drive, it must be read before diskpart wipes the drive.
+        prepare_deps = ("extract",) if iso_on_drive(session.iso_path, target.drive) else ()
+        # Drives measured before (same model and serial) are not benchmarked again. A drive with a mounted volume is
+        # measured on it before prepare wipes it; one without is measured once formatted, where it can only warn.
+        benchmark = (session.config.get("benchmark_enabled", True) and not target.resume_phases
+                     and drive_benchmark_key(target.drive) not in load_benchmark_results())
+        before = benchmark and os.path.isdir(target.drive.get('device', ""))
+        after = benchmark and not before
+        phases += ([Phase("benchmark" + suffix, label + "Measuring drive speed", target.benchmark_drive, (), durations["benchmark"], **options)] if before else []) + [
+            Phase("prepare" + suffix, label + "Preparing USB drive", target.prepare_usb_drive,
+                  prepare_deps + (("benchmark" + suffix,) if before else ()), durations["prepare"], **options),
+        ] + ([Phase("benchmark" + suffix, label + "Measuring drive speed", target.benchmark_formatted, ("prepare" + suffix,), durations["benchmark"], **options)] if after else []) + [
+            Phase("apply" + suffix, label + "Applying Windows Image", target.apply_windows_image,
+                  image_deps + (("benchmark" if after else "prepare") + suffix,), durations["apply"], **options),
+        ] + ([Phase("tune" + suffix, label + "Tuning for USB", target.tune_offline, ("apply" + suffix,), durations["tune"], **options)] if tune else []) + [
+            Phase("bootable" + suffix, label + "Creating boot files", target.make_bootable, (("tune" if tune else "apply") + suffix,), durations["bootable"], **options),
+        ] + verify_phase(target, "bootable")
+        phases = [p for p in phases if not (p.name.endswith(suffix) and p.name[:len(p.name) - len(suffix)] in target.resume_phases)]
+    names = {phase.name for phase in phases}
+    for phase in phases: phase.depends_on = tuple(d for d in phase.depends_on if d in names)
+    return phases
+
+# --- Headless Mode ---
+def _drive_status(phases: List[Phase], disk_index: int, fan_out: bool) -> Tuple[str, str]:
+    """Returns (status, error) for one drive from the state of its own and the shared phases after a run."""
+    suffix = f"@{disk_index}"
+    relevant = [p for p in phases if not fan_out or "@" not in p.name or p.name.endswith(suffix)]
+    failed = [p for p in relevant if p.status == "failed"]
+    # Report the phase that caused the stop, not the ones that were cancelled because of it.
+    cause = next((p for p in failed if not isinstance(p.error, InstallationCancelled)), failed[0] if failed else None)
+    if cause is not None: return "failed", str(cause.error).split("\n")[0]
+    if all(p.status == "done" for p in relevant): return "success", ""
+    return "cancelled", ""
+
+def run_headless(argv: Optional[List[str]] = None) -> int:
+    """Writes one ISO to one or more USB disks without the GUI. Returns the process exit code."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="Windows2Go.py --headless",
+                                     description="Create Windows To Go drives without the GUI. ALL DATA ON THE LISTED DISKS IS DESTROYED.")
+    parser.add_argument("--iso", required=True, help="Windows ISO file")
+    parser.add_argument("--disk", type=int, action="append", required=True, dest="disks", metavar="INDEX",
+                        help="Disk number of a target USB drive (repeat for several drives)")
+    parser.add_argument("--index", type=int, help="Image index to apply (default: image_index from the config file)")
+    parser.add_argument("--parallel", type=int, help="Drives written at the same time (default: max_parallel_drives from the config file)")
+    parser.add_argument("--extraction-mode", choices=EXTRACTION_MODES, help="Override extraction_mode from the config file")
+    parser.add_argument("--apply-mode", choices=APPLY_MODES, help="Override apply_mode from the config file")
+    parser.add_argument("--esd-conversion", choices=ESD_CONVERSION_MODES,
+                        help="Override esd_conversion from the config file (export an install.esd to a faster WIM once)")
+    parser.add_argument("--tune", action="store_true", help=f"Disable {', '.join(PORTABLE_TWEAKS)} on the drives after applying")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Update existing Windows2Go drives in place, writing only files that differ from the image")
+    parser.add_argument("--verify-mode", choices=VERIFY_MODES, help="Override verify_mode from the config file (read the files back after writing)")
+    parser.add_argument("--verify-only", action="store_true",
+                        help="Only check existing Windows2Go drives against the image (sampled unless --verify-mode full); nothing is written")
+    parser.add_argument("--tool", action="append", default=[], metavar="NAME=PATH",
+                        help=f"Use another executable for a tool ({', '.join(DEFAULT_TOOLS)}), e.g. a stub for testing")
+    parser.add_argument("--yes", action="store_true", help="Do not ask for confirmation")
+    parser.add_argument("--no-resume", action="store_true", help="Start from scratch even if a previous attempt on a drive can be resumed")
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    if args.extraction_mode: config["extraction_mode"] = args.extraction_mode
+    if args.apply_mode: config["apply_mode"] = args.apply_mode
+    if args.esd_conversion: config["esd_conversion"] = args.esd_conversion
+    if args.tune: config["portable_tuning"] = list(PORTABLE_TWEAKS)
+    if args.refresh: config["install_mode"] = "refresh"
+    if args.verify_mode: config["verify_mode"] = args.verify_mode
+    if args.verify_only: config["install_mode"] = "verify"
+    refresh = config.get("install_mode", "clean") == "refresh"
+    audit = config.get("install_mode", "clean") == "verify"
+    for spec in args.tool:
+        name, _, path = spec.partition("=")
+        if name not in DEFAULT_TOOLS or not path: parser.error(f"Invalid --tool '{spec}'.")
+        config.setdefault("tool_paths", {})[name] = path
+    image_index = args.index or int(config.get("image_index", 1))
+    parallel = max(1, args.parallel or int(config.get("max_parallel_drives", 2)))
+    disks = list(dict.fromkeys(args.disks))
+
+    log_file = open_log_file()
+    log_lock = threading.Lock()
+    def log(message: str, level: str = "info"):
+        line = f"[{time.strftime('%H:%M:%S')}] {level.upper():<7} {message}"
+        with log_lock:
+            print(line, flush=True)
+            if log_file: log_file.write(line + "\n"); log_file.flush()
+    def output(text: str):
+        with log_lock:
+            if log_file: log_file.write(text); log_file.flush()
+
+    if not os.path.isfile(args.iso):
+        log(f"ISO not found: {args.iso}", "error"); return 2
+    if not is_admin():
+        log("Administrator rights are required.", "error"); return 2
+    tools = resolve_tools(config)
+    broker = ToolBroker(tools) if config.get("tool_sessions", True) else None
+    try:
+        usb_drives = {d['index']: d for d in enumerate_usb_drives(tools, broker)}
+    except Exception as e:
+        log(f"Error detecting USB drives: {e}", "error"); return 2
+    unknown = [d for d in disks if d not in usb_drives]
+    if unknown:
+        log(f"Not a USB disk (refusing to touch it): {', '.join(f'Disk {d}' for d in unknown)}", "error"); return 2
+
+    image_name, required_gb, expanded_bytes, file_count = "", 0.0, 0, 0
+    try:
+        with IsoImage(args.iso) as iso:
+            entry = find_image_in_iso(iso)
+            images = read_wim_images_from_iso(iso, entry) if entry else []
+        image = next((i for i in images if i['index'] == image_index), None)
+        if images and image is None:
+            log(f"Image index {image_index} does not exist. Available: " + ", ".join(describe_wim_image(i) for i in images), "error"); return 2
+        if image:
+            image_name, expanded_bytes, file_count = image['name'], image['expanded_bytes'], image['file_count']
+            required_gb = expanded_bytes / (1024 ** 3) + WTG_SPACE_MARGIN_GB
+    except (IsoFormatError, WimFormatError, OSError) as e:
+        log(f"Could not read the editions in the ISO ({e}); applying index {image_index}.", "warning")
+
+    targets, results = [], {}
+    session = InstallSession(config, args.iso, log, output, broker=broker)
+    for disk in disks:
+        drive = usb_drives[disk]
+        if required_gb and drive['total_gb'] < required_gb and not audit:
+            results[disk] = ("failed", f"Drive too small ({drive['total_gb']:.1f} GB, {required_gb:.1f} GB needed)")
+            continue
+        placement_error = None if audit else iso_placement_error(config, args.iso, drive)
+        if placement_error:
+            results[disk] = ("failed", placement_error)
+            continue
+        journal = InstallJournal(disk) if config.get("resume_enabled", True) and not args.no_resume and not refresh and not audit else None
+        target = DriveTarget(session, drive, image_index, image_name, f"[Disk {disk}] " if len(disks) > 1 else "", journal, expanded_bytes, file_count)
+        known = load_benchmark_results().get(drive_benchmark_key(drive)) if config.get("benchmark_enabled", True) and not (refresh or audit) else None
+        if known:
+            try: target.check_benchmark(known)
+            except RuntimeError as e:
+                results[disk] = ("failed", str(e))
+                continue
+        targets.append(target)
+    if targets and not args.yes and not audit:
+        print("\nThe following drives will be UPDATED IN PLACE (files not in the image are deleted):" if refresh
+              else "\nThe following drives will be PERMANENTLY ERASED:")
+        for target in targets: print(f"  {target.drive['display_name']}")
+        if input("Type YES to continue: ").strip() != "YES":
+            log("Cancelled by user."); return 1
+
+    if targets:
+        if any(target.journal for target in targets):
+            iso_fingerprint = fingerprint_file(args.iso)
+            for target in targets:
+                if target.journal: target.plan_resume(iso_fingerprint)
+        if any("apply" not in target.resume_phases for target in targets) or config.get("verify_mode", "off") != "off":
+            try:
+                session.plan_workspace([root for target in targets for root in target_volume_roots(target.drive, tools, broker)])
+            except (RuntimeError, SubprocessError, OSError) as e:
+                log(str(e), "error")
+                for target in targets: results[target.disk_index] = ("failed", str(e).split("\n")[0])
+                targets = []
+    if targets:
+        phases = build_install_phases(session, targets, config.get("phase_durations"))
+        last_report = [0.0, -1]
+        def on_progress(fraction: float, label: str):
+            percent, now = int(fraction * 100), time.monotonic()
+            if percent != last_report[1] and (now - last_report[0] >= 5 or percent == 100):
+                last_report[:] = [now, percent]; log(f"{percent:3d}% {label}")
+        scheduler = PhaseScheduler(phases, on_progress, session.cancel_event, session.cancel,
+                                   max_workers=parallel + 1, limits={"drive": parallel}, tracer=session.tracer)
+        session.tracer.metadata.update(iso=os.path.basename(args.iso), disks=[t.disk_index for t in targets],
+                                       image_index=image_index, parallel=parallel)
+        if audit: log(f"Verifying {len(targets)} drive(s) against {image_name or f'index {image_index}'}, {parallel} at a time.")
+        else: log(f"{'Updating' if refresh else 'Writing'} {image_name or f'index {image_index}'} {'on' if refresh else 'to'} {len(targets)} drive(s), {parallel} at a time.")
+        worker = threading.Thread(target=lambda: _run_quietly(scheduler), daemon=True)
+        worker.start()
+        try:
+            while worker.is_alive(): worker.join(0.5)
+        except KeyboardInterrupt:
+            log("Interrupted, stopping all drives...", "warning")
+            session.cancel()
+            worker.join()
+        finally:
+            session.cleanup()
+        # Saved into a fresh copy of the config file, so command-line overrides are not persisted.
+        stored = load_config()
+        record_phase_durations(stored, {phase.name: phase.duration for phase in phases if phase.status == "done"})
+        save_config(stored)
+        trace_path = session.tracer.export()
+        if session.tracer.spans: log("Phase timings: " + session.tracer.summary())
+        if trace_path: log(f"Performance trace written to {trace_path}")
+        for target in targets:
+            results[target.disk_index] = _drive_status(phases, target.disk_index, len(disks) > 1)
+    if broker: broker.close()
+
+    log("Summary:")
+    for disk in disks:
+        status, error = results.get(disk, ("cancelled", ""))
+        log(f"  Disk {disk}: {status.upper()}" + (f" - {error}" if error else ""), "info" if status == "success" else "error")
+    if log_file: log_file.close()
+    return 0 if all(results.get(d, ("",))[0] == "success" for d in disks) else 1
+
+def run_benchmark(argv: Optional[List[str]] = None) -> int:
+    """Benchmarks any mounted path (e.g. a USB stick's volume) and prints its performance class."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="Windows2Go.py --benchmark", description="Measure a drive with a temporary test file.")
+    parser.add_argument("path", help="A directory on the volume to measure")
+    parser.add_argument("--seconds", type=float, default=BENCHMARK_SECONDS, help="Time limit for each test")
+    args = parser.parse_args(argv)
+    config = load_config()
+    try: result = benchmark_path(args.path, args.seconds)
+    except OSError as e:
+        print(f"Benchmark failed: {e}"); return 2
+    level, summary = benchmark_verdict(result, config)
+    print(f"{args.path}: {summary}" + ("" if result["direct"] else " (OS cache could not be bypassed)"))
+    estimate = estimate_apply_seconds(result, 16 * 1024 ** 3, 100_000)
+    if estimate: print(f"A typical Windows 11 image (16 GB, 100,000 files) would take about {estimate / 60:.1f} min to apply.")
+    return {"ok": 0, "warn": 1, "block": 2}[level]
+
+def _run_quietly(scheduler: PhaseScheduler):
+    # Failures are read back from the phases, so the scheduler's exception carries no extra information here.
+    try: scheduler.run()
+    except Exception: pass
+
+def load_gui():
+    """Imports the GUI toolkit and sets the appearance mode and color theme."""
+    global ctk, filedialog, messagebox
+    if ctk is not None: return
+    import customtkinter
+    from tkinter import filedialog as tk_filedialog, messagebox as tk_messagebox
+    ctk, filedialog, messagebox = customtkinter, tk_filedialog, tk_messagebox
+    ctk.set_appearance_mode("dark")
+    ctk.set_default_color_theme("blue")
+
+class WindowsToGoCreator:
+    def __init__(self):
+        load_gui()
         self.root = ctk.CTk()
         self.root.title(f"{APP_NAME} v{APP_VERSION}")
         self.root.geometry("900x750")
@@ -69,29 +3121,56 @@ class WindowsToGoCreator:
         # --- Application State ---
         self.selected_iso_path = ""
         self.selected_drive: Optional[Dict] = None
-        self.target_drive_letter: Optional[str] = None
         self.installation_thread: Optional[threading.Thread] = None
-        self.current_process: Optional[subprocess.Popen] = None
-        self.temp_iso_extract_path: Optional[str] = None
+        self.session: Optional[InstallSession] = None
+        self.cancel_event = threading.Event()
+        self.available_images: List[Dict] = []
+        self.selected_image_index = 1
         self.is_installing = False
+        self.events = EventBus()
+        self.log_file = open_log_file()
         
         self.load_config()
+        self.available_drives: List[Dict] = []
+        # One broker for the app, so drive scans and installs reuse the same diskpart/PowerShell sessions.
+        self.tool_broker = ToolBroker(resolve_tools(self.config)) if self.config.get("tool_sessions", True) else None
+        self.drive_inventory = DriveInventory(
+            lambda: list_usb_disks(resolve_tools(self.config), self.tool_broker),
+            lambda *change: self.call_in_ui(self.on_drives_changed, *change),
+            lambda e: self.log_message(f"Error detecting USB drives: {str(e)}", "error"))
         self.setup_ui()
-        self.refresh_drives()
+        # Everything slow happens after the window is up, with "loading" states until it reports back.
+        self.drive_dropdown.set("Scanning for USB drives...")
+        self.start_btn.configure(state="disabled", text="⏳ Checking requirements...")
         self.center_window()
-        
-    def check_admin_rights(self):
-        try:
-            if not ctypes.windll.shell32.IsUserAnAdmin():
-                messagebox.showerror("Administrator Rights Required", "This application requires administrator privileges...")
-                sys.exit(1)
-        except Exception:
-            messagebox.showwarning("Warning", "Could not verify admin rights. The application may fail.")
+        self._events_job = self.root.after(UI_DRAIN_INTERVAL_MS, self.process_events)
+        self.root.after_idle(self.start_background_work)
+
+    def start_background_work(self):
+        self.drive_inventory.start()
+        threading.Thread(target=self.run_preflight_checks, name="preflight", daemon=True).start()
+        if self.selected_iso_path and os.path.exists(self.selected_iso_path): self.validate_iso_file_async(self.selected_iso_path)
 
-    def check_dependencies(self):
-        if not shutil.which(SEVEN_ZIP_EXECUTABLE):
-            messagebox.showerror("Dependency Missing", f"'{SEVEN_ZIP_EXECUTABLE}' not found...")
-            sys.exit(1)
+    def run_preflight_checks(self):
+        """Probes admin rights and the 7-Zip executable off the UI thread, then reports to on_preflight_done."""
+        try: admin: Optional[bool] = is_admin()
+        except Exception: admin = None
+        seven_zip = resolve_tools(self.config)["7z"]
+        self.call_in_ui(self.on_preflight_done, admin, seven_zip if shutil.which(seven_zip) else None, seven_zip)
+
+    def on_preflight_done(self, admin: Optional[bool], seven_zip_path: Optional[str], seven_zip: str):
+        if admin is False:
+            messagebox.showerror("Administrator Rights Required", "This application requires administrator privileges...")
+            self.root.after(0, self._shutdown); return
+        if admin is None:
+            messagebox.showwarning("Warning", "Could not verify admin rights. The application may fail.")
+        if not seven_zip_path:
+            messagebox.showerror("Dependency Missing", f"'{seven_zip}' not found...")
+            self.root.after(0, self._shutdown); return
+        self.log_message(f"Requirements OK (7-Zip: {seven_zip_path}).", "success")
+        self.start_btn.configure(text="🚀 Create Windows2Go Drive")
+        if not self.is_installing:
+            self.start_btn.configure(state="normal"); self.verify_btn.configure(state="normal")
 
     def center_window(self):
         self.root.update_idletasks()
@@ -101,16 +3180,10 @@ class WindowsToGoCreator:
         self.root.geometry(f"{width}x{height}+{x}+{y}")
         
     def load_config(self):
-        self.config = {"last_iso_path": "", "partition_scheme": "MBR", "file_system": "NTFS"}
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r') as f: self.config.update(json.load(f))
-            except Exception as e: print(f"Failed to load config: {e}")
+        self.config = load_config()
             
     def save_config(self):
-        try:
-            with open(CONFIG_FILE, 'w') as f: json.dump(self.config, f, indent=4)
-        except Exception as e: print(f"Failed to save config: {e}")
+        save_config(self.config)
             
     # --- UI Setup ---
     def setup_ui(self):
@@ -174,12 +3247,35 @@ class WindowsToGoCreator:
         self.filesystem_var = ctk.StringVar(value=self.config["file_system"])
         filesystem_dropdown = ctk.CTkComboBox(options_grid, variable=self.filesystem_var, values=["NTFS"], state="disabled")
         filesystem_dropdown.grid(row=1, column=1, padx=15, pady=(0, 10), sticky="ew")
+        image_label = ctk.CTkLabel(options_grid, text="Windows Edition:")
+        image_label.grid(row=2, column=0, padx=15, pady=5, sticky="w")
+        self.image_var = ctk.StringVar(value="Select an ISO to list its editions")
+        self.image_dropdown = ctk.CTkComboBox(options_grid, variable=self.image_var, values=[self.image_var.get()], state="readonly", command=self.on_image_selected)
+        self.image_dropdown.grid(row=3, column=0, columnspan=2, padx=15, pady=(0, 10), sticky="ew")
+        apply_label = ctk.CTkLabel(options_grid, text="Apply Mode:")
+        apply_label.grid(row=4, column=0, padx=15, pady=5, sticky="w")
+        self.apply_mode_var = ctk.StringVar(value=APPLY_MODE_LABELS[self.config.get("apply_mode", "standard")])
+        self.apply_mode_dropdown = ctk.CTkComboBox(options_grid, variable=self.apply_mode_var, values=list(APPLY_MODE_LABELS.values()), state="readonly", command=self.on_apply_options_changed)
+        self.apply_mode_dropdown.grid(row=5, column=0, padx=15, pady=(0, 10), sticky="ew")
+        self.tuning_var = ctk.BooleanVar(value=bool(self.config.get("portable_tuning")))
+        self.tuning_checkbox = ctk.CTkCheckBox(options_grid, text="Disable pagefile, hibernation, restore and indexing", variable=self.tuning_var, command=self.on_apply_options_changed)
+        self.tuning_checkbox.grid(row=5, column=1, padx=15, pady=(0, 10), sticky="w")
+        self.refresh_var = ctk.BooleanVar(value=self.config.get("install_mode", "clean") == "refresh")
+        self.refresh_checkbox = ctk.CTkCheckBox(options_grid, text="Update an existing Windows2Go drive in place (writes only changed files)", variable=self.refresh_var, command=self.on_apply_options_changed)
+        self.refresh_checkbox.grid(row=6, column=0, columnspan=2, padx=15, pady=(0, 10), sticky="w")
+        verify_label = ctk.CTkLabel(options_grid, text="Verify After Writing:")
+        verify_label.grid(row=7, column=0, padx=15, pady=5, sticky="w")
+        self.verify_mode_var = ctk.StringVar(value=VERIFY_MODE_LABELS.get(self.config.get("verify_mode", "off"), VERIFY_MODE_LABELS["off"]))
+        self.verify_mode_dropdown = ctk.CTkComboBox(options_grid, variable=self.verify_mode_var, values=list(VERIFY_MODE_LABELS.values()), state="readonly", command=self.on_apply_options_changed)
+        self.verify_mode_dropdown.grid(row=8, column=0, padx=15, pady=(0, 10), sticky="ew")
         
     def create_action_section(self):
         action_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
         action_frame.pack(fill="x", padx=20, pady=10)
         self.start_btn = ctk.CTkButton(action_frame, text="🚀 Create Windows2Go Drive", command=self.start_installation, height=45, font=ctk.CTkFont(size=16, weight="bold"))
         self.start_btn.pack(side="left", expand=True, padx=(0, 5))
+        self.verify_btn = ctk.CTkButton(action_frame, text="🔍 Verify Drive", command=self.start_verification, height=45, font=ctk.CTkFont(size=16, weight="bold"), state="disabled")
+        self.verify_btn.pack(side="left", expand=True, padx=5)
         self.stop_btn = ctk.CTkButton(action_frame, text="⏹️ STOP", command=self.stop_installation, height=45, font=ctk.CTkFont(size=16, weight="bold"), state="disabled", fg_color="#D32F2F", hover_color="#B71C1C")
         self.stop_btn.pack(side="left", expand=True, padx=(5, 0))
         
@@ -212,84 +3308,137 @@ class WindowsToGoCreator:
             self.config["last_iso_path"] = file_path
             self.save_config()
             self.log_message(f"Selected ISO: {os.path.basename(file_path)}")
-            self.validate_iso_file(file_path)
+            self.validate_iso_file_async(file_path)
+
+    def validate_iso_file_async(self, file_path: str):
+        self.image_dropdown.configure(values=["Reading editions..."]); self.image_var.set("Reading editions...")
+        threading.Thread(target=self.validate_iso_file, args=(file_path,), name="iso-validation", daemon=True).start()
 
     def validate_iso_file(self, file_path: str):
+        """Checks the ISO and lists its editions. Safe to run off the UI thread."""
         try:
             file_size_gb = os.path.getsize(file_path) / (1024 ** 3)
             self.log_message(f"ISO file size: {file_size_gb:.2f} GB")
             if not (3 < file_size_gb < 20): self.log_message("Warning: Unusual ISO file size.", "warning")
             else: self.log_message("ISO file size appears valid.", "success")
-        except Exception as e: self.log_message(f"Error validating ISO file: {str(e)}", "error")
-
-    def get_usb_drives(self) -> List[Dict]:
-        usb_drives = []
-        try:
-            # Use PowerShell instead of wmic (wmic is deprecated/removed in Windows 11 24H2+)
-            ps_script = (
-                "Get-PhysicalDisk | Where-Object { $_.BusType -eq 'USB' } | "
-                "Select-Object DeviceId, FriendlyName, Size | "
-                "ConvertTo-Json -Compress"
-            )
-            command = ['powershell', '-NoProfile', '-NonInteractive', '-Command', ps_script]
-            proc = subprocess.run(command, capture_output=True, text=True, check=True,
-                                  creationflags=subprocess.CREATE_NO_WINDOW)
-            output = proc.stdout.strip()
-            if not output:
-                return []
-
-            import json as _json
-            raw = _json.loads(output)
-            # PowerShell returns a single object (dict) if only one disk, or a list
-            if isinstance(raw, dict):
-                raw = [raw]
-
-            for disk in raw:
-                try:
-                    index = int(disk["DeviceId"])
-                    size_bytes = int(disk["Size"])
-                    size_gb = size_bytes / (1024 ** 3)
-                    if size_gb < 1:
-                        continue
-                    model = disk.get("FriendlyName", "Unknown USB Drive")
-                    mountpoint = f"Disk {index}"
-                    for part in psutil.disk_partitions(all=True):
-                        if f'PhysicalDrive{index}' in part.device:
-                            mountpoint = part.mountpoint
-                            break
-                    usb_drives.append({
-                        'device': mountpoint, 'index': index, 'model': model,
-                        'total_gb': size_gb,
-                        'display_name': f"{mountpoint} (Disk {index}) - {model} ({size_gb:.1f} GB)"
-                    })
-                except (ValueError, KeyError):
-                    continue
+            images: List[Dict] = []
+            with IsoImage(file_path) as iso:
+                image = find_image_in_iso(iso)
+                file_system = iso.file_system
+                if image is not None:
+                    try: images = read_wim_images_from_iso(iso, image)
+                    except WimFormatError as e: self.log_message(f"Could not read the editions in {image.path}: {e}", "warning")
+            if image is None:
+                self.log_message(f"The ISO ({file_system}) contains neither sources/install.wim nor sources/install.esd.", "error")
+            else:
+                self.log_message(f"Found {image.path} ({image.size / (1024 ** 3):.2f} GB) in the {file_system} file system.", "success")
+            self.call_in_ui(self.set_available_images, images)
+        except IsoFormatError as e:
+            self.log_message(f"The ISO file appears to be damaged: {str(e)}", "error"); self.call_in_ui(self.set_available_images, [])
         except Exception as e:
-            self.log_message(f"Error detecting USB drives: {str(e)}", "error")
-        return usb_drives
+            self.log_message(f"Error validating ISO file: {str(e)}", "error"); self.call_in_ui(self.set_available_images, [])
+
+    def set_available_images(self, images: List[Dict]):
+        self.available_images = images
+        if not images:
+            placeholder = f"Editions unknown - index {self.config.get('image_index', 1)} will be used"
+            self.image_dropdown.configure(values=[placeholder]); self.image_var.set(placeholder)
+            return
+        names = [describe_wim_image(image) for image in images]
+        self.image_dropdown.configure(values=names)
+        preferred = next((n for i, n in zip(images, names) if i['index'] == self.config.get("image_index", 1)), names[0])
+        self.image_var.set(preferred)
+        self.log_message(f"Found {len(images)} edition(s): " + ", ".join(f"{i['index']}: {i['name']}" for i in images))
+
+    def on_image_selected(self, choice: str):
+        image = next((i for i in self.available_images if describe_wim_image(i) == choice), None)
+        if image:
+            self.config["image_index"] = image['index']
+            self.save_config()
+
+    def on_apply_options_changed(self, *args):
+        self.config["apply_mode"] = next((mode for mode, label in APPLY_MODE_LABELS.items() if label == self.apply_mode_var.get()), "standard")
+        self.config["portable_tuning"] = list(PORTABLE_TWEAKS) if self.tuning_var.get() else []
+        self.config["install_mode"] = "refresh" if self.refresh_var.get() else "clean"
+        self.config["verify_mode"] = next((mode for mode, label in VERIFY_MODE_LABELS.items() if label == self.verify_mode_var.get()), "off")
+        self.save_config()
+
+    def get_selected_image(self) -> Optional[Dict]:
+        return next((i for i in self.available_images if describe_wim_image(i) == self.image_var.get()), None)
+
+    def get_image_by_index(self, index: int) -> Optional[Dict]:
+        return next((i for i in self.available_images if i['index'] == index), None)
 
     def refresh_drives(self):
+        """Asks the drive inventory for a rescan; the list updates when it finishes."""
         self.log_message("Refreshing USB drives list...")
-        self.available_drives = self.get_usb_drives()
-        if self.available_drives:
-            drive_names = [drive['display_name'] for drive in self.available_drives]
+        if not self.drive_inventory.scanned: self.drive_dropdown.set("Scanning for USB drives...")
+        self.drive_inventory.refresh()
+
+    def on_drives_changed(self, drives: List[Dict], added: List[Dict], removed: List[Dict], changed: List[Dict]):
+        """Runs on the UI thread with the latest inventory and what changed since the previous one."""
+        self.available_drives = drives
+        for drive in added: self.log_message(f"USB drive connected: {drive['display_name']}")
+        for drive in removed: self.log_message(f"USB drive removed: {drive['display_name']}", "warning")
+        if drives:
+            drive_names = [drive['display_name'] for drive in drives]
             self.drive_dropdown.configure(values=drive_names)
-            if self.drive_var.get() not in drive_names:
+            if self.drive_var.get() not in drive_names and not self.is_installing:
                 self.drive_var.set(drive_names[0])
-            self.log_message(f"Found {len(self.available_drives)} USB drive(s).")
+            self.log_message(f"Found {len(drives)} USB drive(s).")
         else:
             self.drive_dropdown.configure(values=["No USB drives detected"])
-            self.drive_dropdown.set("No USB drives detected")
+            if not self.is_installing: self.drive_dropdown.set("No USB drives detected")
             self.log_message("No USB drives detected.", "warning")
 
     def log_message(self, message: str, level: str = "info", end: str = "\n"):
+        """Queues a log line for the UI. Safe to call from any thread."""
         timestamp = time.strftime("%H:%M:%S")
         prefix = {"error": "❌", "warning": "⚠️", "success": "✅"}.get(level, "ℹ️")
-        self.log_text.insert("end", f"[{timestamp}] {prefix} {message}{end}")
+        self.events.post("log", f"[{timestamp}] {prefix} {message}{end}")
+
+    def set_progress(self, value: Optional[float] = None, label: Optional[str] = None):
+        """Queues a progress bar and/or label update. Safe to call from any thread."""
+        if value is not None: self.events.post("progress", value)
+        if label is not None: self.events.post("label", label)
+
+    def call_in_ui(self, function: Callable, *args):
+        """Runs function(*args) on the UI thread, after the log lines queued before it."""
+        self.events.post("call", function, args)
+
+    def process_events(self):
+        """Drains queued events on the UI thread: log text is inserted in one batch and progress is coalesced."""
+        log_chunks: List[str] = []
+        progress: Optional[float] = None
+        label: Optional[str] = None
+        def flush():
+            nonlocal log_chunks, progress, label
+            if log_chunks: self._append_log("".join(log_chunks)); log_chunks = []
+            if progress is not None: self.progress_bar.set(progress); progress = None
+            if label is not None: self.progress_label.configure(text=label); label = None
+        try:
+            for event in self.events.drain():
+                kind = event[0]
+                if kind == "log": log_chunks.append(event[1])
+                elif kind == "progress": progress = event[1]
+                elif kind == "label": label = event[1]
+                elif kind == "call":
+                    flush()
+                    event[1](*event[2])
+            flush()
+        finally:
+            self._events_job = self.root.after(UI_DRAIN_INTERVAL_MS, self.process_events)
+
+    def _append_log(self, text: str):
+        if self.log_file:
+            try: self.log_file.write(text); self.log_file.flush()
+            except OSError: self.log_file = None
+        self.log_text.insert("end", text)
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - LOG_WIDGET_MAX_LINES
+        if excess > 0: self.log_text.delete("1.0", f"{excess + 1}.0")
         self.log_text.see("end")
-        self.root.update_idletasks()
 
-    def validate_inputs(self) -> bool:
+    def validate_inputs(self, verify_only: bool = False) -> bool:
         if not self.selected_iso_path or not os.path.exists(self.selected_iso_path):
             messagebox.showerror("Validation Error", "Please select a valid Windows ISO file.")
             return False
@@ -300,13 +3449,52 @@ class WindowsToGoCreator:
         if not self.selected_drive:
             messagebox.showerror("Validation Error", "Selected drive not found. Please refresh.")
             return False
+        image = self.get_selected_image()
+        self.selected_image_index = image['index'] if image else int(self.config.get("image_index", 1))
+        if verify_only: return True  # Nothing is written
+        placement_error = iso_placement_error(self.config, self.selected_iso_path, self.selected_drive)
+        if placement_error:
+            messagebox.showerror("Validation Error", placement_error)
+            return False
+        if not self.check_known_drive_speed(image): return False
+        if image and image['expanded_bytes']:
+            required_gb = image['expanded_bytes'] / (1024 ** 3) + WTG_SPACE_MARGIN_GB
+            if self.selected_drive['total_gb'] < required_gb:
+                messagebox.showerror("Validation Error", f"USB drive is too small. '{image['name']}' expands to {image['expanded_bytes'] / (1024 ** 3):.1f} GB and needs a drive of at least {required_gb:.1f} GB.")
+                return False
+            return True
         iso_size_gb = os.path.getsize(self.selected_iso_path) / (1024 ** 3)
         if self.selected_drive['total_gb'] < iso_size_gb + 5: # WTG needs more buffer space
             messagebox.showerror("Validation Error", "USB drive is too small. A Windows To Go installation requires more space than the ISO file size.")
             return False
         return True
 
+    def check_known_drive_speed(self, image: Optional[Dict]) -> bool:
+        """Uses a saved benchmark of the selected drive, if any, to refuse or warn before anything is written."""
+        result = load_benchmark_results().get(drive_benchmark_key(self.selected_drive))
+        if not result or not self.config.get("benchmark_enabled", True): return True
+        level, summary = benchmark_verdict(result, self.config)
+        estimate = estimate_apply_seconds(result, image['expanded_bytes'] if image else 0, image['file_count'] if image else 0)
+        if estimate: summary += f"\nEstimated image apply time: about {estimate / 60:.1f} minutes."
+        if level == "block":
+            messagebox.showerror("Drive Too Slow", f"This drive measured too slow for Windows To Go.\n\n{summary}")
+            return False
+        if level == "warn":
+            return messagebox.askyesno("Slow Drive", f"This drive measured slow; Windows may be barely usable from it.\n\n{summary}\n\nContinue anyway?")
+        self.log_message(f"Known drive performance {summary.replace(chr(10), ' ')}", "info")
+        return True
+
     def confirm_installation(self) -> bool:
+        if self.config.get("install_mode", "clean") == "refresh":
+            return messagebox.askyesno("Confirm Update", f"""
+        The Windows installation on:
+        {self.selected_drive['display_name']}
+
+        will be updated in place to the selected image. Files that are not part of the
+        new image (including user files) are deleted.
+
+        Continue?
+        """)
         return messagebox.askyesno("Confirm Installation", f"""
         \n⚠️ FINAL WARNING ⚠️
         This will PERMANENTLY DESTROY all data on:
@@ -321,193 +3509,89 @@ class WindowsToGoCreator:
         if not self.confirm_installation(): self.log_message("Installation cancelled by user."); return
         self.save_config()
         self.is_installing = True
+        self.cancel_event.clear()
         self.toggle_ui_state(False)
-        self.progress_bar.set(0)
+        self.set_progress(0)
         self.installation_thread = threading.Thread(target=self.installation_worker, daemon=True)
         self.installation_thread.start()
 
+    def start_verification(self):
+        """Checks the files on the selected drive against the selected edition, without writing to the drive."""
+        if self.is_installing: return
+        if not self.validate_inputs(verify_only=True): return
+        self.is_installing = True
+        self.cancel_event.clear()
+        self.toggle_ui_state(False)
+        self.set_progress(0)
+        self.installation_thread = threading.Thread(target=lambda: self.installation_worker(verify_only=True), daemon=True)
+        self.installation_thread.start()
+
     def stop_installation(self):
         if not self.is_installing: return
         if messagebox.askyesno("Stop Installation", "Are you sure you want to stop?"):
             self.log_message("Stop signal received. Terminating...", "warning")
             self.is_installing = False
-            if self.current_process:
-                try: self.current_process.terminate()
-                except Exception as e: self.log_message(f"Could not terminate: {e}", "error")
+            self.cancel_running_processes()
+
+    def cancel_running_processes(self):
+        self.cancel_event.set()
+        if self.session: self.session.cancel()
 
     def toggle_ui_state(self, enabled: bool):
         state, stop_state = ("normal", "disabled") if enabled else ("disabled", "normal")
-        for widget in [self.start_btn, self.browse_iso_btn, self.refresh_drives_btn, self.drive_dropdown]:
+        for widget in [self.start_btn, self.verify_btn, self.browse_iso_btn, self.refresh_drives_btn, self.drive_dropdown, self.apply_mode_dropdown,
+                       self.tuning_checkbox, self.refresh_checkbox, self.verify_mode_dropdown]:
             widget.configure(state=state)
         self.stop_btn.configure(state=stop_state)
 
-    def _run_subprocess(self, command: List[str], progress_callback: Optional[Callable[[int], None]] = None):
-        try:
-            self.current_process = subprocess.Popen(
-                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                text=True, encoding='utf-8', errors='replace',
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            output_lines = []
-            for line in iter(self.current_process.stdout.readline, ''):
-                if not self.is_installing: self.current_process.terminate(); raise SubprocessError("Installation stopped by user.")
-                output_lines.append(line)
-                if progress_callback:
-                    # Generic progress regex for DISM: [====== 20.0% ]
-                    match = re.search(r'\[=*\s*(\d{1,3}(?:\.\d)?)\s*%\s*\]', line)
-                    if match: progress_callback(float(match.group(1))); continue
-                    # Progress regex for 7-Zip: "  1% ..."
-                    match = re.search(r'^\s*(\d{1,3})%\s', line)
-                    if match: progress_callback(int(match.group(1))); continue
-                if '\r' not in line.strip(): self.log_text.insert("end", line); self.log_text.see("end"); self.root.update_idletasks()
-            self.current_process.wait()
-            full_output = "".join(output_lines)
-            is_robocopy = command[0].lower() == 'robocopy'
-            failed = (is_robocopy and self.current_process.returncode >= 8) or (not is_robocopy and self.current_process.returncode != 0)
-            if failed:
-                raise SubprocessError(f"Command `{' '.join(command)}` failed with exit code {self.current_process.returncode}.", full_output)
-        except FileNotFoundError:
-            raise SubprocessError(f"Command not found: {command[0]}", "Ensure the executable is in the correct directory or system PATH.")
-        except Exception as e:
-            if not isinstance(e, SubprocessError): raise SubprocessError(f"An unexpected error occurred: {e}")
-            else: raise e
-        finally:
-            self.current_process = None
+    def _record_phase_durations(self, durations: Dict[str, float]):
+        record_phase_durations(self.config, durations)
+        self.save_config()
 
-    def installation_worker(self):
+    def installation_worker(self, verify_only: bool = False):
+        config = {**self.config, "install_mode": "verify"} if verify_only else self.config
+        self.session = InstallSession(config, self.selected_iso_path, self.log_message,
+                                      lambda text: self.events.post("log", text), self.cancel_event, self.tool_broker)
         try:
-            self.log_message("🚀 Starting Windows To Go creation process...")
-            self.progress_label.configure(text="Phase 1/4: Extracting ISO..."); self.extract_iso()
-            self.progress_label.configure(text="Phase 2/4: Preparing USB drive..."); self.prepare_usb_drive()
-            self.progress_label.configure(text="Phase 3/4: Applying Windows Image..."); self.apply_windows_image()
-            self.progress_label.configure(text="Phase 4/4: Creating boot files..."); self.make_bootable()
-            self.progress_bar.set(1.0)
-            self.progress_label.configure(text="Creation completed successfully!")
-            self.log_message("✅ Windows To Go drive created successfully!", "success")
-            messagebox.showinfo("Success", "Windows To Go drive has been created successfully!")
+            self.log_message("🔍 Verifying the drive against the image..." if verify_only else "🚀 Starting Windows To Go creation process...")
+            image = self.get_image_by_index(self.selected_image_index)
+            refresh = config.get("install_mode", "clean") == "refresh"
+            journal = InstallJournal(self.selected_drive['index']) if config.get("resume_enabled", True) and not (refresh or verify_only) else None
+            target = DriveTarget(self.session, self.selected_drive, self.selected_image_index, image['name'] if image else "",
+                                 journal=journal, expanded_bytes=image['expanded_bytes'] if image else 0,
+                                 file_count=image['file_count'] if image else 0)
+            if journal: target.plan_resume(fingerprint_file(self.selected_iso_path))
+            if "apply" not in target.resume_phases or config.get("verify_mode", "off") != "off":
+                self.session.plan_workspace(target_volume_roots(self.selected_drive, self.session.tools, self.tool_broker))
+            phases = build_install_phases(self.session, [target], config.get("phase_durations"))
+            scheduler = PhaseScheduler(phases, lambda fraction, label: self.set_progress(fraction, label),
+                                       self.cancel_event, self.session.cancel, tracer=self.session.tracer)
+            self.session.tracer.metadata.update(iso=os.path.basename(self.selected_iso_path),
+                                                disks=[target.disk_index], image_index=self.selected_image_index)
+            durations = scheduler.run()
+            failed = next((phase for phase in phases if phase.status == "failed"), None)
+            if failed: raise failed.error  # A phase that does not stop the others, e.g. reading the image for verification
+            self.log_message("Phase timings: " + (self.session.tracer.summary() or
+                                                  ", ".join(f"{name} {seconds:.1f}s" for name, seconds in durations.items())))
+            self.call_in_ui(self._record_phase_durations, durations)
+            if verify_only:
+                self.set_progress(1.0, "Verification passed")
+                self.call_in_ui(messagebox.showinfo, "Verification Passed", "The checked files on the drive match the image.")
+            else:
+                self.set_progress(1.0, "Creation completed successfully!")
+                self.log_message("✅ Windows To Go drive created successfully!", "success")
+                self.call_in_ui(messagebox.showinfo, "Success", "Windows To Go drive has been created successfully!")
         except Exception as e:
-            self.log_message(f"❌ Creation failed: {str(e)}", "error")
+            self.log_message(f"❌ {'Verification' if verify_only else 'Creation'} failed: {str(e)}", "error")
             if self.is_installing:
-                messagebox.showerror("Creation Failed", str(e))
+                self.call_in_ui(messagebox.showerror, "Verification Failed" if verify_only else "Creation Failed", str(e))
         finally:
-            self._cleanup()
+            self.session.cleanup()
+            trace_path = self.session.tracer.export()
+            if trace_path: self.log_message(f"Performance trace written to {trace_path}")
             self.is_installing = False
-            self.toggle_ui_state(True)
+            self.call_in_ui(self.toggle_ui_state, True)
             
-    def _cleanup(self):
-        if self.temp_iso_extract_path and os.path.exists(self.temp_iso_extract_path):
-            self.log_message(f"Cleaning up temporary directory...")
-            shutil.rmtree(self.temp_iso_extract_path, ignore_errors=True)
-            self.temp_iso_extract_path = None
-            self.log_message("Cleanup complete.")
-    
-    def _get_drive_letter_for_disk(self, disk_index: int) -> str:
-        self.log_message(f"Querying diskpart for the new drive letter for Disk {disk_index}...", "info")
-        script_content_list = "list volume\nexit"
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt', encoding='utf-8') as sf:
-            sf.write(script_content_list)
-            script_path = sf.name
-        try:
-            proc = subprocess.run(
-                ['diskpart', '/s', script_path], capture_output=True, text=True, check=True,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
-            for line in proc.stdout.splitlines():
-                if "WindowsUSB" in line:
-                    parts = line.split()
-                    if len(parts) > 2 and re.match(r'^[A-Z]$', parts[2]):
-                        drive_letter = f"{parts[2]}:\\"
-                        self.log_message(f"Diskpart assigned drive letter: {drive_letter}", "success")
-                        return drive_letter
-            raise RuntimeError("Could not find the 'WindowsUSB' volume in 'list volume' output.")
-        finally:
-            os.remove(script_path)
-
-    def extract_iso(self):
-        def update_extraction_progress(percent: int):
-            progress_value = 0.05 + (percent / 100) * 0.15
-            self.progress_bar.set(progress_value)
-            self.progress_label.configure(text=f"Phase 1/4: Extracting ISO... ({percent}%)")
-        self.progress_bar.set(0.05)
-        self.log_message("Creating temporary directory for ISO extraction...")
-        self.temp_iso_extract_path = tempfile.mkdtemp(prefix="win-togo-")
-        self.log_message(f"Extracting to: {self.temp_iso_extract_path}", "info")
-        command = [SEVEN_ZIP_EXECUTABLE, 'x', self.selected_iso_path, f'-o{self.temp_iso_extract_path}', '-y', '-bsp1']
-        self._run_subprocess(command, progress_callback=update_extraction_progress)
-        
-    def prepare_usb_drive(self):
-        self.progress_bar.set(0.20)
-        disk_index = self.selected_drive['index']
-        script_content_format = f"""
-        automount enable
-        select disk {disk_index}
-        clean
-        create partition primary
-        select partition 1
-        active
-        format fs=NTFS quick label=WindowsUSB
-        assign
-        exit
-        """
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt', encoding='utf-8') as sf:
-            sf.write(script_content_format.strip()); script_path = sf.name
-        self.log_message(f"Executing diskpart to format Disk {disk_index}...", "warning")
-        try:
-            self._run_subprocess(['diskpart', '/s', script_path])
-        finally:
-            os.remove(script_path)
-        self.target_drive_letter = self._get_drive_letter_for_disk(disk_index)
-
-    def apply_windows_image(self):
-        """Applies the Windows image using DISM."""
-        def update_apply_progress(percent: float):
-            progress_value = 0.25 + (percent / 100) * 0.65
-            self.progress_bar.set(progress_value)
-            self.progress_label.configure(text=f"Phase 3/4: Applying Windows Image... ({int(percent)}%)")
-
-        self.progress_bar.set(0.25)
-        if not self.target_drive_letter:
-            raise RuntimeError("Cannot apply image because the target drive letter was not determined.")
-        
-        sources_dir = os.path.join(self.temp_iso_extract_path, "sources")
-        wim_file = os.path.join(sources_dir, "install.wim")
-        esd_file = os.path.join(sources_dir, "install.esd")
-        
-        image_file_path = ""
-        if os.path.exists(wim_file):
-            image_file_path = wim_file
-        elif os.path.exists(esd_file):
-            image_file_path = esd_file
-        else:
-            raise RuntimeError("Could not find install.wim or install.esd in the ISO's sources directory.")
-            
-        self.log_message(f"Found Windows image file: {os.path.basename(image_file_path)}", "info")
-        self.log_message("Applying image with DISM. This is the longest step and may take a very long time...", "info")
-        
-        # NOTE: We are defaulting to Index:1. A more advanced version could parse the WIM for all indexes.
-        command = [
-            'dism', '/Apply-Image', f'/ImageFile:{image_file_path}',
-            '/Index:1', f'/ApplyDir:{self.target_drive_letter}'
-        ]
-        self._run_subprocess(command, progress_callback=update_apply_progress)
-
-    def make_bootable(self):
-        """Creates boot files using BCDBoot."""
-        self.progress_bar.set(0.95)
-        if not self.target_drive_letter:
-            raise RuntimeError("Cannot make drive bootable because the target drive letter was not determined.")
-
-        windows_dir = os.path.join(self.target_drive_letter, 'Windows')
-        drive_letter = self.target_drive_letter.strip('\\')
-        
-        self.log_message(f"Creating boot files on {drive_letter} using BCDBoot...", "info")
-        
-        # /f ALL creates boot files for both BIOS and UEFI systems for maximum compatibility.
-        command = [
-            'bcdboot', windows_dir, '/s', drive_letter, '/f', 'ALL'
-        ]
-        self._run_subprocess(command)
-
     def run(self):
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.root.mainloop()
@@ -516,10 +3600,23 @@ class WindowsToGoCreator:
         if self.is_installing:
             if messagebox.askokcancel("Quit", "Installation in progress. Quit anyway?"):
                 self.is_installing = False
-                self.root.after(500, self.root.destroy)
+                self.cancel_running_processes()
+                self.root.after(500, self._shutdown)
         else:
-            self.root.destroy()
+            self._shutdown()
+
+    def _shutdown(self):
+        self.drive_inventory.stop()
+        if self.tool_broker: self.tool_broker.close()
+        self.process_events()
+        self.root.after_cancel(self._events_job)
+        if self.log_file: self.log_file.close(); self.log_file = None
+        self.root.destroy()
 
 if __name__ == "__main__":
+    if "--headless" in sys.argv[1:]:
+        sys.exit(run_headless([a for a in sys.argv[1:] if a != "--headless"]))
+    if "--benchmark" in sys.argv[1:]:
+        sys.exit(run_benchmark([a for a in sys.argv[1:] if a != "--benchmark"]))
     app = WindowsToGoCreator()
     app.run()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Measures how fast a running tool is stopped, and checks stall and timeout detection.
+
+A stand-in tool starts a child process that shares its output pipe (as DISM does with DismHost)
+and then hangs in one of several ways: silently, after printing a line, while printing forever,
+silently while doing disk I/O, or ignoring terminate(). Each scenario runs the stand-in through
+InstallSession.run_tool with limits from "phase_limits", then checks the error raised, the time it
+took, and that no process of the tree is left running. A hanging command in the diskpart session
+is cancelled as well.
+
+Usage:
+    python benchmarks/cancellation.py [--max-latency-ms 1000]
+"""
+
+import argparse
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+HANGING_TOOL = r'''
+import os, signal, subprocess, sys, time
+mode, pidfile = sys.argv[1], sys.argv[2]
+if mode == "ignore-terminate" and hasattr(signal, "SIGTERM"): signal.signal(signal.SIGTERM, signal.SIG_IGN)
+child = subprocess.Popen([sys.executable, "-c", "import time\nwhile True: time.sleep(1)"])  # Inherits the output pipe
+with open(pidfile, "w") as f: f.write("%d %d" % (os.getpid(), child.pid))
+if mode == "stall":
+    print("Starting...", flush=True)
+elif mode == "chatty":
+    while True: print(".", flush=True); time.sleep(0.1)
+elif mode == "io":
+    with open(pidfile + ".data", "wb") as f:
+        while True: f.seek(0); f.write(b"\0" * 65536); f.flush(); os.fsync(f.fileno()); time.sleep(0.05)
+while True: time.sleep(1)
+'''
+
+HANGING_DISKPART = r'''
+import sys, time
+print("\nMicrosoft DiskPart version 10.0 (fake)")
+while True:
+    sys.stdout.write("\nDISKPART> "); sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line: break
+    if line.strip().lower() == "clean":
+        while True: time.sleep(1)
+'''
+
+# (name, stand-in mode, limits, cancel after seconds, expected error, expected message part)
+SCENARIOS = [
+    ("silent, cancelled", "silent", {}, 0.5, w2g.InstallationCancelled, ""),
+    ("ignores terminate, cancelled", "ignore-terminate", {}, 0.5, w2g.InstallationCancelled, ""),
+    ("stalls after output", "stall", {"stall": 1.0}, None, w2g.ToolTimeoutError, "no progress"),
+    ("prints forever", "chatty", {"timeout": 1.5, "stall": 1.0}, None, w2g.ToolTimeoutError, "did not finish"),
+    ("silent but doing I/O", "io", {"timeout": 2.5, "stall": 1.0}, None, w2g.ToolTimeoutError, "did not finish"),
+]
+
+def write_tool(directory: str, name: str, source: str) -> str:
+    path = os.path.join(directory, name)
+    with open(path, "w") as f: f.write(f"#!{sys.executable}\n{source}")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+def still_running(pids) -> list:
+    import psutil
+    running = []
+    for pid in pids:
+        try:
+            if psutil.Process(pid).status() != psutil.STATUS_ZOMBIE: running.append(pid)
+        except psutil.NoSuchProcess:
+            pass
+    return running
+
+def run_scenario(work: str, name: str, mode: str, limits: dict, cancel_after, expected, message: str):
+    pidfile = os.path.join(work, f"{mode}.pid")
+    config = {**w2g.default_config(), "tool_paths": {"hang": os.path.join(work, "hang")}, "trace_enabled": False,
+              "phase_limits": {"test": limits}}
+    session = w2g.InstallSession(config, "", lambda *a: None)
+    if cancel_after is not None: threading.Timer(cancel_after, session.cancel).start()
+    start = time.monotonic()
+    try:
+        session.run_tool("hang", [mode, pidfile], phase="test")
+        error = None
+    except w2g.SubprocessError as e:
+        error = e
+    ended = time.monotonic()
+    reference = session.cancel_requested_at or start
+    with open(pidfile) as f: pids = [int(pid) for pid in f.read().split()]
+    time.sleep(0.2)  # Let the system reap the stopped processes
+    problems = []
+    if type(error) is not expected: problems.append(f"raised {type(error).__name__}, expected {expected.__name__}")
+    elif message not in str(error): problems.append(f"message '{str(error).splitlines()[0]}' lacks '{message}'")
+    if still_running(pids): problems.append(f"processes still running: {still_running(pids)}")
+    return name, ended - reference, str(error).splitlines()[0] if error else "", problems
+
+def run_diskpart_scenario(work: str):
+    config = {**w2g.default_config(), "tool_paths": {"diskpart": os.path.join(work, "diskpart")}, "trace_enabled": False}
+    session = w2g.InstallSession(config, "", lambda *a: None)
+    threading.Timer(0.5, session.cancel).start()
+    try:
+        session.run_diskpart("select disk 1\nclean\nexit")
+        error = None
+    except w2g.SubprocessError as e:
+        error = e
+    latency = time.monotonic() - session.cancel_requested_at
+    problems = [] if isinstance(error, w2g.InstallationCancelled) else [f"raised {type(error).__name__}"]
+    session.cleanup()
+    return "diskpart session, cancelled", latency, str(error).splitlines()[0] if error else "", problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-latency-ms", type=float, default=1000,
+                        help="Budget for stopping a tool after cancel (plus the kill grace for tools that ignore terminate)")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="w2g-cancel-") as work:
+        write_tool(work, "hang", HANGING_TOOL)
+        write_tool(work, "diskpart", HANGING_DISKPART)
+        for scenario in SCENARIOS:
+            if scenario[1] == "ignore-terminate" and os.name == "nt": continue  # terminate() can't be ignored on Windows
+            results.append(run_scenario(work, *scenario))
+        results.append(run_diskpart_scenario(work))
+
+    failed = False
+    print(f"{'scenario':<30} {'stopped after':>13}  error")
+    for (name, seconds, error, problems), budget in zip(results, [s[3] for s in SCENARIOS] + [0.5]):
+        print(f"{name:<30} {seconds * 1000:10.0f} ms  {error}")
+        if "cancelled" in name:
+            limit = args.max_latency_ms / 1000 + (w2g.KILL_GRACE_SECONDS if "ignores" in name else 0)
+            if seconds > limit: problems.append(f"took longer than {limit * 1000:.0f} ms")
+        for problem in problems: print(f"  FAIL: {problem}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
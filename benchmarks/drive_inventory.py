@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Checks that DriveInventory with a stub enumeration backend sees the same drives as the PowerShell path.
+
+The stub backend hands DriveInventory plain disk lists in-process, the way it runs under test on
+Linux. The PowerShell path runs list_usb_disks against a scripted stand-in for PowerShell that prints
+the same disks as Get-PhysicalDisk JSON, once per process and through a ToolBroker session. After
+each hotplug step (insert, remove, new mountpoint, a single disk, which PowerShell returns as
+an object instead of a list, and a disk under 1 GB) the published drive lists and the added, removed
+and changed drives must match. A failing enumeration must be reported and keep the last drive list.
+It also prints how long a scan takes through each backend.
+
+Usage:
+    python benchmarks/drive_inventory.py [--scans 20]
+"""
+
+import argparse
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+FAKE_POWERSHELL = r'''
+import os, re, sys
+def run(line):
+    if "Write-Output '" in line and "__W2G_" in line and not line.startswith("try"):
+        print(re.search(r"'(.*)'", line).group(1)); return
+    if "Get-PhysicalDisk" in line:
+        with open(os.environ["FAKE_DISKS_FILE"]) as f: text = f.read()
+        if text == "fail": print("__W2G_ERROR__ Get-PhysicalDisk : Access denied"); sys.exit(1)
+        print(text)
+if "-Command" in sys.argv and sys.argv[sys.argv.index("-Command") + 1] != "-":
+    run(sys.argv[sys.argv.index("-Command") + 1]); sys.exit(0)
+for line in sys.stdin:
+    run(line.strip()); sys.stdout.flush()
+'''
+
+GB = 1000 ** 3
+
+def disk(index: int, model: str, size: int) -> dict:
+    return {"index": index, "model": model, "serial": f"SN{index}", "size_bytes": size}
+
+# Hotplug steps: (label, disks, mountpoints, expected (added, removed, changed) or None if nothing is published)
+STEPS = [
+    ("first scan", [disk(1, "Stick A", 64 * GB), disk(2, "Stick B", 32 * GB)], {1: "E:\\"}, ([1, 2], [], [])),
+    ("drive inserted", [disk(1, "Stick A", 64 * GB), disk(2, "Stick B", 32 * GB), disk(4, "Stick C", 128 * GB)], {1: "E:\\"}, ([4], [], [])),
+    ("nothing changed", [disk(1, "Stick A", 64 * GB), disk(2, "Stick B", 32 * GB), disk(4, "Stick C", 128 * GB)], {1: "E:\\"}, None),
+    ("drive removed", [disk(1, "Stick A", 64 * GB), disk(4, "Stick C", 128 * GB)], {1: "E:\\"}, ([], [2], [])),
+    ("volume mounted", [disk(1, "Stick A", 64 * GB), disk(4, "Stick C", 128 * GB)], {1: "E:\\", 4: "F:\\"}, ([], [], [4])),
+    ("single disk", [disk(4, "Stick C", 128 * GB)], {4: "F:\\"}, ([], [1], [])),
+    ("disk under 1 GB", [disk(4, "Stick C", 128 * GB), disk(5, "Card reader", 512 * 1024 ** 2)], {4: "F:\\"}, None),
+]
+
+def powershell_json(disks: list) -> str:
+    raw = [{"DeviceId": str(d["index"]), "FriendlyName": d["model"], "SerialNumber": d["serial"] + "  ", "Size": d["size_bytes"]}
+           for d in disks]
+    return json.dumps(raw[0] if len(raw) == 1 else raw)
+
+class Recorder:
+    """Collects what a DriveInventory publishes."""
+
+    def __init__(self):
+        self.changes, self.errors = [], []
+
+    def on_change(self, drives, added, removed, changed):
+        self.changes.append((drives, *[sorted(d["index"] for d in group) for group in (added, removed, changed)]))
+
+    def on_error(self, error):
+        self.errors.append(error)
+
+def timed(function, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count): function()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scans", type=int, default=20, help="Scans timed per backend")
+    args = parser.parse_args()
+
+    failures = []
+    def check(condition: bool, message: str):
+        if not condition: failures.append(message)
+
+    with tempfile.TemporaryDirectory(prefix="w2g-inventory-") as work:
+        disks_file = os.path.join(work, "disks.json")
+        os.environ["FAKE_DISKS_FILE"] = disks_file
+        path = os.path.join(work, "powershell")
+        with open(path, "w") as f: f.write(f"#!{sys.executable}\n{FAKE_POWERSHELL}")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        tools = w2g.resolve_tools({"tool_paths": {"powershell": path}})
+        broker = w2g.ToolBroker(tools)
+
+        state = {"disks": [], "mountpoints": {}}
+        backends = {
+            "stub": lambda: [dict(d) for d in state["disks"]],
+            "powershell": lambda: w2g.list_usb_disks(tools),
+            "powershell session": lambda: w2g.list_usb_disks(tools, broker),
+        }
+        recorders = {name: Recorder() for name in backends}
+        inventories = {name: w2g.DriveInventory(list_disks, recorders[name].on_change, recorders[name].on_error,
+                                                change_token=lambda: None, mountpoints=lambda: dict(state["mountpoints"]))
+                       for name, list_disks in backends.items()}
+
+        steps = []
+        for label, disks, mountpoints, expected_change in STEPS:
+            state.update(disks=disks, mountpoints=mountpoints)
+            with open(disks_file, "w") as f: f.write(powershell_json(disks))
+            expected = sorted(w2g.build_drive_list(disks, mountpoints), key=lambda d: d["index"])
+            published = {}
+            for name, inventory in inventories.items():
+                before = len(recorders[name].changes)
+                inventory.scan()
+                published[name] = recorders[name].changes[before:]
+                check(sorted(inventory.drives.values(), key=lambda d: d["index"]) == expected,
+                      f"{label}: {name} backend holds {sorted(inventory.drives)}, expected {[d['index'] for d in expected]}")
+            check(all(changes == published["stub"] for changes in published.values()),
+                  f"{label}: the backends published different changes: {published}")
+            check([change[1:] for change in published["stub"]] == ([expected_change] if expected_change else []),
+                  f"{label}: published {[change[1:] for change in published['stub']]}, expected {expected_change}")
+            steps.append((label, published["stub"][0][1:] if published["stub"] else None))
+
+        last = dict(inventories["powershell"].drives)
+        with open(disks_file, "w") as f: f.write("fail")
+        for name in ("powershell", "powershell session"):
+            check(not inventories[name].scan() and len(recorders[name].errors) == 1, f"{name}: a failing enumeration was not reported")
+        check(inventories["powershell"].drives == last, "a failing enumeration changed the drive list")
+
+        with open(disks_file, "w") as f: f.write(powershell_json(STEPS[1][1]))
+        state.update(disks=STEPS[1][1], mountpoints=STEPS[1][2])
+        rows = [(name, timed(inventories[name].scan, args.scans)) for name in backends]
+        broker.close()
+
+    print("Hotplug steps (stub backend; the PowerShell backends published the same)")
+    for label, change in steps:
+        print(f"  {label:<18} " + (f"added {change[0]}, removed {change[1]}, changed {change[2]}" if change else "nothing published"))
+    print(f"{args.scans} scans of {len(STEPS[1][1])} disks")
+    print(f"  {'backend':<20} {'ms per scan':>11}")
+    for name, seconds in rows: print(f"  {name:<20} {seconds / args.scans * 1000:11.2f}")
+    for message in failures: print(f"  FAIL: {message}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
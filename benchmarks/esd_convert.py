@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Estimates what converting an install.esd to a WIM saves, and checks the conversion cache.
+
+DISM applies an ESD at the speed LZMS decompresses on the CPU; a WIM exported with /Compress:fast
+(XPRESS) or max (LZX) decompresses several times faster. Neither codec is in the standard library,
+so the same kinds of codecs stand in: LZMA compressed in large solid blocks for LZMS (as ESD
+stores it), and DEFLATE in 32 KB chunks for XPRESS (level 1) and LZX (level 9), which are LZ77
+with Huffman coding like them. Real XPRESS decompresses faster than LZX, an order the DEFLATE
+levels do not reproduce, so the two rows bound what either export gains. The corpus is real
+files of the Python installation (program code, libraries, text). The run prints each codec's
+ratio and decompression throughput on one core, and the time an apply of --image-gb expanded
+bytes would spend decompressing.
+
+A fake DISM then checks InstallSession.convert_image: a first run exports the ESD into the WIM
+cache and later phases read index 1 of the export; a second session reuses it without running
+DISM; a run that may not convert leaves the ESD alone; a failed export falls back to the ESD
+without leaving anything behind; a small cache cap evicts the oldest export; and in the install
+graph the conversion runs alongside drive preparation, before the apply.
+
+Usage:
+    python benchmarks/esd_convert.py [--corpus-mb 64] [--image-gb 15]
+"""
+
+import argparse
+import lzma
+import os
+import stat
+import sys
+import sysconfig
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+WIM_CHUNK = 32 * 1024          # Chunk size of XPRESS and LZX resources in a WIM
+ESD_SOLID_BLOCK = 64 * 1024 ** 2  # LZMS solid resources in an ESD are compressed in large blocks
+
+FAKE_DISM = r'''
+import os, shutil, sys
+with open(os.environ["FAKE_DISM_LOG"], "a") as log: log.write(" ".join(sys.argv[1:]) + "\n")
+if "/Export-Image" in sys.argv:
+    source = next(a.split(":", 1)[1] for a in sys.argv if a.startswith("/SourceImageFile:"))
+    target = next(a.split(":", 1)[1] for a in sys.argv if a.startswith("/DestinationImageFile:"))
+    if "broken" in source:
+        print("Error: 4390\n\nThe file or directory is corrupted and unreadable."); sys.exit(4390)
+    shutil.copyfile(source, target)
+    print("Exporting image\n[==========================100.0%==========================]\nThe operation completed successfully.")
+'''
+
+def load_corpus(limit: int) -> bytes:
+    """Reads files of the Python installation, code and text alike, up to limit bytes."""
+    parts, total = [], 0
+    for directory, dirs, names in os.walk(sysconfig.get_paths()["stdlib"]):
+        dirs.sort()
+        for name in sorted(names):
+            try:
+                with open(os.path.join(directory, name), "rb") as f: data = f.read()
+            except OSError:
+                continue
+            parts.append(data); total += len(data)
+            if total >= limit: return b"".join(parts)[:limit]
+    return b"".join(parts)
+
+def measure(corpus: bytes, compress, decompress, block: int, repeat: int = 3) -> dict:
+    blocks = [compress(corpus[i:i + block]) for i in range(0, len(corpus), block)]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in blocks: decompress(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"ratio": sum(len(b) for b in blocks) / len(corpus), "mbps": len(corpus) / 1024 ** 2 / best}
+
+def codec_table(corpus: bytes) -> list:
+    return [
+        ("ESD: LZMS (LZMA, solid)", measure(corpus, lambda d: lzma.compress(d, preset=6), lzma.decompress, ESD_SOLID_BLOCK)),
+        ("WIM max: LZX (DEFLATE 9)", measure(corpus, lambda d: zlib.compress(d, 9), zlib.decompress, WIM_CHUNK)),
+        ("WIM fast: XPRESS (DEFLATE 1)", measure(corpus, lambda d: zlib.compress(d, 1), zlib.decompress, WIM_CHUNK)),
+    ]
+
+def write_dism(directory: str) -> str:
+    path = os.path.join(directory, "dism")
+    with open(path, "w") as f: f.write(f"#!{sys.executable}\n{FAKE_DISM}")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+def new_session(work: str, image_file: str, **config) -> w2g.InstallSession:
+    config = {**w2g.default_config(), "trace_enabled": False, "tool_sessions": False, "benchmark_enabled": False,
+              "tool_paths": {"dism": os.path.join(work, "dism")}, "wim_cache_dir": os.path.join(work, "wim-cache"), **config}
+    session = w2g.InstallSession(config, os.path.join(work, "test.iso"), lambda message, level="info": None)
+    session.image_file_path = image_file
+    return session
+
+def dism_runs(work: str) -> int:
+    try:
+        with open(os.path.join(work, "dism.log")) as f: return sum(1 for line in f if "/Export-Image" in line)
+    except OSError:
+        return 0
+
+def check_cache(work: str) -> list:
+    failures = []
+    def check(condition: bool, message: str):
+        if not condition: failures.append(message)
+    write_dism(work)
+    os.environ["FAKE_DISM_LOG"] = os.path.join(work, "dism.log")
+    esd, other, broken, wim = (os.path.join(work, name) for name in ("install.esd", "other.esd", "broken.esd", "install.wim"))
+    for path in (esd, other, broken, wim):
+        with open(path, "wb") as f: f.write(os.urandom(3 * 1024 * 1024))
+
+    session = new_session(work, wim)
+    session.convert_image(6)
+    check(session.image_source(6) == (wim, 6), "a WIM image was converted")
+
+    session = new_session(work, esd)
+    session.convert_image(6, convert=False)
+    check(session.image_source(6) == (esd, 6) and dism_runs(work) == 0, "an ESD was converted although conversion was not wanted")
+
+    session.convert_image(6)
+    source, index = session.image_source(6)
+    check(dism_runs(work) == 1, "the ESD was not exported")
+    check(index == 1 and source.startswith(os.path.join(work, "wim-cache")) and os.path.isfile(source),
+          f"later phases read {source} index {index}, not index 1 of the cached export")
+    check(session.tracer.metadata.get("convert", {}).get("cached") is False, "the export is not recorded in the trace metadata")
+
+    again = new_session(work, esd)
+    again.convert_image(6, convert=False)
+    check(again.image_source(6) == (source, 1), "a second session did not find the cached export")
+    check(dism_runs(work) == 1, "a cached export was made again")
+    again.cleanup()
+    check(again.converted_image is None and os.path.isfile(source), "cleanup removed the cached export or kept pointing at it")
+
+    failed = new_session(work, broken)
+    failed.convert_image(6)
+    check(failed.image_source(6) == (broken, 6), "a failed export did not fall back to the ESD")
+    check(not [n for n in os.listdir(os.path.join(work, "wim-cache")) if n.startswith(".staging-")], "a failed export left a staging directory")
+
+    capped = new_session(work, other, wim_cache_max_gb=4 / 1024)  # Room for one 3 MB export
+    capped.convert_image(6)
+    check(capped.converted_image and not os.path.exists(source), "the cache cap did not evict the older export")
+
+    targets = []
+    graph_session = new_session(work, esd)
+    for disk in (1, 2):
+        targets.append(w2g.DriveTarget(graph_session, {"index": disk, "model": "Fake", "device": ""}, image_index=6))
+    phases = {phase.name: phase for phase in w2g.build_install_phases(graph_session, targets)}
+    check(phases.get("convert") is not None and phases["convert"].depends_on == ("extract",), "no convert phase after extract")
+    check(all("convert" in phases[f"apply@{d}"].depends_on for d in (1, 2)), "the applies do not wait for the conversion")
+    check(all("convert" not in phases[f"prepare@{d}"].depends_on for d in (1, 2)), "drive preparation waits for the conversion")
+    single = w2g.build_install_phases(new_session(work, esd, esd_conversion="off"), targets[:1])
+    check("convert" not in {phase.name for phase in single}, "a convert phase was added with esd_conversion off")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus-mb", type=int, default=64, help="Bytes of real files compressed with each codec")
+    parser.add_argument("--image-gb", type=float, default=15, help="Expanded size of the image, for the apply estimate")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus_mb * 1024 ** 2)
+    rows = codec_table(corpus)
+    with tempfile.TemporaryDirectory(prefix="w2g-esd-") as work:
+        failures = check_cache(work)
+
+    esd_mbps = rows[0][1]["mbps"]
+    print(f"{len(corpus) / 1024 ** 2:.0f} MB of real files; decompression on one core, apply of {args.image_gb:.0f} GB expanded")
+    print(f"  {'image format (stand-in)':<30} {'ratio':>6} {'MB/s':>7} {'speedup':>8} {'decompress time':>16}")
+    for label, result in rows:
+        seconds = args.image_gb * 1024 / result["mbps"]
+        print(f"  {label:<30} {result['ratio']:6.1%} {result['mbps']:7.0f} {result['mbps'] / esd_mbps:7.1f}x {seconds / 60:12.1f} min")
+    print("  conversion cache: " + ("all checks passed" if not failures else f"{len(failures)} check(s) failed"))
+    for failure in failures: print(f"  FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
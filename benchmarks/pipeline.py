@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Runs the full install pipeline against fake 7z/diskpart/dism/bcdboot executables.
+
+The fake tools are small Python scripts that copy data at a configurable synthetic throughput
+and print the same progress output as the real ones, so scheduling, output parsing and UI-update
+overhead can be measured (and regression-tested) on Linux without touching a real disk. The run
+is traced like a real install; the per-phase spans are printed and the trace can be kept with
+--trace-dir.
+
+Usage:
+    python benchmarks/pipeline.py [--drives 4] [--parallel 2] [--image-mb 256] [--extract-mbps 400]
+                                  [--usb-mbps 120] [--format-seconds 1.0] [--cache] [--no-tool-sessions]
+"""
+
+import argparse
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+FAKE_7Z = r'''
+import os, sys, time
+image_mb, mbps = int(os.environ["FAKE_IMAGE_MB"]), float(os.environ["FAKE_EXTRACT_MBPS"])
+if sys.argv[1] == "l":
+    print("Path = sources/install.wim\nSize = %d\n" % (image_mb * 1024 * 1024)); sys.exit(0)
+out = next(a[2:] for a in sys.argv if a.startswith("-o"))
+os.makedirs(os.path.join(out, "sources"), exist_ok=True)
+print("Extracting archive: " + sys.argv[2], flush=True)
+block, status = b"\0" * (1024 * 1024), ""
+with open(os.path.join(out, "sources", "install.wim"), "wb") as f:
+    for mb in range(image_mb):
+        f.write(block)
+        time.sleep(1 / mbps)
+        new = "%3d%% 1 - sources\\install.wim" % ((mb + 1) * 100 // image_mb)
+        sys.stdout.write("\b" * len(status) + new); sys.stdout.flush(); status = new
+print("\nEverything is Ok")
+'''
+
+FAKE_DISKPART = r'''
+import os, re, sys, time
+def run(line, state):
+    match = re.match(r"select disk (\d+)", line)
+    if match:
+        state["disk"] = int(match.group(1)); print("\nDisk %d is now the selected disk." % state["disk"])
+    elif line == "detail disk":
+        print("\n  Volume ###  Ltr  Label        Fs     Type\n  ----------  ---  -----------  -----  ----------\n"
+              "  Volume %-4d  %s   WindowsUSB   NTFS   Removable" % (state["disk"], "DEFGHIJKLMNOPQRSTUVWXYZ"[state["disk"] % 23]))
+    elif line.startswith("format"):
+        time.sleep(float(os.environ["FAKE_FORMAT_SECONDS"])); print("\nDiskPart successfully formatted the volume.")
+    elif line.startswith("assign"):
+        print("\nDiskPart successfully assigned the drive letter or mount point.")
+state = {"disk": 0}
+if len(sys.argv) > 2 and sys.argv[1].lower() == "/s":
+    for line in open(sys.argv[2]).read().splitlines(): run(line.strip().lower(), state)
+    sys.exit(0)
+print("\nMicrosoft DiskPart version 10.0 (fake)")
+while True:
+    sys.stdout.write("\nDISKPART> "); sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line or line.strip().lower() == "exit": break
+    run(line.strip().lower(), state)
+'''
+
+FAKE_DISM = r'''
+import os, sys, time
+image = next(a.split(":", 1)[1] for a in sys.argv if a.startswith("/ImageFile:"))
+mbps = float(os.environ["FAKE_USB_MBPS"])
+size_mb = max(1, os.path.getsize(image) // (1024 * 1024))
+print("Deployment Image Servicing and Management tool\nApplying image", flush=True)
+with open(image, "rb") as f:
+    for mb in range(size_mb):
+        f.read(1024 * 1024)
+        time.sleep(1 / mbps)
+        percent = "%.1f%%" % ((mb + 1) * 100 / size_mb)
+        bar = ("=" * int((mb + 1) * 58 / size_mb)).ljust(58)
+        sys.stdout.write("\r[" + bar[:29 - len(percent) // 2] + percent + bar[29 - len(percent) // 2 + len(percent):] + "]"); sys.stdout.flush()
+print("\nThe operation completed successfully.")
+'''
+
+FAKE_BCDBOOT = r'''
+print("Boot files successfully created.")
+'''
+
+def write_tools(directory: str) -> dict:
+    paths = {}
+    for name, source in (("7z", FAKE_7Z), ("diskpart", FAKE_DISKPART), ("dism", FAKE_DISM), ("bcdboot", FAKE_BCDBOOT)):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f: f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        paths[name] = path
+    return paths
+
+class UiSimulator:
+    """Drains an EventBus on a timer like the Tk main loop and records how long each drain takes."""
+
+    def __init__(self, events: w2g.EventBus):
+        self.events, self.drains, self.handled = events, [], 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(w2g.UI_DRAIN_INTERVAL_MS / 1000):
+            start = time.perf_counter()
+            batch = self.events.drain()
+            self.handled += len(batch)
+            self.drains.append(time.perf_counter() - start)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set(); self._thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drives", type=int, default=4)
+    parser.add_argument("--parallel", type=int, default=2)
+    parser.add_argument("--image-mb", type=int, default=256, help="Size of the fake install.wim")
+    parser.add_argument("--extract-mbps", type=float, default=400, help="Synthetic 7-Zip extraction speed")
+    parser.add_argument("--usb-mbps", type=float, default=120, help="Synthetic DISM apply speed per drive")
+    parser.add_argument("--format-seconds", type=float, default=1.0, help="Time the fake diskpart takes to format")
+    parser.add_argument("--cache", action="store_true", help="Use the extraction cache (a second run is a cache hit)")
+    parser.add_argument("--no-tool-sessions", action="store_true", help="Start diskpart once per script instead of keeping a session")
+    parser.add_argument("--trace-dir", help="Keep the JSONL and Chrome traces of the run in this directory")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="w2g-bench-") as work:
+        os.environ.update(FAKE_IMAGE_MB=str(args.image_mb), FAKE_EXTRACT_MBPS=str(args.extract_mbps),
+                          FAKE_USB_MBPS=str(args.usb_mbps), FAKE_FORMAT_SECONDS=str(args.format_seconds))
+        iso_path = os.path.join(work, "fake.iso")
+        with open(iso_path, "wb") as f: f.write(os.urandom(64 * 1024))
+        config = {**w2g.default_config(), "tool_paths": write_tools(work), "extraction_mode": "selective",
+                  "cache_enabled": args.cache, "cache_dir": os.path.join(work, "cache"),
+                  "benchmark_enabled": False,  # The fake drives have no volume to measure
+                  "tool_sessions": not args.no_tool_sessions}
+        events = w2g.EventBus()
+        session = w2g.InstallSession(config, iso_path, lambda message, level="info": events.post("log", message),
+                                     lambda text: events.post("log", text))
+        drives = [{"index": i, "device": f"Disk {i}", "model": "Fake", "total_gb": 64.0, "display_name": f"Disk {i}"}
+                  for i in range(1, args.drives + 1)]
+        targets = [w2g.DriveTarget(session, drive, log_prefix=f"[Disk {drive['index']}] " if args.drives > 1 else "")
+                   for drive in drives]
+        phases = w2g.build_install_phases(session, targets)
+        progress_updates = [0]
+        def on_progress(fraction: float, label: str):
+            progress_updates[0] += 1
+            events.post("progress", fraction); events.post("label", label)
+        scheduler = w2g.PhaseScheduler(phases, on_progress, session.cancel_event, session.cancel,
+                                       max_workers=args.parallel + 1, limits={"drive": args.parallel},
+                                       tracer=session.tracer)
+        with UiSimulator(events) as ui:
+            start = time.perf_counter()
+            try: scheduler.run()
+            finally: session.cleanup()
+            elapsed = time.perf_counter() - start
+
+    extract_s = args.image_mb / args.extract_mbps
+    drive_s = args.format_seconds + args.image_mb / args.usb_mbps
+    waves = -(-args.drives // args.parallel)
+    ideal = max(extract_s, args.format_seconds) + args.image_mb / args.usb_mbps + (waves - 1) * drive_s
+    failed = [p.name for p in phases if p.status != "done"]
+    print(f"{args.drives} drive(s), {args.parallel} in parallel, {args.image_mb} MB image")
+    print(f"  wall time        {elapsed:8.2f} s   (ideal with this schedule ~{ideal:.2f} s, overhead {elapsed - ideal:+.2f} s)")
+    print(f"  progress updates {progress_updates[0]:8d}     UI events handled {ui.handled}, "
+          f"max drain {max(ui.drains, default=0) * 1000:.2f} ms")
+    if failed: print(f"  FAILED phases: {', '.join(failed)}")
+    print(f"  {'span':<18} {'kind':<6} {'start s':>8} {'seconds':>8} {'spawn ms':>9} {'1st out ms':>10}")
+    for record in session.tracer.records():
+        print(f"  {record['name']:<18} {record['category']:<6} {record['start_s']:8.2f} {record['seconds']:8.2f} "
+              f"{record.get('spawn_ms', ''):>9} {record.get('first_output_ms', ''):>10}")
+    if args.trace_dir:
+        print(f"  trace: {session.tracer.export(args.trace_dir)}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
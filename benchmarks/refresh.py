@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Compares an in-place refresh with rewriting the whole image.
+
+Builds a synthetic "old build" tree and a "new build" that differs from it the way a cumulative
+update does: a few files get new content (some with the same size), a few are added or removed,
+some get only new timestamps, and links are added, removed or pointed elsewhere. The old build is copied onto a "drive" directory, which is then
+refreshed with DriveTarget.refresh_in_place against the new build (standing in for the mounted
+image). The run prints the bytes written and the time taken next to a full copy of the new build,
+checks that the drive ends up identical to the new build (links included, with those pointing
+into the image pointing into the drive), and repeats the refresh to show that
+an up-to-date drive costs only a scan.
+
+Usage:
+    python benchmarks/refresh.py [--files 3000] [--total-mb 300] [--change-percent 5]
+"""
+
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+def write_tree(root: str, files: int, total_bytes: int, rng: random.Random) -> list:
+    paths = []
+    for i in range(files):
+        rel = os.path.join("Windows", f"dir{i % 37}", f"sub{i % 5}", f"file{i}.bin")
+        os.makedirs(os.path.join(root, os.path.dirname(rel)), exist_ok=True)
+        with open(os.path.join(root, rel), "wb") as f: f.write(os.urandom(max(1, int(rng.expovariate(files / total_bytes)))))
+        paths.append(rel)
+    return paths
+
+def write_links(old: str):
+    os.symlink("dir1", os.path.join(old, "Windows", "same-link"))
+    os.symlink("dir2", os.path.join(old, "Windows", "changed-link"))
+    os.symlink("dir3", os.path.join(old, "Windows", "removed-link"))
+
+def make_update(old: str, new: str, paths: list, percent: float, rng: random.Random) -> dict:
+    shutil.copytree(old, new, symlinks=True)
+    count = max(1, int(len(paths) * percent / 100))
+    picked = rng.sample(paths, count * 5)
+    changes = {"same size": picked[:count], "resized": picked[count:2 * count], "removed": picked[2 * count:3 * count],
+               "retimed": picked[3 * count:4 * count]}
+    for rel in changes["same size"]:
+        size = os.path.getsize(os.path.join(new, rel))
+        with open(os.path.join(new, rel), "wb") as f: f.write(os.urandom(size))
+    for rel in changes["resized"]:
+        with open(os.path.join(new, rel), "ab") as f: f.write(os.urandom(4096))
+    for rel in changes["removed"]: os.remove(os.path.join(new, rel))
+    for rel in changes["retimed"]: os.utime(os.path.join(new, rel), (time.time() + 3600, time.time() + 3600))
+    changes["added"] = [os.path.join("Windows", "NewFeature", f"added{i}.bin") for i in range(count)]
+    os.makedirs(os.path.join(new, "Windows", "NewFeature"))
+    for rel in changes["added"]:
+        with open(os.path.join(new, rel), "wb") as f: f.write(os.urandom(64 * 1024))
+    os.remove(os.path.join(new, "Windows", "changed-link"))
+    os.symlink("dir4", os.path.join(new, "Windows", "changed-link"))
+    os.remove(os.path.join(new, "Windows", "removed-link"))
+    os.symlink(os.path.join(new, "Windows", "dir5"), os.path.join(new, "Windows", "absolute-link"))  # Into the image itself
+    changes["relinked"] = ["changed-link", "absolute-link"]
+    return changes
+
+def refresh(session: w2g.InstallSession, drive: str) -> float:
+    target = w2g.DriveTarget(session, {"index": 1, "model": "Fake"})
+    target.target_drive_letter = drive
+    start = time.perf_counter()
+    target.refresh_in_place()
+    return time.perf_counter() - start
+
+def identical(a: str, b: str) -> bool:
+    compare = filecmp.dircmp(a, b)
+    if compare.left_only or compare.right_only or compare.funny_files: return False
+    if filecmp.cmpfiles(a, b, compare.common_files, shallow=False)[1:] != ([], []): return False
+    return all(identical(os.path.join(a, d), os.path.join(b, d)) for d in compare.common_dirs)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=3000)
+    parser.add_argument("--total-mb", type=int, default=300)
+    parser.add_argument("--change-percent", type=float, default=5, help="Share of files in each change category")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="w2g-refresh-") as work:
+        old, new, drive, full = (os.path.join(work, name) for name in ("old", "new", "drive", "full"))
+        paths = write_tree(old, args.files, args.total_mb * 1024 * 1024, rng)
+        write_links(old)
+        changes = make_update(old, new, paths, args.change_percent, rng)
+        shutil.copytree(old, drive, symlinks=True)
+        os.makedirs(os.path.join(drive, "System Volume Information"))  # Left alone by the refresh
+        for root, name in ((new, "image"), (drive, "live")):  # The drive's boot files stay; bcdboot rewrites them
+            os.makedirs(os.path.join(root, "Boot"))
+            with open(os.path.join(root, "Boot", "BCD"), "w") as f: f.write(name)
+
+        start = time.perf_counter()
+        shutil.copytree(new, full, symlinks=True)
+        full_seconds = time.perf_counter() - start
+        full_bytes = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(new) for f in files)
+
+        config = {**w2g.default_config(), "trace_enabled": False}
+        session = w2g.InstallSession(config, "", lambda message, level="info": None)
+        session.staged_image_dir = new
+        session.image_manifest = w2g.FileManifest().scan(new, w2g.REFRESH_KEEP)  # As InstallSession.stage_image scans it
+        first = refresh(session, drive)
+        stats = dict(session.tracer.metadata["refresh"]["1"])
+        second = refresh(session, drive)
+        again = session.tracer.metadata["refresh"]["1"]
+        shutil.rmtree(os.path.join(drive, "System Volume Information"))
+        with open(os.path.join(drive, "Boot", "BCD")) as f: boot = f.read()
+        shutil.rmtree(os.path.join(drive, "Boot")); shutil.rmtree(os.path.join(new, "Boot"))
+        same = identical(new, drive)
+        links = {key: entry[1:] for key, entry in w2g.FileManifest().scan(drive).links.items()}
+        wanted = {key: entry[1:] for key, entry in session.image_manifest.links.items()}
+        absolute = os.readlink(os.path.join(drive, "Windows", "absolute-link"))
+
+    print(f"{args.files} files, {full_bytes / 1024 ** 2:.0f} MB; changed: " + ", ".join(f"{len(v)} {k}" for k, v in changes.items()))
+    print(f"  full copy          {full_seconds:7.2f} s  {full_bytes / 1024 ** 2:8.1f} MB written")
+    print(f"  refresh            {first:7.2f} s  {stats['bytes_written'] / 1024 ** 2:8.1f} MB written "
+          f"({stats['files_written']} files, {stats['files_deleted']} deleted, {stats['bytes_hashed'] / 1024 ** 2:.1f} MB hashed)")
+    print(f"  refresh, no change {second:7.2f} s  {again['bytes_written'] / 1024 ** 2:8.1f} MB written")
+    expected = len(changes["same size"]) + len(changes["resized"]) + len(changes["added"])
+    failures = []
+    if not same: failures.append("the refreshed drive differs from the new build")
+    if boot != "live": failures.append("the image's boot files were copied over the drive's")
+    if links != wanted: failures.append(f"the drive's links {links} differ from the new build's {wanted}")
+    if absolute != os.path.join(drive, "Windows", "dir5"): failures.append(f"a link into the image points to {absolute}, not into the drive")
+    if stats["links_created"] != len(changes["relinked"]): failures.append(f"created {stats['links_created']} links, expected {len(changes['relinked'])}")
+    if stats["files_written"] != expected: failures.append(f"wrote {stats['files_written']} files, expected {expected}")
+    if again["files_written"] or again["links_created"]: failures.append("a second refresh wrote files or links")
+    for failure in failures: print(f"  FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Replays 7-Zip and DISM output transcripts through the subprocess output engine.
+
+Compares the streaming OutputProcessor with the previous readline-based loop: throughput, how many
+progress updates each one sees, and peak memory. Synthetic transcripts that mimic `7z x -bsp1`,
+a verbose `7z x -bb3` file listing and `dism /Apply-Image` are generated by default; pass recorded
+transcripts (raw bytes captured from the tool's stdout) to replay those instead.
+
+Usage:
+    python benchmarks/replay_output.py [--transcript 7z:path/to/7z.log] [--transcript dism:path/to/dism.log]
+"""
+
+import argparse
+import io
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+def synthetic_7z_progress() -> bytes:
+    out = io.StringIO()
+    out.write("\n7-Zip 23.01 (x64) : Copyright (c) 1999-2023 Igor Pavlov : 2023-06-20\n\n"
+              "Scanning the drive for archives:\n1 file, 6340345856 bytes (6047 MiB)\n\n"
+              "Extracting archive: Win11_23H2_English_x64.iso\n--\nPath = Win11_23H2_English_x64.iso\nType = Udf\n\n")
+    previous = ""
+    for percent in range(101):
+        for step in range(20):  # 7-Zip redraws several times per percent
+            status = f"{percent:3d}% 1 - sources\\install.wim"
+            out.write("\b" * len(previous) + " " * len(previous) + "\b" * len(previous) + status)
+            previous = status
+    out.write("\nEverything is Ok\n\nSize:       4941830946\nCompressed: 6340345856\n")
+    return out.getvalue().encode("utf-8")
+
+def synthetic_7z_verbose(files: int = 100_000) -> bytes:
+    lines = [f"- sources\\sxs\\component_{i:06d}\\payload_{i % 97}.dll\n" for i in range(files)]
+    return ("\n7-Zip 23.01 (x64)\n\nExtracting archive: full.iso\n" + "".join(lines) + "Everything is Ok\n").encode("utf-8")
+
+def synthetic_dism() -> bytes:
+    out = io.StringIO()
+    out.write("\nDeployment Image Servicing and Management tool\nVersion: 10.0.22621.2792\n\nApplying image\n")
+    for tenth in range(1001):
+        percent = tenth / 10
+        filled = int(percent / 100 * 58)
+        label = f"{percent:.1f}%"
+        bar = ("=" * filled).ljust(58)
+        middle = 29 - len(label) // 2
+        out.write("\r[" + bar[:middle] + label + bar[middle + len(label):] + "]")
+    out.write("\nThe operation completed successfully.\n")
+    return out.getvalue().encode("utf-8")
+
+def legacy_loop(data: bytes) -> dict:
+    """The previous _run_subprocess loop: readline, two regex searches per line, every line kept."""
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="replace")
+    output_lines, updates = [], 0
+    for line in iter(stream.readline, ''):
+        output_lines.append(line)
+        match = re.search(r'\[=*\s*(\d{1,3}(?:\.\d)?)\s*%\s*\]', line)
+        if match: updates += 1; continue
+        match = re.search(r'^\s*(\d{1,3})%\s', line)
+        if match: updates += 1; continue
+    return {"updates": updates, "lines": len(output_lines)}
+
+def streaming_engine(data: bytes, tool: str, min_interval: float) -> dict:
+    updates = []
+    output = w2g.OutputProcessor(w2g.progress_pattern_for([tool]), updates.append, lambda text: None,
+                                 min_interval=min_interval, spill=False)
+    for offset in range(0, len(data), w2g.OUTPUT_READ_SIZE):
+        output.feed(data[offset:offset + w2g.OUTPUT_READ_SIZE].decode("utf-8", errors="replace"))
+    output.finish()
+    return {"updates": len(updates), "lines": output.line_count, "last": updates[-1] if updates else None}
+
+def measure(function, *args) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transcript", action="append", default=[], metavar="TOOL:PATH",
+                        help="Replay a recorded transcript; TOOL is 7z or dism.")
+    args = parser.parse_args()
+    transcripts = []
+    for spec in args.transcript:
+        tool, _, path = spec.partition(":")
+        with open(path, "rb") as f: transcripts.append((f"{tool}: {os.path.basename(path)}", tool, f.read()))
+    if not transcripts:
+        transcripts = [("7z -bsp1 progress", "7z", synthetic_7z_progress()),
+                       ("7z -bb3 file list", "7z", synthetic_7z_verbose()),
+                       ("dism /Apply-Image", "dism", synthetic_dism())]
+
+    print(f"{'transcript':<22} {'engine':<22} {'MB/s':>8} {'updates':>8} {'lines':>8} {'peak KB':>9}")
+    for name, tool, data in transcripts:
+        size_mb = len(data) / (1024 ** 2)
+        runs = [("readline (legacy)", legacy_loop, (data,)),
+                ("streaming, all", streaming_engine, (data, tool, 0.0)),
+                ("streaming, limited", streaming_engine, (data, tool, w2g.PROGRESS_MIN_INTERVAL))]
+        for engine, function, function_args in runs:
+            result, elapsed, peak = measure(function, *function_args)
+            print(f"{name:<22} {engine:<22} {size_mb / elapsed:8.1f} {result['updates']:8d} {result['lines']:8d} {peak / 1024:9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Measures cold start: importing the install core, and (where a display is available) the time until
+the main window is built and idle.
+
+Each measurement runs in a fresh interpreter. The import check also fails if importing the core
+pulled in the GUI toolkit or other modules that should only load on demand, so a stray top-level
+import shows up here before it shows up as a slow start.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--max-import-ms 150] [--no-window]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+LAZY_MODULES = ["tkinter", "customtkinter", "psutil", "xml.etree.ElementTree"]
+
+IMPORT_PROBE = f'''
+import json, sys, time
+start = time.perf_counter()
+import Windows2Go
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+'''
+
+WINDOW_PROBE = '''
+import json, os, sys, time
+start = time.perf_counter()
+import Windows2Go
+app = Windows2Go.WindowsToGoCreator()
+built = time.perf_counter()
+def idle():
+    print(json.dumps({"built_ms": (built - start) * 1000, "idle_ms": (time.perf_counter() - start) * 1000}), flush=True)
+    os._exit(0)
+app.root.after_idle(idle)
+app.root.mainloop()
+'''
+
+def probe(code: str) -> dict:
+    proc = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0: raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "probe failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="Fail if the median core import takes longer")
+    parser.add_argument("--no-window", action="store_true", help="Skip the window measurement")
+    args = parser.parse_args()
+
+    imports = [probe(IMPORT_PROBE) for _ in range(args.runs)]
+    import_ms = statistics.median(r["ms"] for r in imports)
+    loaded = sorted({m for r in imports for m in r["loaded"]})
+    print(f"core import      median {import_ms:7.1f} ms  (min {min(r['ms'] for r in imports):.1f}, {args.runs} runs)")
+    failed = False
+    if loaded:
+        print(f"  FAIL: importing the core loaded {', '.join(loaded)}"); failed = True
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        print(f"  FAIL: above the {args.max_import_ms:.0f} ms budget"); failed = True
+
+    has_display = os.name == "nt" or bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+    if args.no_window or not has_display:
+        print("window           skipped" + ("" if args.no_window else " (no display)"))
+    else:
+        try:
+            windows = [probe(WINDOW_PROBE) for _ in range(args.runs)]
+            print(f"window built     median {statistics.median(r['built_ms'] for r in windows):7.1f} ms")
+            print(f"window idle      median {statistics.median(r['idle_ms'] for r in windows):7.1f} ms")
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            print(f"window           could not be measured: {e}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
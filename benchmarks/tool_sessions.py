@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Compares one process per query with the persistent diskpart/PowerShell sessions of ToolBroker.
+
+Scripted stand-ins replace diskpart and PowerShell: they answer the queries Windows2Go sends, in
+script mode (diskpart /s, powershell -Command) and interactively over stdin, after a configurable
+start-up delay that models the cost of starting the real tools. Besides the timings, the run checks
+the session behaviour that matters for safety: replies are parsed into volumes and disks, a failed
+'select disk' stops a batch before the next command is sent, and a killed session restarts.
+
+Usage:
+    python benchmarks/tool_sessions.py [--queries 20] [--startup-ms 300]
+"""
+
+import argparse
+import os
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+FAKE_DISKPART = r'''
+import os, re, sys, time
+time.sleep(float(os.environ["FAKE_STARTUP_SECONDS"]))
+log = open(os.environ["FAKE_DISKPART_LOG"], "a")
+def run(line, state):
+    log.write(line + "\n"); log.flush()
+    match = re.match(r"select disk (\d+)", line)
+    if match:
+        if int(match.group(1)) > 8:
+            print("\nThe disk you specified is not valid.\n\nThere is no disk selected."); return False
+        state["disk"] = int(match.group(1)); print("\nDisk %d is now the selected disk." % state["disk"])
+    elif line == "detail disk":
+        print("\nFake USB Device\nDisk ID: 1234ABCD\nType   : USB\n\n"
+              "  Volume ###  Ltr  Label        Fs     Type        Size     Status     Info\n"
+              "  ----------  ---  -----------  -----  ----------  -------  ---------  --------\n"
+              "  Volume %-4d  %s   WindowsUSB   NTFS   Removable     58 GB  Healthy\n"
+              "  Volume %-4d       System       FAT32  Partition    100 MB  Healthy    Hidden"
+              % (state["disk"], "DEFGHIJKLMNOPQRSTUVWXYZ"[state["disk"] % 23], state["disk"] + 10))
+    elif line.startswith("assign"):
+        print("\nDiskPart successfully assigned the drive letter or mount point.")
+    return True
+state = {"disk": 0}
+if len(sys.argv) > 2 and sys.argv[1].lower() == "/s":
+    for line in open(sys.argv[2]).read().splitlines():
+        if not run(line.strip().lower(), state): sys.exit(1)
+    sys.exit(0)
+print("\nMicrosoft DiskPart version 10.0 (fake)")
+while True:
+    sys.stdout.write("\nDISKPART> "); sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line or line.strip().lower() == "exit": break
+    run(line.strip().lower(), state)
+'''
+
+FAKE_POWERSHELL = r'''
+import os, re, sys, time
+time.sleep(float(os.environ["FAKE_STARTUP_SECONDS"]))
+DISKS = '[{"DeviceId":"1","FriendlyName":"Stick A","SerialNumber":"A1","Size":64000000000},{"DeviceId":"2","FriendlyName":"Stick B","SerialNumber":"B2","Size":32000000000}]'
+def run(line):
+    if "Write-Output '" in line and "__W2G_" in line and not line.startswith("try"):
+        print(re.search(r"'(.*)'", line).group(1)); return
+    if "Get-PhysicalDisk" in line: print(DISKS)
+    elif "Get-Partition" in line:
+        disk = int(re.search(r"-DiskNumber (\d+)", line).group(1))
+        if disk > 8: print("__W2G_ERROR__ No MSFT_Partition objects found with property 'DiskNumber' equal to '%d'." % disk)
+        else: print("E")
+if "-Command" in sys.argv and sys.argv[sys.argv.index("-Command") + 1] != "-":
+    run(sys.argv[sys.argv.index("-Command") + 1]); sys.exit(0)
+for line in sys.stdin:
+    run(line.strip()); sys.stdout.flush()
+'''
+
+def write_tools(directory: str) -> dict:
+    paths = {}
+    for name, source in (("diskpart", FAKE_DISKPART), ("powershell", FAKE_POWERSHELL)):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f: f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        paths[name] = path
+    return paths
+
+def timed(function, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count): function()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=20, help="Queries of each kind")
+    parser.add_argument("--startup-ms", type=float, default=300, help="Start-up time of the fake tools")
+    args = parser.parse_args()
+
+    failures = []
+    def check(condition: bool, message: str):
+        if not condition: failures.append(message)
+
+    with tempfile.TemporaryDirectory(prefix="w2g-sessions-") as work:
+        log_path = os.path.join(work, "diskpart.log")
+        os.environ.update(FAKE_STARTUP_SECONDS=str(args.startup_ms / 1000), FAKE_DISKPART_LOG=log_path)
+        tools = w2g.resolve_tools({"tool_paths": write_tools(work)})
+        config = {**w2g.default_config(), "tool_paths": tools, "trace_enabled": False}
+        oneshot = w2g.InstallSession({**config, "tool_sessions": False}, "", lambda *a: None)
+        broker = w2g.ToolBroker(tools)
+        session = w2g.InstallSession(config, "", lambda *a: None, broker=broker)
+        drive = {"index": 1, "device": "Disk 1"}
+
+        detail_disk = "select disk 1\ndetail disk\nexit"
+        rows = []
+        for label, without, with_broker in (
+                ("list USB disks", lambda: w2g.list_usb_disks(tools), lambda: w2g.list_usb_disks(tools, broker)),
+                ("target volumes", lambda: w2g.target_volume_roots(drive, tools), lambda: w2g.target_volume_roots(drive, tools, broker)),
+                ("diskpart detail disk", lambda: w2g.diskpart_volumes(oneshot.run_diskpart(detail_disk, capture=True)),
+                 lambda: w2g.diskpart_volumes(session.run_diskpart(detail_disk, capture=True)))):
+            broker.close()  # The session's start-up counts towards its time
+            rows.append((label, timed(without, args.queries), timed(with_broker, args.queries)))
+            check(without() == with_broker(), f"{label}: the session reply differs from the one-shot reply")
+
+        volumes = w2g.diskpart_volumes(session.run_diskpart("select disk 3\ndetail disk", capture=True))
+        check([(v["number"], v["letter"], v["label"]) for v in volumes] == [(3, "G", "WindowsUSB"), (13, None, "System")],
+              f"detail disk parsed as {volumes}")
+        check([d["index"] for d in w2g.list_usb_disks(tools, broker)] == [1, 2], "USB disks not parsed from the session reply")
+
+        open(log_path, "w").close()
+        try:
+            session.run_diskpart("select disk 99\nclean\nexit")
+            check(False, "a failed 'select disk' did not raise")
+        except w2g.SubprocessError:
+            with open(log_path) as f: sent = f.read().split()
+            check("clean" not in sent, "'clean' was sent after 'select disk' failed")
+        try:
+            broker.powershell("Get-Partition -DiskNumber 99")
+            check(False, "a failing PowerShell command did not raise")
+        except w2g.SubprocessError:
+            pass
+
+        starts = broker.session("diskpart").starts
+        broker.close("diskpart", kill=True)
+        check(session.run_diskpart("select disk 2\ndetail disk", capture=True).count("WindowsUSB") == 1, "no reply after a restart")
+        check(broker.session("diskpart").starts == starts + 1, "the killed session was not restarted")
+        letters = {w2g.reserve_drive_letter(disk) for disk in range(1, 5)}
+        check(len(letters) == 4 and w2g.reserve_drive_letter(1) in letters, "drive letters are not unique and stable per disk")
+        broker.close()
+
+    print(f"{args.queries} queries of each kind, tools start in {args.startup_ms:.0f} ms")
+    print(f"  {'query':<22} {'per process ms':>14} {'session ms':>11} {'speedup':>8}")
+    for label, without, with_broker in rows:
+        print(f"  {label:<22} {without / args.queries * 1000:14.1f} {with_broker / args.queries * 1000:11.1f} {without / with_broker:7.1f}x")
+    for message in failures: print(f"  FAIL: {message}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
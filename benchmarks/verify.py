@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Measures post-install verification and checks that it finds damaged files.
+
+Builds a synthetic image tree and a "drive" copy of it, then damages the copy the way a failing
+USB stick does: a few bytes flipped with size and timestamps unchanged, a truncated file and a
+missing file. A file changed with a new timestamp (as portable tuning does to registry hives)
+must be skipped, not reported. Full verification runs with several reader counts and prints the
+throughput of each next to a buffered single-threaded read (which the OS cache can answer, as it
+would right after writing); sampled verification reports how much it read. The run fails if full
+verification misses a damaged file or reports the retimed one.
+
+Usage:
+    python benchmarks/verify.py [--files 3000] [--total-mb 300] [--workers 1,2,4,8]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Windows2Go as w2g  # noqa: E402
+
+def write_tree(root: str, files: int, total_bytes: int, rng: random.Random) -> list:
+    paths = []
+    for i in range(files):
+        rel = os.path.join("Windows", f"dir{i % 37}", f"sub{i % 5}", f"file{i}.bin")
+        os.makedirs(os.path.join(root, os.path.dirname(rel)), exist_ok=True)
+        with open(os.path.join(root, rel), "wb") as f: f.write(os.urandom(max(1, int(rng.expovariate(files / total_bytes)))))
+        paths.append(rel)
+    return paths
+
+def damage(drive: str, paths: list, rng: random.Random) -> dict:
+    """Damages the drive copy. Returns {category: [relative paths]}."""
+    larger = [p for p in paths if os.path.getsize(os.path.join(drive, p)) > 4096]
+    flipped, truncated, missing, retimed = rng.sample(larger, 3), rng.sample(larger, 1), rng.sample(larger, 1), rng.sample(larger, 1)
+    flipped = [p for p in flipped if p not in truncated + missing + retimed]
+    for rel in flipped:
+        path = os.path.join(drive, rel)
+        info = os.stat(path)
+        with open(path, "r+b") as f:
+            f.seek(info.st_size // 2); byte = f.read(1); f.seek(info.st_size // 2); f.write(bytes([byte[0] ^ 0xFF]))
+        os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns))  # Silent corruption keeps the metadata
+    for rel in truncated:
+        path = os.path.join(drive, rel)
+        info = os.stat(path)
+        with open(path, "r+b") as f: f.truncate(info.st_size // 2)
+        os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns))
+    for rel in missing: os.remove(os.path.join(drive, rel))
+    for rel in retimed:
+        with open(os.path.join(drive, rel), "ab") as f: f.write(b"tuned")
+    return {"flipped": flipped, "truncated": truncated, "missing": missing, "retimed": retimed}
+
+def plain_read(root: str, paths: list) -> float:
+    start = time.perf_counter()
+    for rel in paths:
+        try: w2g.hash_file(os.path.join(root, rel))
+        except OSError: pass
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=3000)
+    parser.add_argument("--total-mb", type=int, default=300)
+    parser.add_argument("--workers", default="1,2,4,8", help="Reader counts to compare")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    failures, rows = [], []
+    with tempfile.TemporaryDirectory(prefix="w2g-verify-") as work:
+        image_root, drive = os.path.join(work, "image"), os.path.join(work, "drive")
+        paths = write_tree(image_root, args.files, args.total_mb * 1024 * 1024, rng)
+        shutil.copytree(image_root, drive)
+        damaged = damage(drive, paths, rng)
+        image = w2g.FileManifest().scan(image_root)
+        start = time.perf_counter()
+        image.hash_files(image_root, list(image.files))
+        image_seconds = time.perf_counter() - start
+
+        plain = plain_read(drive, paths)
+        for workers in [int(w) for w in args.workers.split(",")]:
+            result = w2g.verify_tree(image, image_root, drive, "full", workers=workers)
+            rows.append((f"full, {workers} reader{'s' if workers > 1 else ''}", result))
+        sampled = w2g.verify_tree(image, image_root, drive, "sampled", workers=4)
+        rows.append(("sampled 5%, 4 readers", sampled))
+
+        full = rows[0][1]
+        found = {path for path, _ in full["mismatches"]}
+        for rel in damaged["flipped"] + damaged["truncated"]:
+            if rel not in found: failures.append(f"full verification missed damaged {rel}")
+        if damaged["retimed"][0] in found: failures.append("a file changed after writing was reported as damaged")
+        if full["missing"] != damaged["missing"]: failures.append(f"missing files reported as {full['missing']}")
+        if full["modified"] != 1: failures.append(f"{full['modified']} files counted as changed after writing, expected 1")
+        if sampled["bytes_checked"] >= full["bytes_checked"]: failures.append("sampled verification read as much as full")
+
+        session = w2g.InstallSession({**w2g.default_config(), "trace_enabled": False, "verify_mode": "full"}, "",
+                                     lambda message, level="info": None)
+        session.staged_image_dir, session.image_manifest = image_root, image
+        target = w2g.DriveTarget(session, {"index": 1, "model": "Fake"})
+        target.target_drive_letter = drive
+        try:
+            target.verify_drive()
+            failures.append("verify_drive passed a damaged drive")
+        except RuntimeError as e:
+            if "damaged or missing" not in str(e): failures.append(f"verify_drive raised '{e}'")
+
+    total_mb = full["bytes_checked"] / 1024 ** 2
+    print(f"{args.files} files, {total_mb:.0f} MB checked in full mode; image hashed once in {image_seconds:.2f} s")
+    print(f"  {'run':<24} {'seconds':>8} {'MB/s':>8} {'files':>7} {'cache bypassed':>15}")
+    print(f"  {'buffered read, 1 thread':<24} {plain:8.2f} {total_mb / plain:8.0f} {len(paths):7d} {'no':>15}")
+    for label, result in rows:
+        print(f"  {label:<24} {result['seconds']:8.2f} {result['mbps']:8.0f} {result['files_checked']:7d} "
+              f"{'yes' if result['direct'] else 'no':>15}")
+    print(f"  mismatches found (full): " + "; ".join(f"{path}: {reason}" for path, reason in full["mismatches"]))
+    for failure in failures: print(f"  FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())